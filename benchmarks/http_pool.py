@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+
+"""
+Measure the HTTP layer of bugzilla2gitlab against a local stand-in server.
+
+The server serves a bulky show_bug.cgi?ctype=xml response over a bandwidth limited,
+keep-alive connection and closes idle connections like Apache does. The same workload
+is run with the old settings (10 pooled connections, no compression, no keep-alive
+hygiene) and with pools sized to the number of workers, gzip and keep-alive hygiene.
+
+    python benchmarks/http_pool.py --workers 16 --requests 400
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import gzip
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from bugzilla2gitlab import utils  # noqa: E402
+
+COMMENT = """
+  <long_desc isprivate="0">
+    <commentid>{0}</commentid>
+    <who name="Jane Doe">jdoe@example.com</who>
+    <bug_when>2017-09-11 09:42:36 -0400</bug_when>
+    <thetext>Stack trace of comment {0}:
+{1}</thetext>
+  </long_desc>"""
+
+
+def make_bug_xml(comments):
+    rng = random.Random(1)
+
+    def trace():
+        return "\n".join("    at org.example.Module{:x}.call{:x}(Module.java:{})".format(
+            rng.getrandbits(32), rng.getrandbits(24), rng.randint(1, 5000)) for _ in range(40))
+
+    body = "".join(COMMENT.format(i, trace()) for i in range(comments))
+    xml = '<?xml version="1.0"?><bugzilla><bug><bug_id>1</bug_id>{}</bug></bugzilla>'
+    return xml.format(body).encode()
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # idle connections are closed after this many seconds, like Apache's KeepAliveTimeout
+    timeout = 1.0
+    bandwidth = 0
+    latency = 0
+    bug_xml = b""
+    bug_xml_gzip = b""
+    wire_bytes = 0
+    connections = 0
+    lock = threading.Lock()
+
+    def setup(self):
+        super().setup()
+        with self.lock:
+            StandInHandler.connections += 1
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, body, content_type, encoding=None):
+        time.sleep(self.latency)
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if encoding:
+            self.send_header("Content-Encoding", encoding)
+        self.end_headers()
+        chunk = 64 * 1024
+        for start in range(0, len(body), chunk):
+            self.wfile.write(body[start:start + chunk])
+            if self.bandwidth:
+                time.sleep(min(chunk, len(body) - start) / self.bandwidth)
+        with self.lock:
+            StandInHandler.wire_bytes += len(body)
+
+    def do_GET(self):
+        if "gzip" in self.headers.get("Accept-Encoding", ""):
+            self._send(self.bug_xml_gzip, "text/xml", "gzip")
+        else:
+            self._send(self.bug_xml, "text/xml")
+
+    def do_PUT(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        self._send(b'{"bugs": []}', "application/json")
+
+
+def run_throughput(base_url, workers, requests, settings):
+    utils.configure_http(**settings)
+    StandInHandler.wire_bytes = 0
+    StandInHandler.connections = 0
+    url = "{}/show_bug.cgi?ctype=xml&id=1".format(base_url)
+    started = time.monotonic()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(
+            lambda _: len(utils._perform_request(url, "get", json=False).content), range(requests)))
+    elapsed = time.monotonic() - started
+    return requests / elapsed, StandInHandler.wire_bytes, StandInHandler.connections
+
+
+def run_idle_puts(base_url, requests, keepalive, settings):
+    """
+    PUT requests (which are not retried) with idle gaps around the server keep-alive timeout.
+    """
+    utils.configure_http(**settings)
+    url = "{}/rest/bug/1".format(base_url)
+    errors = 0
+    for _ in range(requests):
+        time.sleep(keepalive * random.uniform(0.9, 1.1))
+        try:
+            utils._perform_request(url, "put", data="{}")
+        except Exception:
+            errors += 1
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=400)
+    parser.add_argument("--comments", type=int, default=200, help="comments in the served bug XML")
+    parser.add_argument("--bandwidth", type=float, default=50,
+                        help="Mbit/s per connection, 0 for unlimited")
+    parser.add_argument("--latency", type=float, default=0.02, help="server latency in seconds")
+    parser.add_argument("--idle_requests", type=int, default=20, help="PUT requests with idle gaps")
+    args = parser.parse_args()
+
+    StandInHandler.bug_xml = make_bug_xml(args.comments)
+    StandInHandler.bug_xml_gzip = gzip.compress(StandInHandler.bug_xml)
+    StandInHandler.bandwidth = args.bandwidth * 1e6 / 8
+    StandInHandler.latency = args.latency
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = "http://127.0.0.1:{}".format(server.server_port)
+
+    scenarios = [
+        ("before", {"pool_maxsize": 10, "compression": False}),
+        ("pool only", {"pool_maxsize": args.workers, "compression": False}),
+        ("pool + gzip", {"pool_maxsize": args.workers, "compression": True}),
+    ]
+    print("bug XML: {} bytes, gzip: {} bytes".format(
+        len(StandInHandler.bug_xml), len(StandInHandler.bug_xml_gzip)))
+    print("{:<14} {:>10} {:>14} {:>12}".format("settings", "req/s", "MB on wire", "connections"))
+    for name, settings in scenarios:
+        rate, wire_bytes, connections = run_throughput(
+            base_url, args.workers, args.requests, settings)
+        print("{:<14} {:>10.1f} {:>14.1f} {:>12}".format(name, rate, wire_bytes / 1e6, connections))
+
+    if args.idle_requests:
+        keepalive = StandInHandler.timeout
+        for name, hygiene in [("before", None), ("keep-alive hygiene", keepalive * 0.8)]:
+            errors = run_idle_puts(
+                base_url, args.idle_requests, keepalive, {"keepalive_timeout": hygiene})
+            print("idle PUTs, {}: {} of {} failed".format(name, errors, args.idle_requests))
+
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
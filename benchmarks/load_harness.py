@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+
+"""
+Run a whole migration against local stand-ins of Bugzilla and GitLab (see standin.py).
+
+The stand-ins serve generated bugs and answer like GitLab, with configurable latency,
+per-token rate limiting (429) and injected server errors. The migration runs in batch
+mode (dead_letter_file) with the given concurrency settings. Reported: bugs per second,
+requests per bug by endpoint, rate limited and failed requests, failed bugs and the peak
+memory of the process.
+
+    python benchmarks/load_harness.py --bugs 200 --comments 30 --attachments 3 \
+        --gitlab-latency 0.02 --rate-limit 50 --error-rate 0.01 --bug-concurrency 8
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import resource
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from standin import BugFactory, BugzillaStandIn, GitLabStandIn
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from bugzilla2gitlab import Migrator  # noqa: E402
+
+DEFAULTS = os.path.join(
+    os.path.dirname(__file__), "..", "tests", "test_data", "config", "defaults.yml")
+
+
+def write_config(path, args, bugzilla_url, gitlab_url, factory):
+    with open(DEFAULTS) as f:
+        config = yaml.safe_load(f)
+    config.update({
+        "dry_run": False,
+        "verify": False,
+        "fetch_bugs": False,
+        "close_bugzilla_bugs": args.close_bugs,
+        "bugzilla_base_url": bugzilla_url,
+        "bugzilla_source": args.source,
+        "bugzilla_attachments_on_demand": not args.attachment_data,
+        "gitlab_base_url": gitlab_url + "/api/v4",
+        "gitlab_private_tokens": ["TOKEN{}".format(i) for i in range(1, args.tokens)],
+        "component_mapping_auto": True,
+        "bug_concurrency": args.bug_concurrency,
+        "heavy_bug_concurrency": args.heavy_bug_concurrency,
+        "note_concurrency": args.note_concurrency,
+        "note_backend": args.note_backend,
+        "attachment_concurrency": args.attachment_concurrency,
+        "http_read_timeout": 30,
+        "dead_letter_file": os.path.join(path, "dead_letters.jsonl"),
+        "retry_backoff": 1,
+        "buglist_file": os.path.join(path, "bug_list"),
+    })
+    with open(os.path.join(path, "defaults.yml"), "w") as f:
+        yaml.safe_dump(config, f)
+    with open(os.path.join(path, "user_mappings.yml"), "w") as f:
+        users = {user: user.split("@")[0] for user in factory.users}
+        users[config["bugzilla_misc_user"]] = config["gitlab_misc_user"]
+        yaml.safe_dump(users, f)
+    with open(os.path.join(path, "component_mappings.yml"), "w") as f:
+        f.write("---\n")
+
+
+@contextlib.contextmanager
+def quiet(verbose, output):
+    if verbose:
+        yield
+        return
+    with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+        yield
+
+
+def peak_memory_mb():
+    # ru_maxrss is in kilobytes on Linux, in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024.0 * 1024 if sys.platform == "darwin" else 1024.0)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--bugs", type=int, default=100)
+    parser.add_argument("--first-bug", type=int, default=1)
+    parser.add_argument("--comments", type=int, default=20,
+                        help="average number of comments per bug")
+    parser.add_argument("--attachments", type=int, default=2, help="attachments per bug")
+    parser.add_argument("--attachment-size", type=int, default=50000)
+    parser.add_argument("--obsolete", type=float, default=0.5, help="share of obsolete attachments")
+    parser.add_argument("--bugzilla-latency", type=float, default=0.0)
+    parser.add_argument("--gitlab-latency", type=float, default=0.0)
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="share of slow responses")
+    parser.add_argument("--slow-latency", type=float, default=1.0)
+    parser.add_argument("--rate-limit", type=float, help="GitLab requests per second and token")
+    parser.add_argument("--error-rate", type=float, default=0.0,
+                        help="share of requests answered with a 502")
+    parser.add_argument("--tokens", type=int, default=1, help="number of GitLab admin tokens")
+    parser.add_argument("--source", choices=["xml", "rest"], default="xml")
+    parser.add_argument("--attachment-data", action="store_true",
+                        help="read attachments with the bugs instead of on demand")
+    parser.add_argument("--close-bugs", action="store_true", help="close the Bugzilla bugs")
+    parser.add_argument("--bug-concurrency", type=int, default=1)
+    parser.add_argument("--heavy-bug-concurrency", type=int, default=1)
+    parser.add_argument("--note-concurrency", type=int, default=1)
+    parser.add_argument("--note-backend", choices=["rest", "graphql"], default="rest")
+    parser.add_argument("--attachment-concurrency", type=int, default=4)
+    parser.add_argument("--tracemalloc", action="store_true",
+                        help="also trace the peak of Python allocations")
+    parser.add_argument("--verbose", action="store_true", help="show the output of the migration")
+    args = parser.parse_args()
+
+    factory = BugFactory(args.comments, args.attachments, args.attachment_size, args.obsolete)
+    errors = {"slow_rate": args.slow_rate, "slow_latency": args.slow_latency,
+              "error_rate": args.error_rate}
+    bugzilla = BugzillaStandIn(factory, latency=args.bugzilla_latency, **errors)
+    gitlab = GitLabStandIn(latency=args.gitlab_latency, rate_limit=args.rate_limit, **errors)
+    bug_ids = [str(bug_id) for bug_id in range(args.first_bug, args.first_bug + args.bugs)]
+    bugzilla.bug_ids = bug_ids
+    config_path = tempfile.mkdtemp(prefix="b2g-load-")
+    try:
+        write_config(config_path, args, bugzilla.start(), gitlab.start(), factory)
+        output = io.StringIO()
+        with quiet(args.verbose, output):
+            migrator = Migrator(config_path)
+        # requests made while loading the configuration (user ids, milestones) are not counted
+        bugzilla.reset_stats()
+        gitlab.reset_stats()
+        if args.tracemalloc:
+            tracemalloc.start()
+        started = time.perf_counter()
+        with quiet(args.verbose, output):
+            migrator.migrate(bug_ids)
+        elapsed = time.perf_counter() - started
+
+        failed = []
+        if os.path.exists(migrator.conf.dead_letter_file):
+            with open(migrator.conf.dead_letter_file) as f:
+                failed = [json.loads(line) for line in f]
+        failed_ids = set(entry["bug_id"] for entry in failed)
+
+        print("{} bugs in {:.1f}s: {:.1f} bugs/s, {} failed".format(
+            len(bug_ids), elapsed, len(bug_ids) / elapsed, len(failed_ids)))
+        print("GitLab: {} issues, {} notes, {} uploads".format(
+            sum(gitlab.issues.values()), gitlab.notes, gitlab.uploads))
+        for standin in (bugzilla, gitlab):
+            print("{:.1f} {} requests per bug".format(
+                sum(standin.requests.values()) / len(bug_ids), standin.name))
+            print(standin.summary())
+        for entry in failed[:10]:
+            print("  bug {bug_id}: {error_type} {exception}: {error}".format(**entry))
+        print("Peak memory: {:.0f} MB".format(peak_memory_mb()))
+        if args.tracemalloc:
+            print("Peak Python allocations: {:.0f} MB".format(
+                tracemalloc.get_traced_memory()[1] / 1e6))
+    finally:
+        bugzilla.stop()
+        gitlab.stop()
+        shutil.rmtree(config_path, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,474 @@
+"""
+Local stand-ins for Bugzilla and GitLab, for load tests of bugzilla2gitlab.
+
+BugzillaStandIn serves generated bugs through show_bug.cgi?ctype=xml, attachment.cgi and
+the REST API (bugs, comments, attachments, users, history, closing bugs). GitLabStandIn
+answers the requests of a migration: users and the admin toggle, projects, milestones,
+uploads, issues, notes and GraphQL createNote mutations.
+
+Both servers add latency (with an optional slow tail), limit the requests per second of
+every token with 429 responses and inject server errors, and count the requests by
+endpoint. See load_harness.py.
+"""
+
+import base64
+from collections import Counter
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit
+from xml.sax.saxutils import escape, quoteattr
+
+BASE_TIME = datetime(2015, 1, 1)
+XML_TIME = "%Y-%m-%d %H:%M:%S +0000"
+REST_TIME = "%Y-%m-%dT%H:%M:%SZ"
+
+WORDS = ("the build fails when the parser reads a stack trace from the module after "
+         "upgrading to the new release on linux and windows with default settings").split()
+
+
+class BugFactory:
+    """
+    Generates the same bug for the same id: a description, `comments` comments on
+    average and `attachments` attachments of `attachment_size` bytes, each added by a
+    comment. A share of the attachments is obsolete, every third bug is resolved.
+    """
+
+    def __init__(self, comments=20, attachments=2, attachment_size=50000, obsolete=0.5, users=20):
+        self.comments = comments
+        self.attachments = attachments
+        self.attachment_size = attachment_size
+        self.obsolete = obsolete
+        self.users = ["user{}@example.com".format(i) for i in range(users)]
+        self.cache = {}
+        self.lock = threading.Lock()
+
+    def real_name(self, login):
+        return "User {}".format(login.split("@")[0][4:])
+
+    def bug(self, bug_id):
+        bug_id = int(bug_id)
+        with self.lock:
+            bug = self.cache.get(bug_id)
+        if bug is None:
+            bug = self.make_bug(bug_id)
+            with self.lock:
+                self.cache[bug_id] = bug
+        return bug
+
+    def make_bug(self, bug_id):
+        rng = random.Random(bug_id)
+        created = BASE_TIME + timedelta(hours=bug_id)
+        reporter = rng.choice(self.users)
+
+        def text(words):
+            return " ".join(rng.choice(WORDS) for _ in range(words))
+
+        comments = [{"who": reporter, "when": created, "text": text(100), "attach_id": None}]
+        count = rng.randint(self.comments // 2, self.comments * 3 // 2) if self.comments else 0
+        for i in range(count):
+            comments.append({"who": rng.choice(self.users),
+                             "when": created + timedelta(minutes=37 * (i + 1)),
+                             "text": text(rng.randint(10, 200)), "attach_id": None})
+
+        attachments = []
+        for i in range(self.attachments):
+            attach_id = bug_id * 1000 + i + 1
+            when = created + timedelta(minutes=37 * (len(comments) + 1), seconds=i)
+            attachment = {
+                "id": attach_id, "obsolete": rng.random() < self.obsolete, "when": when,
+                "filename": "patch-{}.diff".format(attach_id), "type": "text/plain",
+                "desc": "Patch {}".format(i + 1), "who": rng.choice(self.users),
+                "data": rng.randbytes(self.attachment_size),
+            }
+            attachments.append(attachment)
+            note = "Created attachment {}\n{}".format(attach_id, attachment["desc"])
+            comments.append({"who": attachment["who"], "when": when, "attach_id": attach_id,
+                             "text": note})
+        comments.sort(key=lambda comment: comment["when"])
+        for i, comment in enumerate(comments):
+            comment["id"] = bug_id * 1000 + i
+            comment["count"] = i
+
+        resolved = bug_id % 3 == 0
+        return {
+            "id": bug_id, "created": created, "changed": comments[-1]["when"],
+            "summary": text(8), "product": "Product", "component": "Component{}".format(bug_id % 5),
+            "version": "1.{}".format(bug_id % 4),
+            "milestone": "---" if bug_id % 2 else "2.{}".format(bug_id % 3),
+            "status": "RESOLVED" if resolved else "NEW", "resolution": "FIXED" if resolved else "",
+            "reporter": reporter, "assignee": rng.choice(self.users),
+            "cc": sorted(set(rng.choice(self.users) for _ in range(3))),
+            "comments": comments, "attachments": attachments,
+        }
+
+    def bug_xml(self, bug_id, attachment_data=True):
+        bug = self.bug(bug_id)
+        parts = ['<?xml version="1.0" encoding="UTF-8" standalone="yes" ?>\n'
+                 '<bugzilla version="5.0.4">\n<bug>']
+
+        def field(tag, value, **attrs):
+            attributes = "".join(" {}={}".format(k, quoteattr(v)) for k, v in attrs.items())
+            parts.append("<{0}{1}>{2}</{0}>".format(tag, attributes, escape(str(value))))
+
+        field("bug_id", bug["id"])
+        field("creation_ts", bug["created"].strftime(XML_TIME))
+        field("short_desc", bug["summary"])
+        field("delta_ts", bug["changed"].strftime(XML_TIME))
+        field("product", bug["product"])
+        field("component", bug["component"])
+        field("version", bug["version"])
+        field("rep_platform", "PC")
+        field("op_sys", "Linux")
+        field("bug_status", bug["status"])
+        if bug["resolution"]:
+            field("resolution", bug["resolution"])
+        field("bug_file_loc", "")
+        field("status_whiteboard", "")
+        field("keywords", "")
+        field("priority", "P3")
+        field("bug_severity", "normal")
+        field("target_milestone", bug["milestone"])
+        field("reporter", bug["reporter"], name=self.real_name(bug["reporter"]))
+        field("assigned_to", bug["assignee"], name=self.real_name(bug["assignee"]))
+        for cc in bug["cc"]:
+            field("cc", cc)
+        for comment in bug["comments"]:
+            parts.append('<long_desc isprivate="0">')
+            field("commentid", comment["id"])
+            field("comment_count", comment["count"])
+            if comment["attach_id"]:
+                field("attachid", comment["attach_id"])
+            field("who", comment["who"], name=self.real_name(comment["who"]))
+            field("bug_when", comment["when"].strftime(XML_TIME))
+            field("thetext", comment["text"])
+            parts.append("</long_desc>")
+        for attachment in bug["attachments"]:
+            parts.append('<attachment isobsolete="{}" ispatch="1" isprivate="0">'.format(
+                int(attachment["obsolete"])))
+            field("attachid", attachment["id"])
+            field("date", attachment["when"].strftime(XML_TIME))
+            field("delta_ts", attachment["when"].strftime(XML_TIME))
+            field("desc", attachment["desc"])
+            field("filename", attachment["filename"])
+            field("type", attachment["type"])
+            field("size", len(attachment["data"]))
+            field("attacher", attachment["who"], name=self.real_name(attachment["who"]))
+            if attachment_data:
+                field("data", base64.b64encode(attachment["data"]).decode(), encoding="base64")
+            parts.append("</attachment>")
+        parts.append("</bug>\n</bugzilla>\n")
+        return "\n".join(parts).encode()
+
+    def attachment(self, attach_id):
+        bug = self.bug(int(attach_id) // 1000)
+        for attachment in bug["attachments"]:
+            if attachment["id"] == int(attach_id):
+                return attachment
+        return None
+
+    def rest_bug(self, bug_id):
+        bug = self.bug(bug_id)
+        return {
+            "id": bug["id"], "creation_time": bug["created"].strftime(REST_TIME),
+            "last_change_time": bug["changed"].strftime(REST_TIME), "summary": bug["summary"],
+            "product": bug["product"], "component": bug["component"], "version": bug["version"],
+            "platform": "PC", "op_sys": "Linux", "status": bug["status"],
+            "resolution": bug["resolution"], "dupe_of": None, "whiteboard": "", "keywords": [],
+            "priority": "P3", "severity": "normal",
+            "target_milestone": bug["milestone"], "url": "", "creator": bug["reporter"],
+            "creator_detail": {"real_name": self.real_name(bug["reporter"])},
+            "assigned_to": bug["assignee"],
+            "assigned_to_detail": {"real_name": self.real_name(bug["assignee"])},
+            "cc": bug["cc"], "depends_on": [], "blocks": [], "see_also": [], "groups": [],
+        }
+
+    def rest_comments(self, bug_id):
+        return [{
+            "id": comment["id"], "count": comment["count"], "creator": comment["who"],
+            "creation_time": comment["when"].strftime(REST_TIME), "text": comment["text"],
+            "attachment_id": comment["attach_id"],
+        } for comment in self.bug(bug_id)["comments"]]
+
+    def rest_attachment(self, attachment, data=True):
+        result = {
+            "id": attachment["id"], "is_obsolete": attachment["obsolete"],
+            "creation_time": attachment["when"].strftime(REST_TIME),
+            "last_change_time": attachment["when"].strftime(REST_TIME),
+            "summary": attachment["desc"],
+            "file_name": attachment["filename"], "content_type": attachment["type"],
+            "size": len(attachment["data"]), "creator": attachment["who"],
+        }
+        if data:
+            result["data"] = base64.b64encode(attachment["data"]).decode()
+        return result
+
+
+class StandIn:
+    """
+    An HTTP server with latency, rate limiting and error injection.
+    latency: seconds added to every response, slow_latency to a share slow_rate of them.
+    rate_limit: requests per second of every token, 429 above.
+    error_rate: share of the requests answered with a 502 before they are processed.
+    """
+    name = "stand-in"
+
+    def __init__(self, latency=0.0, slow_rate=0.0, slow_latency=0.0, rate_limit=None,
+                 error_rate=0.0, seed=1):
+        self.latency = latency
+        self.slow_rate = slow_rate
+        self.slow_latency = slow_latency
+        self.rate_limit = rate_limit
+        self.error_rate = error_rate
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        # token -> (tokens left, last refill)
+        self.buckets = {}
+        self.requests = Counter()
+        self.statuses = Counter()
+        self.bytes_sent = 0
+        self.server = None
+
+    def start(self):
+        handler = type("Handler", (_Handler,), {"standin": self})
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return "http://127.0.0.1:{}".format(self.server.server_port)
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def reset_stats(self):
+        with self.lock:
+            self.requests.clear()
+            self.statuses.clear()
+            self.bytes_sent = 0
+
+    def respond(self, method, url, headers, body):
+        parts = urlsplit(url)
+        query = parse_qs(parts.query)
+        endpoint = "{} {}".format(method, re.sub(r"/[0-9]+(?=/|$)", "/:id", parts.path))
+        with self.lock:
+            self.requests[endpoint] += 1
+            slow = self.rng.random() < self.slow_rate
+            failed = self.rng.random() < self.error_rate
+            token = headers.get("private-token") or query.get("api_key", [""])[0]
+            limited = self.rate_limited(token)
+        time.sleep(self.latency + (self.slow_latency if slow else 0))
+        if limited:
+            response_headers = {"Retry-After": "1", "RateLimit-Remaining": "0"}
+            status, content = 429, b"Retry later"
+        elif failed:
+            status, response_headers, content = 502, {}, b"Bad gateway"
+        else:
+            status, response_headers, content = self.handle(
+                method, parts.path, query, headers, body)
+        with self.lock:
+            self.statuses[status] += 1
+            self.bytes_sent += len(content)
+        return status, response_headers, content
+
+    def rate_limited(self, token):
+        if not self.rate_limit:
+            return False
+        now = time.monotonic()
+        left, refilled = self.buckets.get(token, (self.rate_limit, now))
+        left = min(self.rate_limit, left + (now - refilled) * self.rate_limit)
+        if left < 1:
+            self.buckets[token] = (left, now)
+            return True
+        self.buckets[token] = (left - 1, now)
+        return False
+
+    def handle(self, method, path, query, headers, body):
+        raise NotImplementedError
+
+    def summary(self):
+        with self.lock:
+            total = sum(self.requests.values())
+            lines = ["{}: {} requests, {:.1f} MB sent, statuses {}".format(
+                self.name, total, self.bytes_sent / 1e6, dict(sorted(self.statuses.items())))]
+            for endpoint, count in self.requests.most_common():
+                lines.append("  {:<50} {:>8}".format(endpoint, count))
+        return "\n".join(lines)
+
+
+class BugzillaStandIn(StandIn):
+    name = "Bugzilla"
+
+    def __init__(self, factory, **kwargs):
+        super().__init__(**kwargs)
+        self.factory = factory
+        self.bug_ids = []
+
+    def handle(self, method, path, query, headers, body):
+        if method == "GET" and path == "/show_bug.cgi":
+            exclude = query.get("excludefield", [])
+            bug_xml = self.factory.bug_xml(query["id"][0], "attachmentdata" not in exclude)
+            return _ok(bug_xml, "text/xml")
+        if method == "GET" and path == "/attachment.cgi":
+            attachment = self.factory.attachment(query["id"][0])
+            if attachment is None:
+                return _json({"error": True, "message": "Invalid attachment"}, 404)
+            return _ok(attachment["data"], attachment["type"])
+        if method == "GET" and path == "/rest/bug":
+            if "id" in query:
+                return _json({"bugs": [self.factory.rest_bug(bug_id)
+                                       for bug_id in query["id"][0].split(",")]})
+            return _json({"bugs": [{"id": bug_id, "status": self.factory.bug(bug_id)["status"]}
+                                   for bug_id in self.bug_ids]})
+        if method == "GET" and path == "/rest/user":
+            return _json({"users": [{"name": name, "real_name": self.factory.real_name(name)}
+                                    for name in query.get("names", [])]})
+        match = re.match(r"^/rest/bug/attachment/([0-9]+)$", path)
+        if method == "GET" and match:
+            attachment = self.factory.attachment(match.group(1))
+            return _json(
+                {"attachments": {match.group(1): self.factory.rest_attachment(attachment)}})
+        match = re.match(r"^/rest/bug/([0-9]+)(/comment|/attachment|/history)?$", path)
+        if match:
+            bug_ids = [match.group(1)] + query.get("ids", [])
+            if method == "PUT":
+                return _json({"bugs": [{"id": int(match.group(1)), "changes": {}}]})
+            if match.group(2) == "/comment":
+                return _json({"bugs": {bug_id: {"comments": self.factory.rest_comments(bug_id)}
+                                       for bug_id in bug_ids}})
+            if match.group(2) == "/attachment":
+                data = "data" not in query.get("exclude_fields", [""])[0].split(",")
+                return _json({"bugs": {
+                    bug_id: [self.factory.rest_attachment(a, data)
+                             for a in self.factory.bug(bug_id)["attachments"]]
+                    for bug_id in bug_ids}})
+            if match.group(2) == "/history":
+                bug = self.factory.bug(match.group(1))
+                history = [{"who": bug["assignee"], "changes": []}]
+                return _json({"bugs": [{"id": bug["id"], "history": history}]})
+        return _json({"error": True, "message": "Not found"}, 404)
+
+
+class GitLabStandIn(StandIn):
+    name = "GitLab"
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.user_ids = {}
+        self.admins = set()
+        self.ids = itertools.count(1000)
+        self.issues = Counter()
+        self.notes = 0
+        self.uploads = 0
+
+    def user_id(self, username):
+        with self.lock:
+            if username not in self.user_ids:
+                self.user_ids[username] = len(self.user_ids) + 2
+            return self.user_ids[username]
+
+    def handle(self, method, path, query, headers, body):
+        if not path.startswith("/api/"):
+            return _json({"message": "404 Not Found"}, 404)
+        path = path[len("/api"):]
+        if method == "POST" and path == "/graphql":
+            variables = json.loads(body)["variables"]
+            with self.lock:
+                self.notes += len(variables)
+                data = {
+                    alias: {"note": {"id": "gid://gitlab/Note/{}".format(next(self.ids))},
+                            "errors": []}
+                    for alias in variables}
+            return _json({"data": data})
+        path = path[len("/v4"):]
+        if method == "GET" and path == "/users":
+            if "username" in query:
+                username = query["username"][0]
+                return _json([{"id": self.user_id(username), "username": username}])
+            return _json([])
+        match = re.match(r"^/users/([0-9]+)$", path)
+        if match:
+            user_id = int(match.group(1))
+            if method == "PUT":
+                with self.lock:
+                    if query.get("admin") == ["True"]:
+                        self.admins.add(user_id)
+                    else:
+                        self.admins.discard(user_id)
+            return _json({"id": user_id, "is_admin": user_id == 1 or user_id in self.admins})
+        match = re.match(r"^/projects/([^/]+)(/.*)?$", path)
+        if not match:
+            return _json({"message": "404 Not Found"}, 404)
+        project, rest = match.group(1), match.group(2) or ""
+        if rest == "":
+            return _json({"id": int(project) if project.isdigit() else 5,
+                          "path_with_namespace": project})
+        if rest == "/milestones":
+            if method == "POST":
+                title = parse_qs(body.decode()).get("title", [""])[0]
+                return _json({"id": next(self.ids), "title": title}, 201)
+            return _json([])
+        if rest == "/uploads" and method == "POST":
+            filename = re.search(rb'filename="([^"]*)"', body).group(1).decode()
+            with self.lock:
+                self.uploads += 1
+            markdown = "[{0}](/uploads/{1:032x}/{0})".format(filename, next(self.ids))
+            return _json({"markdown": markdown}, 201)
+        if rest == "/issues":
+            if method == "POST":
+                with self.lock:
+                    self.issues[project] += 1
+                    iid = self.issues[project]
+                return _json({"iid": iid, "id": next(self.ids)}, 201)
+            return _json([])
+        match = re.match(r"^/issues/([0-9]+)(/notes)?$", rest)
+        if match and match.group(2) and method == "POST":
+            with self.lock:
+                self.notes += 1
+            return _json({"id": next(self.ids)}, 201)
+        if match:
+            return _json({"iid": int(match.group(1)), "id": next(self.ids)})
+        return _json({"message": "404 Not Found"}, 404)
+
+
+def _ok(content, content_type):
+    return 200, {"Content-Type": content_type}, content
+
+
+def _json(value, status=200):
+    return status, {"Content-Type": "application/json"}, json.dumps(value).encode()
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # send headers and body in one packet, without waiting for delayed ACKs
+    disable_nagle_algorithm = True
+    wbufsize = -1
+    standin = None
+
+    def log_message(self, *args):
+        pass
+
+    def handle_request(self, method):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        headers = {k.lower(): v for k, v in self.headers.items()}
+        status, response_headers, content = self.standin.respond(method, self.path, headers, body)
+        self.send_response(status)
+        for name, value in response_headers.items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def do_PUT(self):
+        self.handle_request("PUT")
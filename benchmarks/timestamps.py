@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+
+"""
+Compare the Bugzilla timestamp conversion with the previous dateutil based functions.
+
+    python benchmarks/timestamps.py --timestamps 20000
+"""
+
+import argparse
+import os
+import random
+import sys
+import timeit
+
+import dateutil.parser
+import pytz
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from bugzilla2gitlab import utils  # noqa: E402
+
+FORMAT = "%b %d, %Y %H:%M"
+
+
+def old_format_datetime(datestr, formatting):
+    return dateutil.parser.parse(datestr).strftime(formatting)
+
+
+def old_format_utc(datestr):
+    return dateutil.parser.parse(datestr).astimezone(pytz.utc).strftime("%Y-%m-%dT%H:%M:%SZ")
+
+
+def make_timestamps(count):
+    rng = random.Random(1)
+    return [
+        "{}-{:02d}-{:02d} {:02d}:{:02d}:{:02d} {}".format(
+            rng.randint(2000, 2022), rng.randint(1, 12), rng.randint(1, 28), rng.randint(0, 23),
+            rng.randint(0, 59), rng.randint(0, 59),
+            rng.choice(["-0400", "-0500", "+0000", "+0200"]))
+        for _ in range(count)
+    ]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--timestamps", type=int, default=20000)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    timestamps = make_timestamps(args.timestamps)
+
+    def before():
+        # what Comment.load_fields did for every comment: parse twice
+        for t in timestamps:
+            old_format_utc(t)
+            old_format_datetime(t, FORMAT)
+
+    def after():
+        for t in timestamps:
+            utils.format_timestamps(t, FORMAT)
+
+    for t in timestamps:
+        expected = (old_format_utc(t), old_format_datetime(t, FORMAT))
+        assert utils.format_timestamps(t, FORMAT) == expected
+
+    old = min(timeit.repeat(before, number=1, repeat=args.repeat))
+    new = min(timeit.repeat(after, number=1, repeat=args.repeat))
+    print("{} comments, UTC + formatted timestamp per comment".format(args.timestamps))
+    print("dateutil, parsed twice:      {:8.1f} ms".format(old * 1000))
+    print("fast path, parsed once:      {:8.1f} ms".format(new * 1000))
+    print("speed-up:                    {:8.1f}x".format(old / new))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,293 @@
+"""
+Cache of GET responses, below `_perform_request`.
+
+The same lookups are repeated throughout a run and across runs, e.g. `/users/:id` for
+every temporary admin permission and `/users?username=` for every user. Responses of the
+endpoints that have a time to live (see DEFAULT_TTLS) are kept in memory (least recently
+used first out) and optionally in an SQLite file. Expired responses with an ETag or a
+Last-Modified header are revalidated with If-None-Match/If-Modified-Since instead of
+being fetched again. Empty lists are not cached: a user that is looked up before it is
+created would stay missing. Requests that change a resource (POST, PUT, DELETE) invalidate
+the cached responses of the resource, of everything below it and of its parents, which are
+found through an index of the cached paths.
+"""
+
+from collections import Counter, defaultdict, OrderedDict
+import hashlib
+import json
+import re
+import sqlite3
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.structures import CaseInsensitiveDict
+
+# Seconds a response stays fresh, by regular expression on the URL path. Responses of
+# other endpoints are not cached. With 0, responses are kept but always revalidated.
+DEFAULT_TTLS = {
+    r"/users/[0-9]+$": 300,
+    r"/users$": 3600,
+}
+
+# Request headers that change the response
+VARY_HEADERS = ["private-token", "sudo", "authorization"]
+
+MEMORY_HIT = "memory_hits"
+DISK_HIT = "disk_hits"
+REVALIDATED = "revalidated"
+MISS = "misses"
+INVALIDATED = "invalidated"
+
+
+class CachedResponse:
+    """
+    A response as stored in the cache.
+    """
+
+    def __init__(self, url, status_code, headers, content, stored_at):
+        self.url = url
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.stored_at = stored_at
+
+    def validators(self):
+        """
+        Headers for a conditional request, if the response can be revalidated.
+        """
+        headers = {}
+        if self.headers.get("ETag"):
+            headers["If-None-Match"] = self.headers["ETag"]
+        if self.headers.get("Last-Modified"):
+            headers["If-Modified-Since"] = self.headers["Last-Modified"]
+        return headers
+
+    def response(self):
+        """
+        A requests.Response, for .json(), .links and .content.
+        """
+        response = requests.Response()
+        response.url = self.url
+        response.status_code = self.status_code
+        response.headers = CaseInsensitiveDict(self.headers)
+        response._content = self.content
+        response.encoding = requests.utils.get_encoding_from_headers(response.headers)
+        return response
+
+
+class ResponseCache:
+    """
+    In-memory LRU cache of GET responses, backed by an optional SQLite file.
+    """
+
+    def __init__(self, size=1000, path=None, ttls=None):
+        self.size = size
+        self.ttls = [
+            (re.compile(pattern), ttl)
+            for pattern, ttl in (ttls or DEFAULT_TTLS).items()
+        ]
+        self.memory = OrderedDict()
+        # cached path: keys of its responses in memory, and path: cached paths below it
+        self.paths = {}
+        self.below = defaultdict(set)
+        self.stats = Counter()
+        self.lock = threading.Lock()
+        self.conn = None
+        if path:
+            self.conn = sqlite3.connect(
+                path, check_same_thread=False, isolation_level=None
+            )
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, url TEXT NOT NULL, path TEXT NOT NULL, "
+                "status INTEGER NOT NULL, headers TEXT NOT NULL, content BLOB NOT NULL, "
+                "stored_at REAL NOT NULL)"
+            )
+            self.conn.execute(
+                "CREATE INDEX IF NOT EXISTS responses_path ON responses (path)"
+            )
+            for (path,) in self.conn.execute("SELECT DISTINCT path FROM responses"):
+                self._index(path)
+
+    def ttl(self, url):
+        """
+        The time to live of the responses of a URL, None if they are not cached.
+        """
+        path = urlsplit(url).path
+        for pattern, ttl in self.ttls:
+            if pattern.search(path):
+                return ttl
+        return None
+
+    def key(self, url, params, headers):
+        headers = {k.lower(): str(v) for k, v in headers.items()}
+        vary = [(name, headers.get(name)) for name in VARY_HEADERS]
+        data = json.dumps(
+            [url, sorted((str(k), str(v)) for k, v in params.items()), vary]
+        )
+        return hashlib.sha256(data.encode()).hexdigest()
+
+    def get(self, key, ttl):
+        """
+        Look up a response, returns it and whether it is still fresh.
+        """
+        with self.lock:
+            cached = self.memory.get(key)
+            if cached is not None:
+                self.memory.move_to_end(key)
+                source = MEMORY_HIT
+            elif self.conn is not None:
+                row = self.conn.execute(
+                    "SELECT url, status, headers, content, stored_at FROM responses WHERE key = ?",
+                    (key,),
+                ).fetchone()
+                if row is not None:
+                    cached = CachedResponse(
+                        row[0], row[1], json.loads(row[2]), row[3], row[4]
+                    )
+                    self._remember(key, cached)
+                    source = DISK_HIT
+            if cached is None:
+                return None, False
+            fresh = time.time() - cached.stored_at < ttl
+            if fresh:
+                self.stats[source] += 1
+        return cached, fresh
+
+    def put(self, key, url, response):
+        if response.content.strip() == b"[]":
+            with self.lock:
+                self.stats[MISS] += 1
+            return None
+        cached = CachedResponse(
+            response.url or url,
+            response.status_code,
+            dict(response.headers),
+            response.content,
+            time.time(),
+        )
+        with self.lock:
+            self.stats[MISS] += 1
+            self._remember(key, cached)
+            self._store(key, cached)
+        return cached
+
+    def revalidated(self, key, cached):
+        """
+        The server confirmed that a cached response is still valid (304 Not Modified).
+        """
+        cached.stored_at = time.time()
+        with self.lock:
+            self.stats[REVALIDATED] += 1
+            self._remember(key, cached)
+            self._store(key, cached)
+
+    def invalidate(self, url):
+        """
+        Forget the responses of a resource that was changed, of everything below it and
+        of its parents (e.g. the lists that contain it).
+        """
+        path = _path(url)
+        with self.lock:
+            related = set(self.below.get(path, ()))
+            related.update(p for p in [path] + _parents(path) if p in self.paths)
+            if not related:
+                return
+            removed = 0
+            for cached_path in related:
+                for key in self._unindex(cached_path):
+                    if self.memory.pop(key, None) is not None:
+                        removed += 1
+            if self.conn is not None:
+                # responses in memory are on disk as well
+                cur = self.conn.executemany(
+                    "DELETE FROM responses WHERE path = ?",
+                    [(cached_path,) for cached_path in related],
+                )
+                removed = max(cur.rowcount, removed)
+            self.stats[INVALIDATED] += removed
+
+    def _index(self, path, key=None):
+        if path not in self.paths:
+            self.paths[path] = set()
+            for parent in _parents(path):
+                self.below[parent].add(path)
+        if key is not None:
+            self.paths[path].add(key)
+
+    def _unindex(self, path):
+        """
+        Remove a path from the index, returns the keys of its responses in memory.
+        """
+        for parent in _parents(path):
+            self.below[parent].discard(path)
+            if not self.below[parent]:
+                del self.below[parent]
+        return self.paths.pop(path)
+
+    def _remember(self, key, cached):
+        self.memory[key] = cached
+        self.memory.move_to_end(key)
+        self._index(_path(cached.url), key)
+        while len(self.memory) > self.size:
+            key, cached = self.memory.popitem(last=False)
+            path = _path(cached.url)
+            self.paths[path].discard(key)
+            if not self.paths[path] and self.conn is None:
+                self._unindex(path)
+
+    def _store(self, key, cached):
+        if self.conn is None:
+            return
+        self.conn.execute(
+            "INSERT OR REPLACE INTO responses "
+            "(key, url, path, status, headers, content, stored_at) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (
+                key,
+                cached.url,
+                _path(cached.url),
+                cached.status_code,
+                json.dumps(cached.headers),
+                cached.content,
+                cached.stored_at,
+            ),
+        )
+
+    def hit_rate(self):
+        lookups = sum(
+            self.stats[name] for name in [MEMORY_HIT, DISK_HIT, REVALIDATED, MISS]
+        )
+        if not lookups:
+            return 0.0
+        return (lookups - self.stats[MISS]) / float(lookups)
+
+    def summary(self):
+        return (
+            "HTTP cache: {:.0%} hit rate ({} memory hits, {} disk hits, {} revalidated, "
+            "{} misses, {} invalidated)"
+        ).format(
+            self.hit_rate(),
+            self.stats[MEMORY_HIT],
+            self.stats[DISK_HIT],
+            self.stats[REVALIDATED],
+            self.stats[MISS],
+            self.stats[INVALIDATED],
+        )
+
+
+def _path(url):
+    parts = urlsplit(url)
+    return "{}://{}{}".format(parts.scheme, parts.netloc, parts.path.rstrip("/"))
+
+
+def _parents(path):
+    """
+    The paths above a path, e.g. https://gitlab/api/v4/users for .../users/12.
+    """
+    parts = urlsplit(path)
+    base = "{}://{}".format(parts.scheme, parts.netloc)
+    segments = parts.path.split("/")
+    return [base + "/".join(segments[:i]) for i in range(len(segments) - 1, 0, -1)]
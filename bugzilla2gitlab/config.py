@@ -3,7 +3,9 @@ import os
 
 import yaml
 
-from .utils import _perform_request, get_gitlab_project_id
+from .cache import ResponseCache
+from .tokens import TokenPool
+from .utils import configure_http, get_gitlab_project_id, paginate, set_cache, set_token_pool
 
 Config = namedtuple(
     "Config",
@@ -58,11 +60,95 @@ Config = namedtuple(
         "close_bugzilla_bugs",
         "see_also_gerrit_link_base_url",
         "see_also_git_link_base_url",
-        "test_mode"
-        
+        "description_template",
+        "comment_template",
+        "test_mode",
+        "project_routes",
+        "bugzilla_source",
+        "bugzilla_batch_size",
+        "bugzilla_time_zone",
+        "bugzilla_database",
+        "bugzilla_attachments_on_demand",
+        "coordination_store",
+        "worker_id",
+        "lease_duration",
+        "lease_batch_size",
+        "journal_store",
+        "note_concurrency",
+        "note_retries",
+        "note_backend",
+        "graphql_note_batch_size",
+        "attachment_concurrency",
+        "http_pool_maxsize",
+        "http_connect_timeout",
+        "http_read_timeout",
+        "http_endpoint_timeouts",
+        "http_hedge_percentile",
+        "http_hedge_endpoints",
+        "bug_time_budget",
+        "gitlab_token_rate",
+        "gitlab_blocking_links",
+        "http_keepalive_timeout",
+        "http_compression",
+        "http_cache",
+        "http_cache_file",
+        "http_cache_size",
+        "http_cache_ttls",
+        "dead_letter_file",
+        "deferred_retries",
+        "retry_backoff",
+        "bug_concurrency",
+        "heavy_bug_concurrency",
+        "heavy_comment_count",
+        "heavy_attachment_bytes",
+        "heavy_upload_bandwidth",
     ],
 )
 
+# Options that may be missing from older defaults.yml files
+OPTIONAL_DEFAULTS = {
+    "description_template": None,
+    "comment_template": None,
+    "bugzilla_source": "xml",
+    "bugzilla_batch_size": 50,
+    "bugzilla_time_zone": None,
+    "bugzilla_database": None,
+    "bugzilla_attachments_on_demand": True,
+    "coordination_store": None,
+    "worker_id": None,
+    "lease_duration": 300,
+    "lease_batch_size": 10,
+    "journal_store": None,
+    "note_concurrency": 1,
+    "note_retries": 2,
+    "note_backend": "rest",
+    "graphql_note_batch_size": 20,
+    "attachment_concurrency": 4,
+    "http_pool_maxsize": None,
+    "http_connect_timeout": 10,
+    "http_read_timeout": 300,
+    "http_endpoint_timeouts": None,
+    "http_hedge_percentile": None,
+    "http_hedge_endpoints": None,
+    "bug_time_budget": None,
+    "gitlab_token_rate": None,
+    "gitlab_blocking_links": False,
+    "http_keepalive_timeout": 4,
+    "http_compression": True,
+    "http_cache": False,
+    "http_cache_file": None,
+    "http_cache_size": 1000,
+    "http_cache_ttls": None,
+    "dead_letter_file": None,
+    "deferred_retries": 3,
+    "retry_backoff": 60,
+    "bug_concurrency": 1,
+    "heavy_bug_concurrency": 1,
+    "heavy_comment_count": 200,
+    "heavy_attachment_bytes": 20000000,
+    "heavy_upload_bandwidth": None,
+}
+
 
 def get_config(path):
     configuration = {}
@@ -85,12 +171,13 @@ def get_config(path):
             )
         )
     configuration.update(_load_component_mappings(path))
-    
+
     temp = {}
     temp["config_path"] = path
     configuration.update(temp)
 
     configuration.update(_load_unassign_list(path))
+    configuration.update(_load_project_routes(path))
 
     return Config(**configuration)
 
@@ -99,13 +186,14 @@ def _load_defaults(path):
     with open(os.path.join(path, "defaults.yml")) as f:
         config = yaml.safe_load(f)
 
-    defaults = {}
+    defaults = dict(OPTIONAL_DEFAULTS)
+    _configure_http(dict(OPTIONAL_DEFAULTS, **config))
 
     #TODO: clean up
     defaults["default_headers"] = {"private-token": config["gitlab_private_token"]}
 
     for key in config:
-        if key == "gitlab_private_token":
+        if key in ("gitlab_private_token", "gitlab_private_tokens"):
             continue
         if key == "gitlab_project_id":
             if config[key] is None:
@@ -124,15 +212,55 @@ def _load_defaults(path):
         else:
             defaults[key] = config[key]
 
+    if defaults["note_backend"] not in ("rest", "graphql"):
+        raise Exception("Unknown note_backend: {}".format(defaults["note_backend"]))
+    if defaults["note_backend"] == "graphql" and not defaults["show_datetime_in_comments"]:
+        # createNote cannot set created_at, the dates of the comments would be lost
+        raise Exception("note_backend 'graphql' requires show_datetime_in_comments")
+
     return defaults
 
 
+def _configure_http(config):
+    """
+    Set up the HTTP session. Unless configured, the connection pool of every host is
+    sized for the number of concurrent requests of all bugs migrated at once.
+    """
+    pool_maxsize = config["http_pool_maxsize"]
+    if not pool_maxsize:
+        bugs = config["bug_concurrency"]
+        if bugs > 1:
+            bugs += config["heavy_bug_concurrency"]
+        concurrency = max(config["note_concurrency"], config["attachment_concurrency"])
+        pool_maxsize = max(10, bugs * concurrency)
+    configure_http(
+        pool_maxsize=pool_maxsize,
+        connect_timeout=config["http_connect_timeout"],
+        read_timeout=config["http_read_timeout"],
+        keepalive_timeout=config["http_keepalive_timeout"],
+        compression=config["http_compression"],
+        endpoint_timeouts=config["http_endpoint_timeouts"],
+        hedge_percentile=config["http_hedge_percentile"],
+        hedge_endpoints=config["http_hedge_endpoints"],
+    )
+    cache = None
+    if config["http_cache"]:
+        cache = ResponseCache(size=config["http_cache_size"], path=config["http_cache_file"],
+                              ttls=config["http_cache_ttls"])
+    set_cache(cache)
+    pool = None
+    if config.get("gitlab_private_tokens") or config["gitlab_token_rate"]:
+        tokens = [config["gitlab_private_token"]] + (config.get("gitlab_private_tokens") or [])
+        pool = TokenPool(tokens, rate=config["gitlab_token_rate"])
+    set_token_pool(pool)
+
+
 def _load_user_id_cache(path, gitlab_url, gitlab_headers, verify):
     """
     Load cache of GitLab usernames and ids
     """
     print("Loading user cache...")
-    user_mappings_file = os.path.join(path, "user_mappings.yml") 
+    user_mappings_file = os.path.join(path, "user_mappings.yml")
 
     # Create new file if it does not exist yet
     if not os.path.exists(user_mappings_file):
@@ -142,11 +270,18 @@ def _load_user_id_cache(path, gitlab_url, gitlab_headers, verify):
     with open(user_mappings_file) as f:
         bugzilla_mapping = yaml.safe_load(f)
 
+    # ids written by bin/provision_users
+    user_ids = _load_user_ids(path)
+
     gitlab_users = {}
     if bugzilla_mapping is not None:
         for user in bugzilla_mapping:
             gitlab_username = bugzilla_mapping[user]
-            uid = _get_user_id(gitlab_username, gitlab_url, gitlab_headers, verify=verify)
+            if gitlab_username in gitlab_users:
+                continue
+            uid = user_ids.get(gitlab_username)
+            if uid is None:
+                uid = _get_user_id(gitlab_username, gitlab_url, gitlab_headers, verify=verify)
             gitlab_users[gitlab_username] = str(uid)
     else:
         bugzilla_mapping = {}
@@ -160,8 +295,31 @@ def _load_user_id_cache(path, gitlab_url, gitlab_headers, verify):
 
     return mappings
 
+
+def _load_user_ids(path):
+    """
+    Load the GitLab user ids cached in user_ids.yml (gitlab_username: gitlab_userid).
+    """
+    user_ids_file = os.path.join(path, "user_ids.yml")
+    if not os.path.exists(user_ids_file):
+        return {}
+    with open(user_ids_file) as f:
+        return yaml.safe_load(f) or {}
+
+
+def save_user_ids(path, user_ids):
+    """
+    Add GitLab user ids to the cache in user_ids.yml.
+    """
+    cached = _load_user_ids(path)
+    cached.update(user_ids)
+    with open(os.path.join(path, "user_ids.yml"), "w") as f:
+        f.write("---\n")
+        yaml.safe_dump(cached, f, default_flow_style=False)
+
+
 def _load_unassign_list(path):
-    file = os.path.join(path, "unassign_users") 
+    file = os.path.join(path, "unassign_users")
     lines = []
     if os.path.exists(file):
         print("Loading unassign list...")
@@ -175,6 +333,23 @@ def _load_unassign_list(path):
     temp["unassign_list"] = lines
     return temp
 
+
+def _load_project_routes(path):
+    """
+    Load the rules that route bugs to GitLab projects, see routing.py
+    """
+    routes_file = os.path.join(path, "project_routes.yml")
+    routes = []
+    if os.path.exists(routes_file):
+        print("Loading project routes...")
+        with open(routes_file) as f:
+            routes = yaml.safe_load(f) or []
+        for route in routes:
+            if "project" not in route:
+                raise Exception("Missing 'project' in project route {}".format(route))
+    return {"project_routes": routes}
+
+
 def _load_milestone_id_cache(project_id, gitlab_url, gitlab_headers, verify):
     """
     Load cache of GitLab milestones and ids
@@ -183,19 +358,17 @@ def _load_milestone_id_cache(project_id, gitlab_url, gitlab_headers, verify):
 
     gitlab_milestones = {}
     url = "{}/projects/{}/milestones".format(gitlab_url, project_id)
-    result = _perform_request(url, "get", headers=gitlab_headers, verify=verify)
-    if result and isinstance(result, list):
-        for milestone in result:
-            gitlab_milestones[milestone["title"]] = milestone["id"]
+    for milestone in paginate(url, headers=gitlab_headers, verify=verify, prefetch=1):
+        gitlab_milestones[milestone["title"]] = milestone["id"]
 
     return {"gitlab_milestones": gitlab_milestones}
 
 
 def _get_user_id(username, gitlab_url, headers, verify):
-    url = "{}/users?username={}".format(gitlab_url, username)
-    result = _perform_request(url, "get", headers=headers, verify=verify)
-    if result and isinstance(result, list):
-        return result[0]["id"]
+    url = "{}/users".format(gitlab_url)
+    user = next(paginate(url, params={"username": username}, headers=headers, verify=verify), None)
+    if user is not None:
+        return user["id"]
     raise Exception("No gitlab account found for user {}".format(username))
 
 
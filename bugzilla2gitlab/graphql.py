@@ -0,0 +1,100 @@
+"""
+Notes through the GitLab GraphQL API: several `createNote` mutations, one alias per
+note, in a single request.
+
+GitLab runs the mutations of a request one after another, in the order of the aliases,
+so the notes keep their order. A mutation that fails does not stop the others; its error
+is mapped back to its note.
+"""
+
+import json
+
+from .utils import _perform_request
+
+
+class GraphQLError(Exception):
+    """
+    A note that GitLab refused to create.
+    """
+
+
+def graphql_url(base_url):
+    """
+    The GraphQL endpoint of a GitLab instance, e.g. https://gitlab.com/api/v4 ->
+    https://gitlab.com/api/graphql
+    """
+    base_url = base_url.rstrip("/")
+    if base_url.endswith("/api/v4"):
+        base_url = base_url[: -len("/api/v4")]
+    return base_url + "/api/graphql"
+
+
+def issue_gid(issue_id):
+    """
+    The global id of an issue, from its database id (not its iid).
+    """
+    return "gid://gitlab/Issue/{}".format(issue_id)
+
+
+def create_notes_query(count):
+    variables = ", ".join("$n{}: CreateNoteInput!".format(i) for i in range(count))
+    mutations = " ".join(
+        "n{0}: createNote(input: $n{0}) {{ note {{ id }} errors }}".format(i)
+        for i in range(count)
+    )
+    return "mutation CreateNotes({}) {{ {} }}".format(variables, mutations)
+
+
+def create_notes(url, noteable_id, bodies, headers, verify=True, dry_run=False):
+    """
+    Create a note with each of the given bodies in one request.
+    Returns one error per body, None for the notes that were created.
+    """
+    payload = {
+        "query": create_notes_query(len(bodies)),
+        "variables": {
+            "n{}".format(i): {"noteableId": noteable_id, "body": body}
+            for i, body in enumerate(bodies)
+        },
+    }
+    headers = dict(headers)
+    headers["Content-Type"] = "application/json"
+    response = _perform_request(
+        url,
+        "post",
+        data=json.dumps(payload),
+        headers=headers,
+        json=True,
+        dry_run=dry_run,
+        verify=verify,
+    )
+    if dry_run:
+        return [None] * len(bodies)
+    return note_errors(response, len(bodies))
+
+
+def note_errors(response, count):
+    """
+    Map the result of a `create_notes` request to its notes.
+    """
+    data = response.get("data") or {}
+    errors = [None] * count
+    for error in response.get("errors", []):
+        path = error.get("path") or []
+        if path and path[0].startswith("n") and path[0][1:].isdigit():
+            errors[int(path[0][1:])] = GraphQLError(error["message"])
+        else:
+            # e.g. an invalid query or missing permissions: no note was created
+            return [GraphQLError(error["message"])] * count
+
+    for i in range(count):
+        result = data.get("n{}".format(i))
+        if errors[i] is not None:
+            continue
+        if not result:
+            errors[i] = GraphQLError("No result for note {}".format(i))
+        elif result.get("errors"):
+            errors[i] = GraphQLError("; ".join(result["errors"]))
+        elif not result.get("note"):
+            errors[i] = GraphQLError("Note {} was not created".format(i))
+    return errors
@@ -0,0 +1,77 @@
+"""
+Journal of migrated bugs.
+
+The journal remembers which GitLab issue every migrated bug turned into, together with
+the comments, attachments, state and labels that were migrated. It is used to sync
+bugs that changed in Bugzilla after they were migrated.
+"""
+
+import json
+import threading
+
+from .coordination import connect
+
+
+class Journal:
+    """
+    Store of migrated bugs, backed by SQLite or PostgreSQL.
+    """
+
+    def __init__(self, url):
+        self.conn, self.dialect = connect(url)
+        self.lock = threading.Lock()
+        self._execute(
+            "CREATE TABLE IF NOT EXISTS bugs ("
+            "bug_id INTEGER PRIMARY KEY, issue_iid INTEGER, data TEXT NOT NULL)"
+        )
+        self._execute(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)"
+        )
+
+    def _execute(self, sql, params=()):
+        if self.dialect == "postgresql":
+            sql = sql.replace("?", "%s")
+        with self.lock:
+            cur = self.conn.cursor()
+            cur.execute(sql, params)
+            return cur.fetchall() if cur.description else None
+
+    def record(self, bug_id, issue_iid, entry):
+        self._execute(
+            "INSERT INTO bugs (bug_id, issue_iid, data) VALUES (?, ?, ?) "
+            "ON CONFLICT (bug_id) DO UPDATE SET issue_iid = excluded.issue_iid, "
+            "data = excluded.data",
+            (int(bug_id), issue_iid, json.dumps(entry)),
+        )
+
+    def get(self, bug_id):
+        rows = self._execute(
+            "SELECT issue_iid, data FROM bugs WHERE bug_id = ?", (int(bug_id),)
+        )
+        if not rows:
+            return None
+        entry = json.loads(rows[0][1])
+        entry["issue_iid"] = rows[0][0]
+        return entry
+
+    def entries(self):
+        """
+        Iterate over (bug_id, entry) of all migrated bugs in bug order.
+        """
+        for bug_id, issue_iid, data in self._execute(
+            "SELECT bug_id, issue_iid, data FROM bugs ORDER BY bug_id"
+        ):
+            entry = json.loads(data)
+            entry["issue_iid"] = issue_iid
+            yield bug_id, entry
+
+    def get_meta(self, key):
+        rows = self._execute("SELECT value FROM meta WHERE key = ?", (key,))
+        return rows[0][0] if rows else None
+
+    def set_meta(self, key, value):
+        self._execute(
+            "INSERT INTO meta (key, value) VALUES (?, ?) "
+            "ON CONFLICT (key) DO UPDATE SET value = excluded.value",
+            (key, value),
+        )
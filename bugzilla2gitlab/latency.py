@@ -0,0 +1,207 @@
+"""
+Deadlines, hedged reads and latency statistics, below `_perform_request`.
+
+Every request gets a connect and a read timeout, by endpoint (see `configure_http`), and
+is not sent once the time budget of the bug it belongs to ran out (see `deadline`).
+Reads never wait past it; writes are not cut short, they may be saved anyway. GETs to
+slow endpoints can be hedged: when the first request takes longer than a percentile of
+the recent latencies of its endpoint, an identical second request is sent and the
+first answer wins.
+"""
+
+from collections import Counter, deque
+from concurrent.futures import FIRST_COMPLETED, TimeoutError, wait
+import contextlib
+import re
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+
+# Reads hedged when hedging is enabled, by regular expression on the URL path
+DEFAULT_HEDGE_ENDPOINTS = [r"/show_bug\.cgi$", r"/rest(\.cgi)?/"]
+
+# Latencies kept per endpoint, and the number of them needed before hedging
+WINDOW = 1000
+MIN_SAMPLES = 20
+
+_DEADLINE = threading.local()
+
+
+class DeadlineExceeded(requests.exceptions.Timeout):
+    """
+    The time budget of a bug ran out.
+    """
+
+
+def get_deadline():
+    return getattr(_DEADLINE, "at", None)
+
+
+def set_deadline(at):
+    _DEADLINE.at = at
+
+
+@contextlib.contextmanager
+def deadline(seconds):
+    """
+    Limit the requests made in this block (and in threads that copy the deadline, see
+    `bind_config`) to the given number of seconds in total. Nested deadlines can only
+    shorten the time left.
+    """
+    previous = get_deadline()
+    at = previous
+    if seconds:
+        at = time.monotonic() + seconds
+        if previous is not None:
+            at = min(at, previous)
+    set_deadline(at)
+    try:
+        yield
+    finally:
+        set_deadline(previous)
+
+
+def remaining():
+    """
+    Seconds left until the deadline of this thread, None without a deadline.
+    """
+    at = get_deadline()
+    if at is None:
+        return None
+    left = at - time.monotonic()
+    if left <= 0:
+        raise DeadlineExceeded("Time budget of the bug exceeded")
+    return left
+
+
+def endpoint(url):
+    """
+    The endpoint of a URL for the statistics, e.g. https://gitlab.com/api/v4/users/:id
+    """
+    parts = urlsplit(url)
+    path = re.sub(r"/[0-9]+(?=/|$)", "/:id", parts.path.rstrip("/"))
+    return "{}://{}{}".format(parts.scheme, parts.netloc, path)
+
+
+def hedged(send, delay, executor):
+    """
+    Call `send` and, if it has not returned after `delay` seconds, call it a second time.
+    Returns the first result and None if there was no second call, else whether the
+    result came from it. The other response is closed when it arrives.
+    """
+    first = executor.submit(send)
+    try:
+        return first.result(timeout=delay), None
+    except TimeoutError:
+        pass
+    second = executor.submit(send)
+    pending = {first, second}
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in sorted(done, key=lambda future: future is second):
+            if future.exception() is None:
+                for other in pending:
+                    other.add_done_callback(_close)
+                return future.result(), future is second
+            error = future.exception()
+    raise error
+
+
+def _close(future):
+    if future.exception() is None:
+        future.result().close()
+
+
+class LatencyStats:
+    """
+    Recent latencies of every endpoint, with the number of timeouts and hedged requests.
+    """
+
+    def __init__(self, window=WINDOW):
+        self.window = window
+        self.latencies = {}
+        self.counts = Counter()
+        self.timeouts = Counter()
+        self.hedges = Counter()
+        self.hedge_wins = Counter()
+        # endpoint -> (number of requests when computed, percentile, seconds)
+        self.thresholds = {}
+        self.lock = threading.Lock()
+
+    def record(self, endpoint, seconds):
+        with self.lock:
+            latencies = self.latencies.get(endpoint)
+            if latencies is None:
+                latencies = self.latencies[endpoint] = deque(maxlen=self.window)
+            latencies.append(seconds)
+            self.counts[endpoint] += 1
+
+    def timeout(self, endpoint):
+        with self.lock:
+            self.timeouts[endpoint] += 1
+
+    def hedge(self, endpoint, won):
+        with self.lock:
+            self.hedges[endpoint] += 1
+            if won:
+                self.hedge_wins[endpoint] += 1
+
+    def percentile(self, endpoint, p):
+        """
+        The p-th percentile of the recent latencies of an endpoint, None while there are
+        too few of them.
+        """
+        with self.lock:
+            latencies = self.latencies.get(endpoint)
+            if not latencies or len(latencies) < MIN_SAMPLES:
+                return None
+            return _percentile(sorted(latencies), p)
+
+    def threshold(self, endpoint, p):
+        """
+        Like `percentile`, recomputed every MIN_SAMPLES requests.
+        """
+        count = self.counts[endpoint]
+        cached = self.thresholds.get(endpoint)
+        if cached is not None and cached[1] == p and count - cached[0] < MIN_SAMPLES:
+            return cached[2]
+        seconds = self.percentile(endpoint, p)
+        self.thresholds[endpoint] = (count, p, seconds)
+        return seconds
+
+    def summary(self):
+        with self.lock:
+            lines = []
+            endpoints = set(self.latencies) | set(self.timeouts)
+            for endpoint in sorted(
+                endpoints, key=lambda endpoint: -self.counts[endpoint]
+            ):
+                latencies = sorted(self.latencies.get(endpoint, []))
+                line = "  {}: {} requests".format(endpoint, self.counts[endpoint])
+                if latencies:
+                    line += (
+                        ", p50 {:.2f}s, p95 {:.2f}s, p99 {:.2f}s, max {:.2f}s".format(
+                            _percentile(latencies, 50),
+                            _percentile(latencies, 95),
+                            _percentile(latencies, 99),
+                            latencies[-1],
+                        )
+                    )
+                if self.timeouts[endpoint]:
+                    line += ", {} timed out".format(self.timeouts[endpoint])
+                if self.hedges[endpoint]:
+                    line += ", {} hedged ({} won by the hedge)".format(
+                        self.hedges[endpoint], self.hedge_wins[endpoint]
+                    )
+                lines.append(line)
+        return "\n".join(
+            ["Request latency (last {} requests per endpoint):".format(self.window)]
+            + lines
+        )
+
+
+def _percentile(latencies, p):
+    return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100.0))]
@@ -1,18 +1,154 @@
+import contextlib
+from datetime import datetime, timedelta
+import json
+import logging
 import os
+import threading
+import time
+
+from . import progress, utils
 from .config import get_config
-from .models import IssueThread
-from .utils import bugzilla_login, get_bugzilla_bug, load_bugzilla_bug, validate_list, fetch_bug_list, save_bug_list
+from .coordination import default_worker_id, LeaseHeartbeat, LeaseStore
+from .journal import Journal
+from .latency import deadline
+from .models import (
+    find_migrated_issue,
+    IssueCreationError,
+    IssueThread,
+    IssueUpdate,
+    PartialMigrationError,
+)
+from .planner import MigrationPlan
+from .relinking import Relinker
+from .routing import ProjectRouter
+from .scheduler import bug_size, BugScheduler, HEAVY, LIGHT
+from .sources import get_source
+from .utils import (
+    bugzilla_login,
+    fetch_bug_list,
+    fetch_bug_sizes,
+    fetch_changed_bug_list,
+    is_transient,
+    load_bugzilla_bug,
+    save_bug_list,
+    validate_list,
+)
+from .verification import Verification
+
+# Bugs changed shortly before the last run started are synced again, to be safe
+# against clock skew between this host and Bugzilla. Syncing a bug twice is harmless.
+SYNC_OVERLAP = timedelta(minutes=10)
+HIGH_WATER_MARK_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+# Error types in the dead-letter file
+TRANSIENT = "transient"
+PERMANENT = "permanent"
+PARTIAL = "partial"
 
 
 class Migrator:
-    def __init__(self, config_path):
+    def __init__(self, config_path, profiler=None, progress=None):
         self.conf = get_config(config_path)
+        self.profiler = profiler
+        self.progress = progress
+        self.router = ProjectRouter(self.conf)
+        self.source = get_source(self.conf)
+        self.dead_letter_lock = threading.Lock()
+        self.journal = None
+        if self.conf.journal_store:
+            self.journal = Journal(self.conf.journal_store)
 
     def migrate(self, bug_list):
         """
         Migrate a list of bug ids from Bugzilla to GitLab.
         """
+        started = datetime.utcnow()
+        bug_list = self.load_bug_list(bug_list)
+        if self.progress:
+            # the number of bugs is not known up front in test mode and in sharded mode
+            total = None
+            if not self.conf.test_mode and not self.conf.coordination_store:
+                total = len([bug for bug in bug_list if bug])
+            self.progress.start(total)
+        try:
+            self.migrate_bugs(bug_list)
+        finally:
+            if self.progress:
+                self.progress.stop()
+            if self.profiler:
+                print(self.profiler.write())
+            if utils.CACHE is not None:
+                print(utils.CACHE.summary())
+                logging.info(utils.CACHE.summary())
+            if utils.TOKEN_POOL is not None:
+                print(utils.TOKEN_POOL.summary())
+                logging.info(utils.TOKEN_POOL.summary())
+            if utils.LATENCY.counts:
+                print(utils.LATENCY.summary())
+                logging.info(utils.LATENCY.summary())
 
+        if self.journal and self.journal.get_meta("high_water_mark") is None:
+            self.journal.set_meta("high_water_mark", started.strftime(HIGH_WATER_MARK_FORMAT))
+
+    def migrate_bugs(self, bug_list):
+        if self.conf.test_mode:
+            print ("### TEST MODE ###")
+            test_dir = os.path.join(self.conf.config_path, "test_xmls")
+            files = [os.path.join(test_dir, file) for file in os.listdir(test_dir)
+                     if file.endswith(".xml")]
+            self.run_bugs(files, self.migrate_one_file,
+                          sizes=lambda files: {file: bug_size(load_bugzilla_bug(file))
+                                               for file in files})
+        elif self.conf.coordination_store:
+            self.migrate_sharded([bug for bug in bug_list if bug])
+        elif self.conf.dead_letter_file:
+            self.migrate_batch([bug for bug in bug_list if bug])
+        else:
+            bug_list = [bug for bug in bug_list if bug]
+            self.source.expect(bug_list)
+            self.run_bugs(bug_list, self.migrate_one)
+
+    def run_bugs(self, items, migrate, key=str, sizes=None):
+        """
+        Call `migrate` for every item (bug id, file or lease), one after another or, with
+        bug_concurrency > 1, on several threads scheduled by the size of the bugs.
+        Returns the results in the order of the items.
+        """
+        if self.conf.bug_concurrency <= 1:
+            return [migrate(item) for item in items]
+        if self.profiler:
+            logging.warning("Profiling migrates one bug at a time.")
+            return [migrate(item) for item in items]
+        scheduler = BugScheduler(self.conf, sizes or self.bug_sizes)
+        results = scheduler.run(items, migrate, key)
+        print("Migrated {} light and {} heavy bug(s)".format(
+            scheduler.lanes[LIGHT], scheduler.lanes[HEAVY]))
+        return results
+
+    def bug_sizes(self, bug_ids):
+        sizes = self.source.get_sizes(bug_ids)
+        if sizes is None:
+            sizes = fetch_bug_sizes(
+                self.conf.bugzilla_base_url, self.conf.bugzilla_api_token, bug_ids)
+        return sizes
+
+    def fetch_bug(self, bugzilla_bug_id):
+        fields = self.source.get_bug(bugzilla_bug_id)
+        progress.count(progress.FETCHED)
+        return fields
+
+    def profile(self, bugzilla_bug_id):
+        """
+        Profile the migration of a bug, if a profiler is set.
+        """
+        if self.profiler:
+            return self.profiler.profile(bugzilla_bug_id)
+        return no_profile()
+
+    def load_bug_list(self, bug_list):
+        """
+        Log in to Bugzilla and fetch the bug list, if configured.
+        """
         if self.conf.bugzilla_user:
             bugzilla_login(
                 self.conf.bugzilla_base_url,
@@ -32,32 +168,363 @@ class Migrator:
             save_bug_list(bug_list, self.conf.buglist_file)
 
         validate_list(bug_list)
+        return bug_list
 
-        if self.conf.test_mode:
-            print ("### TEST MODE ###")
-            test_dir = os.path.join(self.conf.config_path, "test_xmls")
-            for file in os.listdir(test_dir):
+    def plan(self, bug_list, xml_dir=None, rate=30, concurrency=1, latency=0.2, bandwidth=10e6):
+        """
+        Report what migrating a list of bugs involves and estimate how long it takes.
+        Bugs are read from Bugzilla, or from the XML files in xml_dir. Nothing is written.
+        """
+        plan = MigrationPlan(self.conf, fetched=xml_dir is None, route=self.router.route)
+        if xml_dir:
+            for file in sorted(os.listdir(xml_dir)):
                 if file.endswith(".xml"):
-                    self.migrate_one_file(os.path.join(test_dir, file))
+                    plan.add_bug(load_bugzilla_bug(os.path.join(xml_dir, file)))
         else:
+            bug_list = [bug for bug in self.load_bug_list(bug_list) if bug]
+            self.source.expect(bug_list)
             for bug in bug_list:
-                if bug:
+                print("Reading bug {}".format(bug))
+                plan.add_bug(self.source.get_bug(bug))
+
+        print(plan.report(rate, concurrency, latency, bandwidth, plan.load_existing_labels()))
+        return plan
+
+    def verify(self, bug_list, report_file="verify_report.jsonl", concurrency=4,
+               from_journal=False):
+        """
+        Compare the GitLab issues with the bugs of a list, or with all bugs in the journal,
+        and write the differences to report_file. Nothing is written to GitLab.
+        """
+        verification = Verification(self.conf, concurrency)
+        if from_journal:
+            if not self.journal:
+                raise Exception(
+                    "Verifying from the journal requires a journal, please set 'journal_store'.")
+            for bug_id, entry in self.journal.entries():
+                verification.add_entry(bug_id, entry)
+        else:
+            bug_list = [bug for bug in self.load_bug_list(bug_list) if bug]
+            self.source.expect(bug_list)
+            for bug in bug_list:
+                fields = self.source.get_bug(bug)
+                entry = self.journal.get(bug) if self.journal else None
+                if entry is None:
+                    verification.add_bug(self.router.route(fields), fields)
+                else:
+                    verification.add_bug(self.router.target(entry["project_id"]), fields, entry)
+
+        print(verification.run(report_file))
+        return verification
+
+    def relink(self, concurrency=4):
+        """
+        Point the links between migrated bugs at their GitLab issues and link the issues
+        of bugs that depend on each other. Requires the journal of the migration.
+        """
+        if not self.journal:
+            raise Exception("Relinking requires a journal, please set 'journal_store'.")
+        relinker = Relinker(self.conf, self.journal, concurrency)
+        print(relinker.run())
+        return relinker
+
+    def sync(self):
+        """
+        Sync the bugs that changed in Bugzilla since the last run. New comments and
+        attachments are appended to the existing GitLab issues, state and labels are
+        updated. Bugs that are not in the journal yet are migrated.
+        """
+        if not self.journal:
+            raise Exception("Syncing requires a journal, please set 'journal_store'.")
+        high_water_mark = self.journal.get_meta("high_water_mark")
+        if high_water_mark is None:
+            raise Exception(
+                "No previous migration found in the journal {}".format(self.conf.journal_store))
+
+        started = datetime.utcnow()
+        since = datetime.strptime(high_water_mark, HIGH_WATER_MARK_FORMAT) - SYNC_OVERLAP
+
+        if self.conf.bugzilla_user:
+            bugzilla_login(
+                self.conf.bugzilla_base_url,
+                self.conf.bugzilla_user,
+                self.conf.bugzilla_password,
+            )
+
+        changed = fetch_changed_bug_list(self.conf.bugzilla_base_url,
+                                         self.conf.bugzilla_api_token,
+                                         self.conf.bugzilla_product,
+                                         self.conf.bugzilla_components,
+                                         since.strftime("%Y-%m-%dT%H:%M:%SZ"))
+
+        self.source.expect([bug for bug, _ in changed])
+        if self.progress:
+            self.progress.start(len(changed))
+        try:
+            for bug, status in changed:
+                entry = self.journal.get(bug)
+                if entry is not None:
+                    self.sync_one(bug, entry)
+                elif status in self.conf.bugzilla_bug_status:
                     self.migrate_one(bug)
+                else:
+                    progress.count(progress.BUGS)
+        finally:
+            if self.progress:
+                self.progress.stop()
+
+        self.journal.set_meta("high_water_mark", started.strftime(HIGH_WATER_MARK_FORMAT))
+
+    def sync_one(self, bugzilla_bug_id, entry):
+        """
+        Sync a single, already migrated bug from Bugzilla to GitLab.
+        """
+        print("Syncing bug {} to issue {}".format(bugzilla_bug_id, entry["issue_iid"]))
+        with deadline(self.conf.bug_time_budget):
+            fields = self.fetch_bug(bugzilla_bug_id)
+            if fields.get("delta_ts") == entry["delta_ts"]:
+                logging.info("Bug {} is unchanged".format(bugzilla_bug_id))
+                progress.count(progress.BUGS)
+                return
+            # the issue stays in the project it was migrated to
+            conf = self.router.target(entry.get("project_id", self.conf.gitlab_project_id))
+            issue_update = IssueUpdate(conf, fields, entry)
+            issue_update.save()
+        self.record(issue_update)
+        progress.count(progress.BUGS)
+
+    def record(self, issue_thread):
+        """
+        Remember a migrated bug in the journal.
+        """
+        if self.journal and not self.conf.dry_run:
+            self.journal.record(
+                issue_thread.bug_id, issue_thread.issue.id, issue_thread.journal_entry()
+            )
+
+    def migrate_sharded(self, bug_list):
+        """
+        Migrate a list of bugs that is shared with other bugzilla2gitlab processes.
+        Bugs are leased from the coordination store in small batches.
+        """
+        owner = self.conf.worker_id or default_worker_id()
+        store = LeaseStore(self.conf.coordination_store, owner, self.conf.lease_duration)
+        store.seed(bug_list)
+        print("Worker {} joined the migration ({})".format(owner, store.counts()))
+
+        heartbeat = LeaseHeartbeat(store)
+        heartbeat.start()
+        try:
+            while True:
+                leases = store.claim(self.conf.lease_batch_size)
+                if not leases:
+                    # bugs that failed for a transient reason are retried after a pause
+                    retry_at = store.next_retry()
+                    if retry_at is None:
+                        break
+                    time.sleep(max(0, retry_at - time.time()))
+                    continue
+                for lease in leases:
+                    heartbeat.add(lease)
+                self.source.expect([lease.bug_id for lease in leases])
+
+                def migrate(lease):
+                    if self.conf.dead_letter_file:
+                        error = self.migrate_isolated(self.migrate_leased, store, heartbeat, lease)
+                        if error is not None:
+                            self.dead_letter(lease.bug_id, error, 1)
+                    else:
+                        self.migrate_leased(store, heartbeat, lease)
+                    heartbeat.discard(lease)
+
+                self.run_bugs(leases, migrate, key=lambda lease: str(lease.bug_id))
+        finally:
+            heartbeat.stop()
+        print("No bugs left to lease ({})".format(store.counts()))
+
+    def migrate_leased(self, store, heartbeat, lease):
+        """
+        Migrate a single leased bug, making sure that no second issue is created for it.
+        """
+        print("Migrating bug {}".format(lease.bug_id))
+        creating = False
+        try:
+            with deadline(self.conf.bug_time_budget):
+                fields = self.fetch_bug(lease.bug_id)
+                conf = self.router.route(fields)
+                if lease.reconcile:
+                    # a previous worker died or stalled while creating the issue of this bug
+                    issue_iid = None
+                    if conf.use_bugzilla_id or conf.include_bugzilla_link:
+                        issue_iid = find_migrated_issue(conf, lease.bug_id)
+                    # only with use_bugzilla_id is a missing issue certainly missing,
+                    # the search of include_bugzilla_link may lag behind
+                    if issue_iid is not None or not conf.use_bugzilla_id:
+                        store.orphan(
+                            lease, issue_iid, "Issue may have been created by a previous worker")
+                        logging.warning(
+                            "Bug {} may have been partially migrated (issue {}), skipping.".format(
+                                lease.bug_id, issue_iid
+                            )
+                        )
+                        progress.count(progress.FAILED)
+                        progress.count_error(PARTIAL)
+                        return
+
+                issue_thread = IssueThread(conf, fields)
+                creating = True
+                if not store.begin_create(lease) or heartbeat.is_lost(lease):
+                    # another worker migrates the bug
+                    logging.warning("Lost lease on bug {}, skipping.".format(lease.bug_id))
+                    progress.count_error("lost_lease")
+                    return
+                issue_thread.save()
+        except Exception as e:
+            if (
+                not creating
+                and error_type(e) == TRANSIENT
+                and lease.attempts < self.conf.deferred_retries
+            ):
+                delay = self.conf.retry_backoff * 2 ** lease.attempts
+                if store.retry(lease, repr(e), delay):
+                    logging.warning("Bug {} failed ({}), retrying in {} seconds.".format(
+                        lease.bug_id, e, delay))
+                    progress.count_error(TRANSIENT)
+                    return
+            store.fail(lease, repr(e))
+            raise
+        store.complete(lease, issue_thread.issue.id)
+        self.record(issue_thread)
+        progress.count(progress.BUGS)
+
+    def migrate_batch(self, bug_list):
+        """
+        Migrate a list of bugs without stopping at bugs that fail. Failed bugs are written
+        to the dead-letter file, bugs that failed for a transient reason (server errors,
+        rate limiting, timeouts) are retried with backoff once the other bugs are done.
+        """
+        pending = bug_list
+        failed = 0
+        for attempt in range(self.conf.deferred_retries + 1):
+            if attempt:
+                delay = self.conf.retry_backoff * 2 ** (attempt - 1)
+                print("Retrying {} bug(s) in {} seconds".format(len(pending), delay))
+                time.sleep(delay)
+
+            deferred = []
+            self.source.expect(pending)
+            errors = self.run_bugs(
+                pending, lambda bug: self.migrate_isolated(self.migrate_one, bug))
+            for bug, error in zip(pending, errors):
+                if error is None:
+                    continue
+                if isinstance(error, IssueCreationError):
+                    error = self.resolve_creation_error(bug, error)
+                if error_type(error) == TRANSIENT and attempt < self.conf.deferred_retries:
+                    deferred.append(bug)
+                else:
+                    self.dead_letter(bug, error, attempt + 1)
+                    failed += 1
+            pending = deferred
+            if not pending:
+                break
+
+        print("Migrated {} of {} bugs".format(len(bug_list) - failed, len(bug_list)))
+        if failed:
+            print("{} bug(s) failed, see {}".format(failed, self.conf.dead_letter_file))
+
+    def resolve_creation_error(self, bugzilla_bug_id, error):
+        """
+        Find out whether the issue of a bug whose creation failed exists. Returns the
+        original error if it does not, the bug can be retried, else a PartialMigrationError.
+        """
+        conf = error.config
+        if conf.use_bugzilla_id or conf.include_bugzilla_link:
+            try:
+                issue_iid = find_migrated_issue(conf, bugzilla_bug_id)
+            except Exception as e:
+                logging.warning("Cannot look up the issue of bug {}: {}".format(bugzilla_bug_id, e))
+            else:
+                if issue_iid is None:
+                    return error.error
+                return PartialMigrationError(bugzilla_bug_id, issue_iid, error.error)
+        return PartialMigrationError(bugzilla_bug_id, None, error.error)
+
+    def migrate_isolated(self, migrate, *args):
+        """
+        Run a migration function, returning its exception instead of raising it.
+        """
+        try:
+            migrate(*args)
+        except Exception as e:
+            logging.exception("Migration failed: {}".format(e))
+            print("Migration failed ({}): {}".format(error_type(e), e))
+            progress.count(progress.FAILED)
+            progress.count_error(error_type(e))
+            return e
+        return None
+
+    def dead_letter(self, bugzilla_bug_id, error, attempts):
+        """
+        Append a failed bug to the dead-letter file, one JSON object per line.
+        """
+        cause = None
+        if isinstance(error, PartialMigrationError):
+            # why the bug failed after its issue was created, e.g. DeadlineExceeded
+            cause = type(error.error).__name__
+        entry = {
+            "bug_id": int(bugzilla_bug_id),
+            "error_type": error_type(error),
+            "exception": type(error).__name__,
+            "error": str(error),
+            "issue_iid": getattr(error, "issue_id", None),
+            "cause": cause,
+            "attempts": attempts,
+            "failed_at": datetime.utcnow().strftime(HIGH_WATER_MARK_FORMAT),
+        }
+        with self.dead_letter_lock, open(self.conf.dead_letter_file, "a") as f:
+            f.write(json.dumps(entry) + "\n")
 
     def migrate_one_file(self, file):
         """
         Migrate a single bug from Bugzilla to GitLab. TEST MODE
         """
         print("Migrating file {}".format(file))
-        fields = load_bugzilla_bug(file)
-        issue_thread = IssueThread(self.conf, fields)
-        issue_thread.save()
+        bug_name = os.path.splitext(os.path.basename(file))[0]
+        with self.profile(bug_name), deadline(self.conf.bug_time_budget):
+            fields = load_bugzilla_bug(file)
+            progress.count(progress.FETCHED)
+            issue_thread = IssueThread(self.router.route(fields), fields)
+            issue_thread.save()
+        self.record(issue_thread)
+        progress.count(progress.BUGS)
 
     def migrate_one(self, bugzilla_bug_id):
         """
         Migrate a single bug from Bugzilla to GitLab.
         """
         print("Migrating bug {}".format(bugzilla_bug_id))
-        fields = get_bugzilla_bug(self.conf.bugzilla_base_url, bugzilla_bug_id)
-        issue_thread = IssueThread(self.conf, fields)
-        issue_thread.save()
+        with self.profile(bugzilla_bug_id), deadline(self.conf.bug_time_budget):
+            fields = self.fetch_bug(bugzilla_bug_id)
+            issue_thread = IssueThread(self.router.route(fields), fields)
+            issue_thread.save()
+        self.record(issue_thread)
+        progress.count(progress.BUGS)
+
+
+@contextlib.contextmanager
+def no_profile():
+    # contextlib.nullcontext requires Python 3.7
+    yield
+
+
+def error_type(error):
+    """
+    Classify the failure of a bug. Bugs whose GitLab issue was created already, or may
+    have been, are never retried automatically, they would end up with a second issue.
+    """
+    if isinstance(error, (PartialMigrationError, IssueCreationError)):
+        return PARTIAL
+    if is_transient(error):
+        return TRANSIENT
+    return PERMANENT
@@ -1,9 +1,132 @@
-import re, json, base64, logging
-
-from .utils import _perform_request, format_datetime, format_utc, markdown_table_row, add_user_mapping, is_admin, set_admin_permission
+import base64
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import contextlib
+import itertools
+import json
+import logging
+import re
+import threading
+
+from requests.packages.urllib3.filepost import encode_multipart_formdata
+
+from . import progress
 from .config import _get_user_id
+from .graphql import create_notes, graphql_url, issue_gid
+from .latency import get_deadline, set_deadline
+from .relinking import referenced_bugs
+from .sources import get_attachment_data
+from .templates import get_templates
+from .utils import (
+    _perform_request,
+    add_user_mapping,
+    format_timestamps,
+    is_admin,
+    is_transient,
+    is_unsent,
+    markdown_table_row,
+    paginate,
+    set_admin_permission,
+    ThrottledBody,
+)
+
+
+class _ThreadConfig:
+    """
+    The configuration of the bug that the current thread works on. Several bugs, possibly
+    for different GitLab projects, can be migrated at the same time by different threads.
+    Threads without a configuration of their own use the one that was set last.
+    """
+
+    def __init__(self):
+        self.local = threading.local()
+        self.default = None
+
+    def current(self):
+        return getattr(self.local, "config", None) or self.default
+
+    def __getattr__(self, name):
+        return getattr(self.current(), name)
+
+
+CONF = _ThreadConfig()
+
+# Temporary admin permissions, shared by all notes and issues created by the same user
+ADMIN_LOCK = threading.Lock()
+ADMIN_USER_LOCKS = defaultdict(threading.Lock)
+ADMIN_ELEVATIONS = {}
+
+# Users and milestones that are looked up or created while bugs are migrated
+USER_LOCK = threading.Lock()
+MILESTONE_LOCK = threading.Lock()
+
+
+def set_config(config):
+    """
+    Set the configuration used by the models in this thread.
+    """
+    CONF.local.config = config
+    CONF.default = config
+
+
+def bind_config(func):
+    """
+    Wrap a function to run in a worker thread with the configuration, the upload limit
+    and the deadline of the current thread.
+    """
+    config = CONF.current()
+    limiter = getattr(CONF.local, "upload_limiter", None)
+    deadline = get_deadline()
+
+    def bound(*args, **kwargs):
+        CONF.local.config = config
+        CONF.local.upload_limiter = limiter
+        set_deadline(deadline)
+        return func(*args, **kwargs)
+    return bound
+
+
+@contextlib.contextmanager
+def upload_limit(limiter):
+    """
+    Limit the bandwidth of the attachment uploads of this thread with a RateLimiter in
+    bytes per second.
+    """
+    previous = getattr(CONF.local, "upload_limiter", None)
+    CONF.local.upload_limiter = limiter
+    try:
+        yield
+    finally:
+        CONF.local.upload_limiter = previous
+
+
+class PartialMigrationError(Exception):
+    """
+    A bug failed after its GitLab issue was created. Migrating it again would create
+    a second issue.
+    """
+
+    def __init__(self, bug_id, issue_id, error):
+        super().__init__(
+            "Bug {} was partially migrated to issue {}: {}".format(bug_id, issue_id, error))
+        self.issue_id = issue_id
+        self.error = error
+
+
+class IssueCreationError(Exception):
+    """
+    The request that creates the issue of a bug failed without telling whether GitLab
+    created the issue, e.g. it timed out or was answered with a server error. The issue
+    has to be looked up before the bug is migrated again.
+    """
 
-CONF = None
+    def __init__(self, bug_id, error, config):
+        super().__init__(
+            "Creating the issue of bug {} failed, it may exist: {}".format(bug_id, error))
+        self.bug_id = bug_id
+        self.error = error
+        # the configuration of the project the issue was created in
+        self.config = config
 
 
 class IssueThread:
@@ -12,14 +135,19 @@ class IssueThread:
     """
 
     def __init__(self, config, fields):
-        global CONF
-        CONF = config
+        set_config(config)
+        self.bug_id = fields["bug_id"]
+        self.delta_ts = fields.get("delta_ts")
+        self.comment_keys = [comment_key(c) for c in fields["long_desc"]]
+        self.dependson = list(fields.get("dependson", []))
+        self.blocked = list(fields.get("blocked", []))
         self.load_objects(fields)
 
     def load_objects(self, fields):
         """
         Load the issue object and the comment objects.
-        If CONF.dry_run=False, then Attachments are created in GitLab in this step.
+        If CONF.dry_run=False, then Attachments are uploaded to GitLab in this step,
+        before the issue description and the comments are rendered.
         """
         self.comments = []
         self.attachments = {}
@@ -37,6 +165,12 @@ class IssueThread:
                     logging.info("Attachment {} is marked as obsolete.".format(attachment_fields["attachid"]))
                 self.attachments[attachment_fields["attachid"]] = Attachment(attachment_fields)
 
+        upload_attachments(
+            self.attachments[comment_fields["attachid"]]
+            for comment_fields in fields["long_desc"]
+            if comment_fields.get("thetext") and comment_fields.get("attachid") in self.attachments
+        )
+
         issue_attachment = {}
         if fields.get("long_desc"):
             comment0 = fields.get("long_desc")[0]
@@ -51,24 +185,139 @@ class IssueThread:
                     attachment = self.attachments.get(comment_fields.get("attachid"))
                 self.comments.append(Comment(comment_fields, attachment))
 
+    def journal_entry(self):
+        """
+        What has been migrated for this bug, as recorded in the journal.
+        """
+        return {
+            "project_id": CONF.gitlab_project_id,
+            "status": self.issue.status,
+            "labels": self.issue.labels,
+            "delta_ts": self.delta_ts,
+            "comment_keys": self.comment_keys,
+            "note_count": len(self.comments),
+            # the bugs linked from the issue, see relinking.py
+            "description_refs": referenced_bugs(self.issue.description, CONF.bugzilla_base_url),
+            "note_refs": note_references(self.comments),
+            "dependson": self.dependson,
+            "blocked": self.blocked,
+            "attachment_ids": [
+                attachid for attachid, attachment in self.attachments.items()
+                if attachment.upload_link
+            ],
+        }
+
     def save(self):
         """
         Save the issue and all of the comments to GitLab.
         If CONF.dry_run=True, then only the HTTP request that would be made is printed.
         """
-        self.issue.save()
+        try:
+            self.issue.save()
+        except Exception as e:
+            if is_transient(e) and not is_unsent(e):
+                raise IssueCreationError(self.bug_id, e, CONF.current()) from e
+            raise
 
-        for comment in self.comments:
-            comment.issue_id = self.issue.id
-            comment.save()
+        try:
+            save_comments(self.comments, self.issue.id, self.issue.global_id)
 
-        # close the issue in GitLab, if it is resolved in Bugzilla
-        if self.issue.status in CONF.bugzilla_closed_states:
-            self.issue.close()
+            # close the issue in GitLab, if it is resolved in Bugzilla
+            if self.issue.status in CONF.bugzilla_closed_states:
+                self.issue.close()
+
+            # close the issue in Bugzilla
+            if CONF.close_bugzilla_bugs: # and not CONF.dry_run:
+                self.issue.closeBugzilla()
+        except Exception as e:
+            raise PartialMigrationError(self.bug_id, self.issue.id, e) from e
+
+
+class IssueUpdate:
+    """
+    Changes to a bug that has already been migrated: new comments and attachments,
+    and the current state, labels and milestone of the issue.
+    """
+
+    def __init__(self, config, fields, entry):
+        set_config(config)
+        self.entry = entry
+        self.bug_id = fields["bug_id"]
+        self.delta_ts = fields.get("delta_ts")
+        self.dependson = list(fields.get("dependson", []))
+        self.blocked = list(fields.get("blocked", []))
+        self.load_objects(fields)
+
+    def load_objects(self, fields):
+        self.issue = Issue(fields, describe=False)
+        self.issue.id = self.entry["issue_iid"]
+
+        attachments = {}
+        for attachment_fields in fields.get("attachment", []):
+            attachments[attachment_fields["attachid"]] = attachment_fields
+
+        known = set(self.entry["comment_keys"])
+        self.comment_keys = list(self.entry["comment_keys"])
+        self.attachments = {}
+        new_comments = []
+        for comment_fields in fields["long_desc"]:
+            key = comment_key(comment_fields)
+            if key in known:
+                continue
+            self.comment_keys.append(key)
+            if comment_fields.get("thetext"):
+                attachment = {}
+                attachid = comment_fields.get("attachid")
+                if attachid and attachid in attachments:
+                    attachment = Attachment(attachments[attachid])
+                    self.attachments[attachid] = attachment
+                new_comments.append((comment_fields, attachment))
+
+        upload_attachments(self.attachments.values())
+        self.comments = [Comment(*comment) for comment in new_comments]
+        logging.info(
+            "Found {} new comment(s) for bug {}".format(len(self.comments), self.bug_id)
+        )
+
+    def journal_entry(self):
+        entry = dict(self.entry)
+        entry.pop("issue_iid", None)
+        entry.update(
+            {
+                "status": self.issue.status,
+                "labels": self.issue.labels,
+                "delta_ts": self.delta_ts,
+                "comment_keys": self.comment_keys,
+                "attachment_ids": self.entry["attachment_ids"] + [
+                    attachid for attachid, attachment in self.attachments.items()
+                    if attachment.upload_link
+                ],
+            }
+        )
+        if "note_count" in self.entry:
+            entry["note_count"] = self.entry["note_count"] + len(self.comments)
+        if "note_refs" in self.entry:
+            entry["note_refs"] = self.entry["note_refs"] + [
+                bug for bug in note_references(self.comments) if bug not in self.entry["note_refs"]
+            ]
+        entry["dependson"] = self.dependson
+        entry["blocked"] = self.blocked
+        return entry
+
+    def save(self):
+        """
+        Append the new comments to the GitLab issue and update its state and labels.
+        """
+        self.issue.update(self.entry["labels"])
+
+        save_comments(self.comments, self.issue.id)
 
-        # close the issue in Bugzilla
-        if CONF.close_bugzilla_bugs: # and not CONF.dry_run:
-            self.issue.closeBugzilla()
+        was_closed = self.entry["status"] in CONF.bugzilla_closed_states
+        is_closed = self.issue.status in CONF.bugzilla_closed_states
+        if is_closed and not was_closed:
+            self.issue.close()
+        elif was_closed and not is_closed:
+            self.issue.reopen()
 
 
 class Issue:
@@ -88,14 +337,16 @@ class Issue:
         "confidential"
     ]
 
-    def __init__(self, bugzilla_fields, attachment=None):
-        self.headers = CONF.default_headers
+    def __init__(self, bugzilla_fields, attachment=None, describe=True):
+        self.headers = dict(CONF.default_headers)
+        # the database id of the issue, as opposed to its iid
+        self.global_id = None
         validate_user(bugzilla_fields["reporter"])
         validate_user(bugzilla_fields["assigned_to"])
         self.attachment = attachment
-        self.load_fields(bugzilla_fields)
+        self.load_fields(bugzilla_fields, describe)
 
-    def load_fields(self, fields):
+    def load_fields(self, fields, describe=True):
         if CONF.use_bugzilla_id_in_title:
             self.title = "[Bug {}] {}".format(fields["bug_id"], fields["short_desc"])
         else:
@@ -111,7 +362,8 @@ class Issue:
             self.assignee_ids = [CONF.gitlab_users[CONF.bugzilla_users[fields["assigned_to"]]]]
             logging.info("Assigning issue to {}".format(CONF.bugzilla_users[fields["assigned_to"]]))
 
-        self.created_at = format_utc(fields["creation_ts"])
+        self.created_at, self.formatted_created_at = format_timestamps(
+            fields["creation_ts"], CONF.datetime_format_string)
         self.status = fields["bug_status"]
 
         #set confidential
@@ -127,68 +379,26 @@ class Issue:
         milestone = fields["target_milestone"]
         if CONF.map_milestones and milestone not in CONF.milestones_to_skip:
             self.create_milestone(milestone)
-        self.create_description(fields)
+        if describe:
+            self.create_description(fields)
 
     def create_labels(self, component, operating_system, keywords, severity, spam):
         """
         Creates 4 types of labels: default labels listed in the configuration, component labels,
         operating system labels, and keyword labels.
         """
-        labels = []
-        if CONF.default_gitlab_labels:
-            labels.extend(CONF.default_gitlab_labels)
-
-        component_label = None
-        if not CONF.component_mappings is None:
-            component_label = CONF.component_mappings.get(component)
-
-        if component_label is None:
-            if CONF.component_mapping_auto:
-                component_label = component
-            else:
-                raise Exception("No component mapping found for '{}'".format(component))
-
-        logging.info("Assigning component label: {}...".format(component_label))
-
-        if component_label:
-            labels.append(component_label)
-
-        # Do not create a label if the OS is other. That is a meaningless label.
-        if (
-            CONF.map_operating_system
-            and operating_system
-            and operating_system != "Other"
-        ):
-            labels.append(operating_system)
-
-        if CONF.map_keywords and keywords:
-            # Input: payload of XML element like this: <keywords>SECURITY, SUPPORT</keywords>
-            # Bugzilla restriction: You may not use commas or whitespace in a keyword name.
-            for k in keywords.replace(" ", "").split(","):
-                if not (CONF.keywords_to_skip and k in CONF.keywords_to_skip):
-                    labels.append(k)
-
-        if severity:
-            if severity == "critical" or severity == "blocker":
-                if severity == "critical" and CONF.severity_critical_label:
-                    severity_label = CONF.severity_critical_label
-                elif severity == "blocker" and CONF.severity_blocker_label:
-                    severity_label = CONF.severity_blocker_label
-                else:
-                    severity_label = severity
-                logging.info("Found severity '{}'. Assigning label: '{}'...".format(severity, severity_label))
-                labels.append(severity_label)
-
-        if spam and spam.lower() == "spam":
-           logging.info("Found keyword spam in whiteboard field! Assigning label...")
-           labels.append("spam")
-
+        labels = get_labels(component, operating_system, keywords, severity, spam)
         self.labels = ",".join(labels)
 
     def create_milestone(self, milestone):
         """
         Looks up milestone id given its title or creates a new one.
         """
+        with MILESTONE_LOCK:
+            self._create_milestone(milestone)
+        self.milestone_id = CONF.gitlab_milestones[milestone]
+
+    def _create_milestone(self, milestone):
         if milestone not in CONF.gitlab_milestones:
             logging.info("Create milestone: {}".format(milestone))
             url = "{}/projects/{}/milestones".format(
@@ -208,85 +418,12 @@ class Issue:
             else:
               CONF.gitlab_milestones[milestone] = response["id"]
 
-        self.milestone_id = CONF.gitlab_milestones[milestone]
-
-    def show_related_bugs(self, fields):
-        deplist = []
-        blocklist = []
-        see_alsolist = []
-        if fields.get("dependson"):
-            for depends in fields.get("dependson"):
-                link = "{}/show_bug.cgi?id={}".format(CONF.bugzilla_base_url, depends)
-                deplist.append("[{}]({})".format(depends, link))
-            self.description += markdown_table_row("Depends on", ", ".join(deplist))
-        if fields.get("blocked"):
-            for blocked in fields.get("blocked"):
-                link = "{}/show_bug.cgi?id={}".format(CONF.bugzilla_base_url, blocked)
-                blocklist.append("[{}]({})".format(blocked, link))
-            self.description += markdown_table_row("Blocks", ", ".join(blocklist))
-        if fields.get("see_also"):
-            for see_also in fields.get("see_also"):
-                if CONF.see_also_gerrit_link_base_url in see_also:
-                    pattern = CONF.see_also_gerrit_link_base_url + '/c/.*/\+/'
-                    gerrit_id = re.sub(pattern, '', see_also)
-                    see_alsolist.append("[Gerrit change {}]({})".format(gerrit_id, see_also))
-                elif CONF.see_also_git_link_base_url in see_also:
-                    pattern = CONF.see_also_git_link_base_url + '/.*id='
-                    commit_id = re.sub(pattern, '', see_also)[0:8]
-                    see_alsolist.append("[Git commit {}]({})".format(commit_id, see_also))
-                else:
-                    if CONF.bugzilla_base_url in see_also:
-                        see_also = see_also.replace("{}/show_bug.cgi?id=".format(CONF.bugzilla_base_url),"")
-                        link = "{}/show_bug.cgi?id={}".format(CONF.bugzilla_base_url, see_also)
-                        see_alsolist.append("[{}]({})".format(see_also, link))
-                    else:
-                        see_alsolist.append(see_also)
-            self.description += markdown_table_row("See also", ", ".join(see_alsolist))
-
     def create_description(self, fields):
         """
         An opinionated description body creator.
         """
         ext_description = ""
-
-        # markdown table header
-        self.description = markdown_table_row("", "")
-        self.description += markdown_table_row("---", "---")
-
-        if CONF.include_bugzilla_link:
-            bug_id = fields["bug_id"]
-            link = "{}/show_bug.cgi?id={}".format(CONF.bugzilla_base_url, bug_id)
-            self.description += markdown_table_row("Bugzilla Link", "[{}]({})".format(bug_id, link))
-
-        if fields.get("bug_status"):
-            status = fields["bug_status"]
-            if fields.get("resolution"):
-                status += " " + fields["resolution"]
-                if fields["resolution"] == "DUPLICATE":
-                    status += " of [bug {}]({}/show_bug.cgi?id={})".format(fields["dup_id"], CONF.bugzilla_base_url, fields["dup_id"])
-            self.description += markdown_table_row("Status", status)
-
-        if fields.get("priority"):
-            self.description += markdown_table_row("Importance", "{} {}".format(fields["priority"], fields["bug_severity"]))
-
-        formatted_creation_dt = format_datetime(fields["creation_ts"], CONF.datetime_format_string)
-        self.description += markdown_table_row("Reported",  "{} {}".format(formatted_creation_dt, CONF.timezone))
-
-        formatted_modification_dt = format_datetime(fields["delta_ts"], CONF.datetime_format_string)
-        self.description += markdown_table_row("Modified", "{} {}".format(formatted_modification_dt, CONF.timezone))
-
-        if CONF.include_version:
-            if CONF.include_version_only_when_specified:
-                if fields.get("version") != "unspecified":
-                    self.description += markdown_table_row("Version", fields.get("version"))
-            else:
-                self.description += markdown_table_row("Version", fields.get("version"))
-        if CONF.include_os:
-            self.description += markdown_table_row("OS", fields.get("op_sys"))
-        if CONF.include_arch:
-            self.description += markdown_table_row("Architecture", fields.get("rep_platform"))
-
-        self.show_related_bugs(fields)
+        reporter = None
 
         # add first comment to the issue description
         attachments = []
@@ -301,7 +438,6 @@ class Issue:
                 if comment0.get("attachid"):
                     if self.attachment:
                         if not self.attachment.is_obsolete:
-                            self.attachment.save() #upload the attachment!
                             ext_description += self.attachment.get_markdown(comment0_text)
                         else:
                             ext_description += re.sub(r"(attachment\s\d*)", "~~\\1~~ (attachment deleted)", comment0_text)
@@ -326,19 +462,20 @@ class Issue:
                         regex = r"^(\S*)\s?.*$"
                         email = re.match(regex, user_data, flags=re.M).group(1)
                         if CONF.show_email:
-                            self.description += markdown_table_row("Reporter", email)
+                            reporter = email
                 # Add original reporter to the markdown table
                 elif CONF.bugzilla_users[fields["reporter"]] == CONF.gitlab_misc_user:
                     reporter = fields["reporter_name"]
                     if CONF.show_email:
                         reporter += " ({})".format(fields["reporter"])
-                    self.description += markdown_table_row("Reporter", reporter)
 
-                self.description += self.fix_description(ext_description)
+                ext_description = self.fix_description(ext_description)
         else:
             logging.info("Description is EMPTY!")
-            self.description += "\n## Description \n"
-            self.description += "EMPTY DESCRIPTION"
+            ext_description = "\n## Description \nEMPTY DESCRIPTION"
+
+        self.description = get_templates(CONF.current()).description(
+            fields, self.formatted_created_at, reporter, ext_description)
 
         if CONF.dry_run:
             logging.info(self.description)
@@ -368,24 +505,18 @@ class Issue:
             logging.info("Using original issue id")
             data["iid"] = self.bug_id
 
-        if not CONF.dry_run:
-            admin_status_issue = is_admin(CONF.gitlab_base_url, self.sudo, CONF.default_headers)
-
-            if admin_status_issue is not None and not admin_status_issue:
-                logging.info("")
-                response = set_admin_permission(CONF.gitlab_base_url, self.sudo, True, CONF.default_headers)
-
         self.headers["sudo"] = self.sudo
 
-        response = _perform_request(
-            url,
-            "post",
-            headers=self.headers,
-            data=data,
-            json=True,
-            dry_run=CONF.dry_run,
-            verify=CONF.verify,
-        )
+        with admin_permission(self.sudo):
+            response = _perform_request(
+                url,
+                "post",
+                headers=self.headers,
+                data=data,
+                json=True,
+                dry_run=CONF.dry_run,
+                verify=CONF.verify,
+            )
 
         if CONF.dry_run:
             # assign a random number so that program can continue
@@ -393,20 +524,62 @@ class Issue:
             return
 
         self.id = response["iid"]
+        self.global_id = response["id"]
+        progress.count(progress.ISSUES)
         print("Created issue with id: {}".format(self.id))
         logging.info("Created issue with id: {}".format(self.id))
 
-        #TODO: make sure this is always set, even if there is an exception
-        if admin_status_issue is not None and not admin_status_issue:
-            response = set_admin_permission(CONF.gitlab_base_url, self.sudo, False, CONF.default_headers)
-            logging.info("")
-
     def who_closed_the_bug(self, bug_id):
         url = "{}/rest/bug/{}/history?api_key={}".format(CONF.bugzilla_base_url, bug_id, CONF.bugzilla_api_token)
         response = _perform_request(url, "get", json=True)
         last_change = response["bugs"][0]["history"][-1]
         return last_change["who"]
 
+    def update(self, previous_labels):
+        """
+        Update title, milestone and labels of an already migrated issue.
+        Labels that were added in GitLab by hand are kept.
+        """
+        url = "{}/projects/{}/issues/{}".format(
+            CONF.gitlab_base_url, CONF.gitlab_project_id, self.id
+        )
+        labels = self.labels.split(",") if self.labels else []
+        previous_labels = previous_labels.split(",") if previous_labels else []
+        data = {
+            "title": self.title,
+            "add_labels": ",".join(
+                label for label in labels if label not in previous_labels
+            ),
+            "remove_labels": ",".join(
+                label for label in previous_labels if label not in labels
+            ),
+        }
+        if getattr(self, "milestone_id", None):
+            data["milestone_id"] = self.milestone_id
+
+        _perform_request(
+            url,
+            "put",
+            headers=CONF.default_headers,
+            data=data,
+            dry_run=CONF.dry_run,
+            verify=CONF.verify,
+        )
+
+    def reopen(self):
+        url = "{}/projects/{}/issues/{}".format(
+            CONF.gitlab_base_url, CONF.gitlab_project_id, self.id
+        )
+        self.headers["sudo"] = self.sudo
+        _perform_request(
+            url,
+            "put",
+            headers=self.headers,
+            data={"state_event": "reopen"},
+            dry_run=CONF.dry_run,
+            verify=CONF.verify,
+        )
+
     def close(self):
         url = "{}/projects/{}/issues/{}".format(
             CONF.gitlab_base_url, CONF.gitlab_project_id, self.id
@@ -458,11 +631,8 @@ class Issue:
 
         url = "{}/rest/bug/{}?api_key={}".format(CONF.bugzilla_base_url, self.bug_id, CONF.bugzilla_api_token)
 
-        #Head request to avoid 'Remote end closed connection without response' (most likely due to race-condition with "Keep-Alive" option set on server)
-        response_head = _perform_request(url, "head", json=False)
-        logging.info("Head-Response:")
-        logging.info(response_head)
-
+        # stale keep-alive connections ('Remote end closed connection without response')
+        # are avoided by the session, see `configure_http`
         response = _perform_request(url, "put", data=json_data, headers={"Content-Type": "application/json"}, json=True)
         if response.get("error"):
             logging.error("Response:")
@@ -470,6 +640,7 @@ class Issue:
         else:
             logging.info("Bugzilla issue has been closed.\n")
 
+
 class Comment:
     """
     The comment model
@@ -479,7 +650,7 @@ class Comment:
     data_fields = ["created_at", "body"]
 
     def __init__(self, bugzilla_fields, attachment=None):
-        self.headers = CONF.default_headers
+        self.headers = dict(CONF.default_headers)
         self.attachment = attachment
         validate_user(bugzilla_fields["who"])
         self.load_fields(bugzilla_fields)
@@ -507,33 +678,27 @@ class Comment:
 
     def load_fields(self, fields):
         self.sudo = CONF.gitlab_users[CONF.bugzilla_users[fields["who"]]] # GitLab user ID
-        # if unable to comment as the original user, put user name in comment body
-        self.created_at = format_utc(fields["bug_when"])
-        self.body = ""
-        if CONF.bugzilla_users[fields["who"]] == CONF.gitlab_misc_user and fields["who"] != CONF.bugzilla_misc_user:
-            self.body += "By {}".format(fields["who_name"])
-            if CONF.show_email:
-                self.body += " ({})".format(fields["who"])
-            if CONF.show_datetime_in_comments:
-                self.body += " on "
-            else:
-                self.body += "\n\n"
-        if CONF.show_datetime_in_comments:
-            self.body += format_datetime(fields["bug_when"], CONF.datetime_format_string)
-            self.body += "\n\n"
-
-        # if this comment is actually an attachment, upload the attachment and add the markdown to the comment body
+        self.created_at, formatted_bug_when = format_timestamps(
+            fields["bug_when"], CONF.datetime_format_string)
+        # if this comment is actually an attachment, add the markdown of the uploaded attachment
+        # to the comment body
         if fields.get("attachid"):
             if self.attachment:
                 if not self.attachment.is_obsolete:
-                    self.attachment.save() #upload the attachment!
-                    self.body += self.attachment.get_markdown(fields["thetext"])
+                    text = self.attachment.get_markdown(fields["thetext"])
                 else:
-                    self.body += self.fix_comment(re.sub(r"(attachment\s\d*)", "~~\\1~~ (attachment deleted)", fields["thetext"]))
+                    text = self.fix_comment(re.sub(
+                        r"(attachment\s\d*)", "~~\\1~~ (attachment deleted)", fields["thetext"]))
             else:
                raise Exception ("No attachment despite attachid!")
         else:
-            self.body += self.fix_comment(fields["thetext"])
+            text = self.fix_comment(fields["thetext"])
+
+        # if unable to comment as the original user, put user name in comment body
+        show_author = (CONF.bugzilla_users[fields["who"]] == CONF.gitlab_misc_user
+                       and fields["who"] != CONF.bugzilla_misc_user)
+        self.body = get_templates(CONF.current()).comment(
+            fields, formatted_bug_when, show_author, text)
 
         if CONF.dry_run:
             logging.info("<--Comment start-->")
@@ -553,31 +718,21 @@ class Comment:
         )
         data = {k: v for k, v in self.__dict__.items() if k in self.data_fields}
 
-        if not CONF.dry_run:
-            admin_status_comment = is_admin(CONF.gitlab_base_url, self.sudo, CONF.default_headers)
-
-            if admin_status_comment is not None and not admin_status_comment:
-                logging.info("")
-                response = set_admin_permission(CONF.gitlab_base_url, self.sudo, True, CONF.default_headers)
-
         self.headers["sudo"] = self.sudo
 
-        _perform_request(
-            url,
-            "post",
-            headers=self.headers,
-            data=data,
-            json=True,
-            dry_run=CONF.dry_run,
-            verify=CONF.verify,
-        )
+        with admin_permission(self.sudo):
+            _perform_request(
+                url,
+                "post",
+                headers=self.headers,
+                data=data,
+                json=True,
+                dry_run=CONF.dry_run,
+                verify=CONF.verify,
+            )
+        progress.count(progress.NOTES)
         logging.info("Created comment")
 
-        if not CONF.dry_run:
-            #TODO: make sure this is always set, even if there is an exception
-            if admin_status_comment is not None and not admin_status_comment:
-                response = set_admin_permission(CONF.gitlab_base_url, self.sudo, False, CONF.default_headers)
-                logging.info("")
 
 class Attachment:
     """
@@ -589,10 +744,13 @@ class Attachment:
         self.id = fields["attachid"]
         self.file_name = fields["filename"]
         self.file_type = fields["type"]
+        self.file_size = fields.get("size")
         self.file_description = fields["desc"]
-        if not self.is_obsolete:
+        # read when the attachment is uploaded if the bug was read without the data
+        self.file_data = None
+        if not self.is_obsolete and "data" in fields:
             self.file_data = base64.b64decode(fields["data"])
-        self.headers = CONF.default_headers
+        self.headers = dict(CONF.default_headers)
         self.upload_link = ""
 
     def parse_upload_link(self, attachment):
@@ -614,6 +772,8 @@ class Attachment:
         return matches.group(1)
 
     def get_markdown(self, comment):
+        if not self.upload_link:
+            raise Exception("Attachment {} has not been uploaded yet!".format(self.id))
         comment = re.sub(r"(attachment\s\d*)", u"[\\1]({})".format(self.upload_link), comment)
         thumbnail_size = "150"
         if self.file_type.startswith("image"):
@@ -630,36 +790,351 @@ class Attachment:
         return comment
 
     def save(self):
+        if self.upload_link:
+            return
         url = "{}/projects/{}/uploads".format(CONF.gitlab_base_url, CONF.gitlab_project_id)
 
+        if self.file_data is None:
+            self.file_data = get_attachment_data(
+                CONF.current(), self.id, self.file_size, self.file_type)
         if not self.file_data:
             raise Exception("Attachment data is empty!")
         f = {"file": (self.file_name, self.file_data)}
-        attachment = _perform_request(
-            url,
-            "post",
-            headers=self.headers,
-            files=f,
-            json=True,
-            dry_run=CONF.dry_run,
-            verify=CONF.verify,
-        )
+        limiter = getattr(CONF.local, "upload_limiter", None)
+        if limiter and limiter.rate and not CONF.dry_run:
+            # the upload is throttled while it is sent
+            body, content_type = encode_multipart_formdata(f)
+            attachment = _perform_request(
+                url,
+                "post",
+                headers=dict(self.headers, **{"Content-Type": content_type}),
+                data=ThrottledBody(body, limiter),
+                json=True,
+                verify=CONF.verify,
+            )
+        else:
+            attachment = _perform_request(
+                url,
+                "post",
+                headers=self.headers,
+                files=f,
+                json=True,
+                dry_run=CONF.dry_run,
+                verify=CONF.verify,
+            )
         # For dry run, nothing is uploaded, so upload link is faked just to let the process continue
         if CONF.dry_run:
             self.upload_link = "/dry-run/upload-link"
         else:
             self.upload_link = self.parse_upload_link(attachment)
+            progress.count(progress.BYTES, len(self.file_data))
+
+
+class UnmappedComponentError(Exception):
+    """
+    A bug of a component that has no label in component_mappings.
+    """
+
+
+def get_labels(component, operating_system, keywords, severity, spam):
+    """
+    The GitLab labels of a bug, see `Issue.create_labels`.
+    """
+    labels = []
+    if CONF.default_gitlab_labels:
+        labels.extend(CONF.default_gitlab_labels)
+
+    component_label = None
+    if not CONF.component_mappings is None:
+        component_label = CONF.component_mappings.get(component)
+
+    if component_label is None:
+        if CONF.component_mapping_auto:
+            component_label = component
+        else:
+            raise UnmappedComponentError("No component mapping found for '{}'".format(component))
+
+    logging.info("Assigning component label: {}...".format(component_label))
+
+    if component_label:
+        labels.append(component_label)
+
+    # Do not create a label if the OS is other. That is a meaningless label.
+    if (
+        CONF.map_operating_system
+        and operating_system
+        and operating_system != "Other"
+    ):
+        labels.append(operating_system)
+
+    if CONF.map_keywords and keywords:
+        # Input: payload of XML element like this: <keywords>SECURITY, SUPPORT</keywords>
+        # Bugzilla restriction: You may not use commas or whitespace in a keyword name.
+        for k in keywords.replace(" ", "").split(","):
+            if not (CONF.keywords_to_skip and k in CONF.keywords_to_skip):
+                labels.append(k)
+
+    if severity:
+        if severity == "critical" or severity == "blocker":
+            if severity == "critical" and CONF.severity_critical_label:
+                severity_label = CONF.severity_critical_label
+            elif severity == "blocker" and CONF.severity_blocker_label:
+                severity_label = CONF.severity_blocker_label
+            else:
+                severity_label = severity
+            logging.info(
+                "Found severity '{}'. Assigning label: '{}'...".format(severity, severity_label))
+            labels.append(severity_label)
+
+    if spam and spam.lower() == "spam":
+       logging.info("Found keyword spam in whiteboard field! Assigning label...")
+       labels.append("spam")
+
+    return labels
+
+
+def upload_attachments(attachments):
+    """
+    Upload the live ones of the given attachments, CONF.attachment_concurrency at a time.
+    Upload links do not depend on the issue, so this is done before anything else.
+    """
+    pending = []
+    for attachment in attachments:
+        if not (attachment.is_obsolete or attachment.upload_link or attachment in pending):
+            pending.append(attachment)
+
+    if CONF.attachment_concurrency <= 1 or len(pending) <= 1:
+        for attachment in pending:
+            attachment.save()
+        return
+
+    logging.info("Uploading {} attachment(s)...".format(len(pending)))
+    with ThreadPoolExecutor(max_workers=min(CONF.attachment_concurrency, len(pending))) as executor:
+        for future in [executor.submit(bind_config(attachment.save)) for attachment in pending]:
+            future.result()
+
+
+def save_comments(comments, issue_id, global_id=None):
+    """
+    Post comments as notes of an issue.
+    With CONF.note_concurrency > 1 several notes are posted at once. GitLab orders notes by
+    their created_at, so the insertion order does not matter, except for comments with the
+    same timestamp: these are posted one after another by the same worker.
+    With CONF.note_backend "graphql" the notes are posted in batches, see
+    `save_comments_graphql`.
+    """
+    for comment in comments:
+        comment.issue_id = issue_id
+
+    if CONF.note_backend == "graphql":
+        save_comments_graphql(comments, issue_id, global_id)
+        return
+
+    if CONF.note_concurrency <= 1:
+        for comment in comments:
+            comment.save()
+        return
+
+    groups = [list(group) for _, group in itertools.groupby(comments, lambda c: c.created_at)]
+    results = []
+    with ThreadPoolExecutor(max_workers=CONF.note_concurrency) as executor:
+        for attempt in range(CONF.note_retries + 1):
+            if attempt:
+                groups = skip_posted(issue_id, results)
+                if not groups:
+                    return
+                logging.warning("Retrying {} failed note(s) of issue {}...".format(
+                    sum(len(group) for group in groups), issue_id))
+            results = list(executor.map(bind_config(_save_comment_group), groups))
+            groups = [failed for failed, _ in results if failed]
+            if not groups:
+                return
+
+    error = next(error for _, error in results if error)
+    raise Exception("Failed to post {} note(s) to issue {}".format(
+        sum(len(group) for group in groups), issue_id)) from error
+
+
+def _save_comment_group(comments):
+    """
+    Post comments in order, stop at the first failure.
+    Returns the comments that were not posted and the error.
+    """
+    for index, comment in enumerate(comments):
+        try:
+            comment.save()
+        except Exception as e:
+            logging.error("Failed to post note to issue {}: {}".format(comment.issue_id, e))
+            progress.count_error("note")
+            return comments[index:], e
+    return [], None
+
+
+def skip_posted(issue_id, results):
+    """
+    The groups of comments to post again, from the results of `_save_comment_group`.
+    A note that failed with a timeout or a server error may have been saved by GitLab:
+    it is only posted again if the issue has no note with its body.
+    """
+    uncertain = [failed for failed, error in results if failed and not is_unsent(error)]
+    posted = get_note_bodies(issue_id) if uncertain else set()
+    groups = []
+    for failed, _ in results:
+        if any(failed is group for group in uncertain) and failed[0].body.strip() in posted:
+            logging.info("Note was saved despite the error, not posting it again")
+            progress.count(progress.NOTES)
+            failed = failed[1:]
+        if failed:
+            groups.append(failed)
+    return groups
+
+
+def get_note_bodies(issue_id):
+    """
+    The bodies of the notes of an issue, without system notes.
+    """
+    url = "{}/projects/{}/issues/{}/notes".format(
+        CONF.gitlab_base_url, CONF.gitlab_project_id, issue_id)
+    return {
+        note["body"].strip()
+        for note in paginate(url, headers=dict(CONF.default_headers), verify=CONF.verify)
+        if not note.get("system")
+    }
+
+
+def save_comments_graphql(comments, issue_id, global_id=None):
+    """
+    Post comments in batches of up to CONF.graphql_note_batch_size notes per GraphQL
+    request. A batch has a single author (the sudo header), so consecutive comments of the
+    same user are batched. GraphQL does not take a created_at, the notes are dated at the
+    time of the migration and posted in order: a note that failed is retried up to
+    CONF.note_retries times before any later batch is sent. GitLab creates the other notes
+    of a request even if one of them fails, so a retried note can only end up after the
+    notes of its own batch. A request that failed may still have been processed; the
+    notes GitLab created are not sent again.
+    """
+    if not comments:
+        return
+    if global_id is None and not CONF.dry_run:
+        global_id = get_issue_global_id(issue_id)
+    noteable_id = issue_gid(global_id or issue_id)
+    url = graphql_url(CONF.gitlab_base_url)
+
+    pending = list(comments)
+    retries = 0
+    while pending:
+        batch = next(note_batches(pending, CONF.graphql_note_batch_size))
+        for comment in batch:
+            comment.validate()
+        headers = dict(CONF.default_headers)
+        headers["sudo"] = batch[0].sudo
+        try:
+            errors = create_notes(url, noteable_id, [comment.body for comment in batch], headers,
+                                  verify=CONF.verify, dry_run=CONF.dry_run)
+        except Exception as e:
+            logging.error(
+                "Failed to post {} note(s) to issue {}: {}".format(len(batch), issue_id, e))
+            progress.count_error("note")
+            if retries >= CONF.note_retries:
+                raise Exception(
+                    "Failed to post {} note(s) to issue {}".format(len(pending), issue_id)) from e
+            retries += 1
+            if not is_unsent(e):
+                # the mutations run in order, the notes created before the failure are skipped
+                posted = get_note_bodies(issue_id)
+                created = len(list(itertools.takewhile(lambda c: c.body.strip() in posted, batch)))
+                progress.count(progress.NOTES, created)
+                pending = pending[created:]
+            logging.warning("Retrying {} note(s) of issue {}...".format(len(batch), issue_id))
+            continue
+
+        failed = []
+        for comment, error in zip(batch, errors):
+            if error is None:
+                progress.count(progress.NOTES)
+                continue
+            logging.error("Failed to post note to issue {}: {}".format(issue_id, error))
+            progress.count_error("note")
+            failed.append((comment, error))
+        logging.info("Created {} comment(s)".format(len(batch) - len(failed)))
+        if failed and retries >= CONF.note_retries:
+            raise Exception("Failed to post {} note(s) to issue {}".format(
+                len(failed) + len(pending) - len(batch), issue_id)) from failed[0][1]
+        if failed:
+            retries += 1
+            logging.warning(
+                "Retrying {} failed note(s) of issue {}...".format(len(failed), issue_id))
+        else:
+            retries = 0
+        pending = [comment for comment, _ in failed] + pending[len(batch):]
+
+
+def note_batches(comments, size):
+    """
+    Split comments into runs of the same author, of at most `size` comments.
+    """
+    batch = []
+    for comment in comments:
+        if batch and (len(batch) >= size or comment.sudo != batch[0].sudo):
+            yield batch
+            batch = []
+        batch.append(comment)
+    if batch:
+        yield batch
+
+
+def get_issue_global_id(issue_id):
+    url = "{}/projects/{}/issues/{}".format(CONF.gitlab_base_url, CONF.gitlab_project_id, issue_id)
+    return _perform_request(
+        url, "get", headers=dict(CONF.default_headers), verify=CONF.verify)["id"]
+
+
+@contextlib.contextmanager
+def admin_permission(gitlab_user_id):
+    """
+    Temporarily make a GitLab user admin, GitLab ignores `created_at` for other users.
+    Nested and concurrent uses for the same user share one elevation, which is undone
+    when the last of them is finished, even if an exception was raised.
+    """
+    if CONF.dry_run:
+        yield
+        return
+
+    with ADMIN_LOCK:
+        user_lock = ADMIN_USER_LOCKS[gitlab_user_id]
+    with user_lock:
+        elevation = ADMIN_ELEVATIONS.get(gitlab_user_id)
+        if elevation is None:
+            admin_status = is_admin(
+                CONF.gitlab_base_url, gitlab_user_id, dict(CONF.default_headers))
+            granted = admin_status is not None and not admin_status
+            if granted:
+                set_admin_permission(
+                    CONF.gitlab_base_url, gitlab_user_id, True, dict(CONF.default_headers))
+            elevation = ADMIN_ELEVATIONS[gitlab_user_id] = {"users": 0, "granted": granted}
+        elevation["users"] += 1
+    try:
+        yield
+    finally:
+        with user_lock:
+            elevation["users"] -= 1
+            if elevation["users"] == 0:
+                del ADMIN_ELEVATIONS[gitlab_user_id]
+                if elevation["granted"]:
+                    set_admin_permission(
+                        CONF.gitlab_base_url, gitlab_user_id, False, dict(CONF.default_headers))
+
 
 #TODO: move method to utils.py? => CONF is not defined in utils.py
 def _get_gitlab_user_by_email(email):
-    url = "{}/users?search={}".format(CONF.gitlab_base_url, email)
-    response = _perform_request(url, "get", json=True, headers=CONF.default_headers)
+    url = "{}/users".format(CONF.gitlab_base_url)
+    response = list(paginate(
+        url, params={"search": email}, headers=CONF.default_headers, verify=CONF.verify))
     if len(response) > 1:
         #list all usernames
         userslist = ""
         for user in response:
           userslist += "{} ".format(user["username"])
-        #TODO: raising exceptions wont allow batch mode
         raise Exception("Found more than one GitLab user for email {}: {}. Please add the right user manually.".format(email, userslist))
     elif len(response) == 0:
       # if no GitLab user is found, return the misc user
@@ -668,7 +1143,36 @@ def _get_gitlab_user_by_email(email):
     else:
       return response[0]["username"]
 
+
+def note_references(comments):
+    """
+    The bugs linked from the bodies of comments, see `referenced_bugs`.
+    """
+    bugs = []
+    for comment in comments:
+        for bug in referenced_bugs(comment.body, CONF.bugzilla_base_url):
+            if bug not in bugs:
+                bugs.append(bug)
+    return bugs
+
+
+def comment_key(fields):
+    """
+    Identify a Bugzilla comment, older Bugzilla versions do not export comment ids.
+    """
+    if fields.get("commentid"):
+        return fields["commentid"]
+    return "{}@{}".format(fields.get("who"), fields.get("bug_when"))
+
+
 def validate_user(bugzilla_user):
+    if bugzilla_user in CONF.bugzilla_users:
+        return
+    with USER_LOCK:
+        _validate_user(bugzilla_user)
+
+
+def _validate_user(bugzilla_user):
     if bugzilla_user not in CONF.bugzilla_users:
         logging.info("Validating username {}...".format(bugzilla_user))
         gitlab_user = _get_gitlab_user_by_email(bugzilla_user)
@@ -679,16 +1183,17 @@ def validate_user(bugzilla_user):
             user_mappings_file = "{}/user_mappings.yml".format(CONF.config_path)
             add_user_mapping(user_mappings_file, bugzilla_user, gitlab_user)
 
-            # update user mapping in memory
-            CONF.bugzilla_users[bugzilla_user] = gitlab_user
+            # update user mapping in memory, the id first for threads that do not lock
             uid = _get_user_id(gitlab_user, CONF.gitlab_base_url, CONF.default_headers, verify=CONF.verify)
             CONF.gitlab_users[gitlab_user] = str(uid)
+            CONF.bugzilla_users[bugzilla_user] = gitlab_user
         else:
             raise Exception(
                 "No matching GitLab user found for Bugzilla user `{}` "
                 "Please add them before continuing.".format(bugzilla_user)
             )
 
+
 def fix_newlines(text):
     # fix line breaks in markdown syntax
     out = ""
@@ -708,6 +1213,7 @@ def fix_newlines(text):
         out += line
     return out
 
+
 def create_link(match_obj):
     if match_obj.group(4) is not None:
         bug_id = match_obj.group(2)
@@ -719,13 +1225,41 @@ def create_link(match_obj):
         link = "{}/show_bug.cgi?id={}".format(CONF.bugzilla_base_url, bug_id)
         return "[{} {}]({}){}".format(match_obj.group(1), bug_id, link, match_obj.group(3))
 
+
 def find_bug_links(text):
     # replace '[b|B]ug 12345 [c|C]omment 1' with markdown link
     text = re.sub(r"([b|B]ug)\s(\d{1,6})(\s?)(([c|C]omment)\s\\?\#?(\d{1,6}))?", create_link, text)
     return text
 
+
 def escape_hashtags(text):
     # escape hashtag in '#5' to avoid linking to the wrong issues
     text = re.sub(r"\#(\d)", "\#\\1", text)
     return text
 
+
+def find_migrated_issue(config, bug_id):
+    """
+    Look up the GitLab issue that was created for a Bugzilla bug.
+    Returns the issue iid or None if there is none.
+    """
+    url = "{}/projects/{}/issues".format(config.gitlab_base_url, config.gitlab_project_id)
+    if not (config.use_bugzilla_id or config.include_bugzilla_link):
+        raise Exception(
+            "Cannot look up the issue of bug {} without use_bugzilla_id or "
+            "include_bugzilla_link".format(bug_id)
+        )
+
+    marker = None
+    if config.include_bugzilla_link:
+        link = "{}/show_bug.cgi?id={}".format(config.bugzilla_base_url, bug_id)
+        marker = markdown_table_row("Bugzilla Link", "[{}]({})".format(bug_id, link))
+    if config.use_bugzilla_id:
+        params = {"iids[]": bug_id}
+    else:
+        params = {"search": link, "in": "description"}
+
+    for issue in paginate(url, params=params, headers=config.default_headers, verify=config.verify):
+        if marker is None or marker in (issue.get("description") or ""):
+            return issue["iid"]
+    return None
@@ -0,0 +1,275 @@
+"""
+Migration planner: count what a migration has to do and estimate how long it takes,
+without writing anything to GitLab or Bugzilla.
+"""
+
+import base64
+from collections import Counter
+import itertools
+import logging
+
+from . import models
+from .utils import format_bytes, format_duration, paginate
+
+FETCH_BUG = "GET /show_bug.cgi"
+FETCH_ATTACHMENT = "GET /attachment.cgi"
+SEARCH_USER = "GET /users?search="
+LOOKUP_USER = "GET /users?username="
+CREATE_MILESTONE = "POST /projects/:id/milestones"
+UPLOAD = "POST /projects/:id/uploads"
+IS_ADMIN = "GET /users/:id"
+SET_ADMIN = "PUT /users/:id?admin= (non-admin users only)"
+CREATE_ISSUE = "POST /projects/:id/issues"
+CREATE_NOTE = "POST /projects/:id/issues/:iid/notes"
+CREATE_NOTES_GRAPHQL = "POST /api/graphql (createNote)"
+BUG_HISTORY = "GET /rest/bug/:id/history"
+CLOSE_ISSUE = "PUT /projects/:id/issues/:iid"
+CLOSE_BUG = "PUT /rest/bug/:id"
+
+
+class MigrationPlan:
+    """
+    Totals of a migration and the number of API calls per endpoint. The calls follow
+    the logic of `IssueThread`: user lookups in `validate_user`, uploads in
+    `upload_attachments`, the temporary admin permission around every issue and note,
+    and closing issues and bugs.
+    """
+
+    def __init__(self, config, fetched=True, route=None):
+        self.conf = config
+        self.fetched = fetched
+        # picks the configuration of the target project of a bug, see routing.py
+        self.route = route or (lambda fields: config)
+        self.bugs = 0
+        self.comments = 0
+        self.live_attachments = 0
+        self.live_bytes = 0
+        self.obsolete_attachments = 0
+        self.obsolete_bytes = 0
+        self.unresolved_users = set()
+        # (project id, milestone) and (project id, label)
+        self.milestones = set()
+        self.new_milestones = set()
+        self.labels = set()
+        self.projects = Counter()
+        self.unmapped_components = set()
+        self.requests = Counter()
+
+    def add_bug(self, fields):
+        conf = self.route(fields)
+        models.set_config(conf)
+        project = conf.gitlab_project_id
+        self.bugs += 1
+        self.projects[project] += 1
+        if self.fetched:
+            self.requests[FETCH_BUG] += 1
+
+        users = [fields["reporter"], fields["assigned_to"]]
+        long_desc = [c for c in fields["long_desc"] if c.get("thetext")]
+        users.extend(c["who"] for c in long_desc)
+        for user in users:
+            if (
+                user not in self.conf.bugzilla_users
+                and user not in self.unresolved_users
+            ):
+                self.unresolved_users.add(user)
+                self.requests[SEARCH_USER] += 1
+                self.requests[LOOKUP_USER] += 1
+
+        attachments = {a["attachid"]: a for a in fields.get("attachment", [])}
+        for attachment in attachments.values():
+            if attachment["isobsolete"] == "1":
+                self.obsolete_attachments += 1
+                self.obsolete_bytes += attachment_size(attachment)
+            else:
+                self.live_attachments += 1
+                self.live_bytes += attachment_size(attachment)
+        uploads = set(
+            c["attachid"] for c in long_desc if c.get("attachid") in attachments
+        )
+        self.requests[UPLOAD] += len(
+            [a for a in uploads if attachments[a]["isobsolete"] != "1"]
+        )
+        if (
+            self.fetched
+            and conf.bugzilla_attachments_on_demand
+            and conf.bugzilla_source != "database"
+        ):
+            # the data of the uploads is read separately
+            self.requests[FETCH_ATTACHMENT] += len(
+                [a for a in uploads if attachments[a]["isobsolete"] != "1"]
+            )
+
+        milestone = fields.get("target_milestone")
+        if conf.map_milestones and milestone not in conf.milestones_to_skip:
+            self.milestones.add((project, milestone))
+            if (
+                milestone not in conf.gitlab_milestones
+                and (project, milestone) not in self.new_milestones
+            ):
+                self.new_milestones.add((project, milestone))
+                self.requests[CREATE_MILESTONE] += 1
+
+        try:
+            labels = models.get_labels(
+                fields["component"],
+                fields.get("op_sys"),
+                fields.get("keywords"),
+                fields["bug_severity"],
+                fields["status_whiteboard"],
+            )
+            self.labels.update((project, label) for label in labels)
+        except models.UnmappedComponentError:
+            # the migration would stop here, report it instead
+            self.unmapped_components.add(fields["component"])
+
+        # the first comment becomes the description if the reporter wrote it
+        notes = len(long_desc)
+        comments = fields["long_desc"]
+        if (
+            comments
+            and comments[0]["who"] == fields["reporter"]
+            and comments[0].get("thetext")
+        ):
+            notes -= 1
+        self.comments += notes
+        self.requests[CREATE_ISSUE] += 1
+        if conf.note_backend == "graphql":
+            # consecutive notes of the same user are batched, without `admin_permission`
+            first = len(long_desc) - notes
+            authors = [c["who"] for c in long_desc[first:]]
+            for _, run in itertools.groupby(authors):
+                self.requests[CREATE_NOTES_GRAPHQL] += -(
+                    -len(list(run)) // conf.graphql_note_batch_size
+                )
+            notes = 0
+        else:
+            self.requests[CREATE_NOTE] += notes
+        # every issue and note is created inside `admin_permission`
+        self.requests[IS_ADMIN] += 1 + notes
+        self.requests[SET_ADMIN] += 2 * (1 + notes)
+
+        if fields["bug_status"] in self.conf.bugzilla_closed_states:
+            self.requests[BUG_HISTORY] += 1
+            self.requests[CLOSE_ISSUE] += 1
+        if self.conf.close_bugzilla_bugs:
+            self.requests[CLOSE_BUG] += 1
+
+    def load_existing_labels(self):
+        """
+        Look up the labels that already exist in the GitLab projects, as (project id, label).
+        """
+        existing = set()
+        for project in self.projects:
+            url = "{}/projects/{}/labels".format(self.conf.gitlab_base_url, project)
+            try:
+                existing.update(
+                    (project, label["name"])
+                    for label in paginate(
+                        url,
+                        headers=self.conf.default_headers,
+                        verify=self.conf.verify,
+                        prefetch=1,
+                    )
+                )
+            except Exception as e:
+                logging.error(
+                    "Could not load the labels of GitLab project {}: {}".format(
+                        project, e
+                    )
+                )
+                return None
+        return existing
+
+    def estimate(self, rate, concurrency, latency, bandwidth, admin_users=False):
+        """
+        Project the wall-clock time in seconds from the request rate limit (requests per
+        second), the number of concurrent requests, the average request latency in seconds
+        and the total upload bandwidth in bytes per second, which concurrent uploads share.
+        """
+        requests = self.total_requests(admin_users)
+        by_rate = requests / rate if rate else 0
+        by_latency = requests * latency / concurrency
+        transfer = self.live_bytes / bandwidth if bandwidth else 0
+        return max(by_rate, by_latency + transfer)
+
+    def total_requests(self, admin_users=False):
+        return sum(
+            count
+            for endpoint, count in self.requests.items()
+            if not (admin_users and endpoint == SET_ADMIN)
+        )
+
+    def report(self, rate, concurrency, latency, bandwidth, existing_labels=None):
+        lines = [
+            "Bugs:                 {}".format(self.bugs),
+            "Comments (notes):     {}".format(self.comments),
+            "Live attachments:     {} ({})".format(
+                self.live_attachments, format_bytes(self.live_bytes)
+            ),
+            "Obsolete attachments: {} ({})".format(
+                self.obsolete_attachments, format_bytes(self.obsolete_bytes)
+            ),
+            "Users to resolve:     {}".format(len(self.unresolved_users)),
+            "Milestones:           {} ({} new)".format(
+                len(self.milestones), len(self.new_milestones)
+            ),
+        ]
+        if existing_labels is None:
+            lines.append("Labels:               {}".format(len(self.labels)))
+        else:
+            lines.append(
+                "Labels:               {} ({} new)".format(
+                    len(self.labels), len(self.labels - existing_labels)
+                )
+            )
+        if len(self.projects) > 1:
+            lines.append(
+                "Bugs per GitLab project: {}".format(
+                    ", ".join(
+                        "{}: {}".format(project, count)
+                        for project, count in sorted(self.projects.items(), key=str)
+                    )
+                )
+            )
+        if self.unmapped_components:
+            lines.append(
+                "Components without mapping: {}".format(
+                    ", ".join(sorted(self.unmapped_components))
+                )
+            )
+
+        lines.append("")
+        lines.append("API calls per endpoint:")
+        for endpoint, count in sorted(self.requests.items(), key=lambda item: -item[1]):
+            lines.append("  {:>9}  {}".format(count, endpoint))
+        lines.append(
+            "  {:>9}  total ({} if all users are admins)".format(
+                self.total_requests(), self.total_requests(admin_users=True)
+            )
+        )
+
+        lines.append("")
+        lines.append(
+            "Estimated time at {} requests/s, {} concurrent requests, {}s latency, "
+            "{}/s upload:".format(rate, concurrency, latency, format_bytes(bandwidth))
+        )
+        lines.append(
+            "  {} ({} if all users are admins)".format(
+                format_duration(self.estimate(rate, concurrency, latency, bandwidth)),
+                format_duration(
+                    self.estimate(
+                        rate, concurrency, latency, bandwidth, admin_users=True
+                    )
+                ),
+            )
+        )
+        return "\n".join(lines)
+
+
+def attachment_size(attachment):
+    if attachment.get("size"):
+        return int(attachment["size"])
+    if attachment.get("data"):
+        return len(base64.b64decode(attachment["data"]))
+    return 0
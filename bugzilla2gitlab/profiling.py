@@ -0,0 +1,215 @@
+"""
+Profiling of single bugs, to find out why a bug is slow or needs a lot of memory.
+
+Every bug is profiled with cProfile (the thread migrating the bug) or with a sampling
+profiler (all threads, including the note and attachment workers), optionally together
+with tracemalloc. Only the N slowest and the N largest bugs are kept and written to the
+profile directory:
+
+    bug-<id>.prof       pstats file (cProfile), e.g. for snakeviz or flameprof
+    bug-<id>.folded     collapsed stacks (sampling), e.g. for flamegraph.pl or speedscope
+    bug-<id>.alloc.txt  allocation summary (tracemalloc)
+    summary.txt         the slowest and the largest bugs
+"""
+
+from collections import Counter
+import contextlib
+import cProfile
+import heapq
+import itertools
+import logging
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+CPROFILE = "cprofile"
+SAMPLING = "sampling"
+
+
+class BugProfile:
+    """
+    Measurements of a single bug.
+    """
+
+    def __init__(self, bug_id):
+        self.bug_id = bug_id
+        self.seconds = 0
+        self.peak_memory = 0
+        self.stats = None
+        self.stacks = None
+        self.allocations = None
+
+
+class BugProfiler:
+    """
+    Profile bugs one after another and keep the slowest and the largest ones.
+    """
+
+    def __init__(self, output_dir, mode=CPROFILE, top=10, memory=False, interval=0.005):
+        if mode not in (CPROFILE, SAMPLING):
+            raise Exception("Unknown profiler: {}".format(mode))
+        self.output_dir = output_dir
+        self.mode = mode
+        self.top = top
+        self.memory = memory
+        self.interval = interval
+        self.slowest = []
+        self.largest = []
+        # tie breaker for the heaps
+        self.counter = itertools.count()
+
+    @contextlib.contextmanager
+    def profile(self, bug_id):
+        result = BugProfile(bug_id)
+        if self.memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start(25)
+            tracemalloc.clear_traces()
+        profiler = (
+            cProfile.Profile() if self.mode == CPROFILE else StackSampler(self.interval)
+        )
+
+        started = time.perf_counter()
+        profiler.enable()
+        try:
+            yield result
+        finally:
+            profiler.disable()
+            result.seconds = time.perf_counter() - started
+            if self.memory:
+                result.peak_memory = tracemalloc.get_traced_memory()[1]
+            if self.is_top(result):
+                if self.mode == CPROFILE:
+                    result.stats = profiler
+                else:
+                    result.stacks = profiler.stacks
+                if self.memory:
+                    result.allocations = tracemalloc.take_snapshot().statistics(
+                        "traceback"
+                    )
+                self.keep(result)
+
+    def is_top(self, result):
+        """
+        Tell whether a bug is among the slowest or the largest so far.
+        """
+        if len(self.slowest) < self.top or result.seconds > self.slowest[0][0]:
+            return True
+        if self.memory:
+            return (
+                len(self.largest) < self.top or result.peak_memory > self.largest[0][0]
+            )
+        return False
+
+    def keep(self, result):
+        count = next(self.counter)
+        _push(self.slowest, (result.seconds, count, result), self.top)
+        if self.memory:
+            _push(self.largest, (result.peak_memory, count, result), self.top)
+
+    def results(self):
+        kept = {}
+        for _, _, result in self.slowest + self.largest:
+            kept[result.bug_id] = result
+        return list(kept.values())
+
+    def write(self):
+        """
+        Write the profiles of the kept bugs and a summary to the output directory.
+        """
+        os.makedirs(self.output_dir, exist_ok=True)
+        for result in self.results():
+            path = os.path.join(self.output_dir, "bug-{}".format(result.bug_id))
+            if result.stats is not None:
+                result.stats.dump_stats(path + ".prof")
+            if result.stacks is not None:
+                with open(path + ".folded", "w") as f:
+                    for stack, count in sorted(result.stacks.items()):
+                        f.write("{} {}\n".format(stack, count))
+            if result.allocations is not None:
+                with open(path + ".alloc.txt", "w") as f:
+                    f.write(format_allocations(result))
+
+        lines = ["Slowest bugs:"]
+        for seconds, _, result in sorted(self.slowest, reverse=True):
+            lines.append("  bug {:>8}  {:8.2f}s".format(result.bug_id, seconds))
+        if self.memory:
+            lines.append("")
+            lines.append("Largest bugs (peak traced memory):")
+            for peak, _, result in sorted(self.largest, reverse=True):
+                lines.append(
+                    "  bug {:>8}  {:8.1f} MB".format(result.bug_id, peak / 1e6)
+                )
+        summary = "\n".join(lines)
+        with open(os.path.join(self.output_dir, "summary.txt"), "w") as f:
+            f.write(summary + "\n")
+        logging.info("Profiles written to {}".format(self.output_dir))
+        return summary
+
+
+class StackSampler:
+    """
+    Sampling profiler that records the stacks of all threads in collapsed format
+    ("thread;outer (file:line);...;inner (file:line)" -> number of samples). Frames are
+    identified by the first line of their function, so that they merge in flame graphs.
+    """
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.stacks = Counter()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def enable(self):
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def disable(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        names = {}
+        while not self.stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == self.thread.ident:
+                    continue
+                if thread_id not in names:
+                    names = {t.ident: t.name for t in threading.enumerate()}
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(
+                        "{} ({}:{})".format(
+                            code.co_name,
+                            os.path.basename(code.co_filename),
+                            code.co_firstlineno,
+                        )
+                    )
+                    frame = frame.f_back
+                stack.append(names.get(thread_id, str(thread_id)))
+                self.stacks[";".join(reversed(stack))] += 1
+
+
+def _push(heap, item, size):
+    if len(heap) < size:
+        heapq.heappush(heap, item)
+    else:
+        heapq.heappushpop(heap, item)
+
+
+def format_allocations(result, limit=20):
+    lines = [
+        "Bug {}: {:.1f} MB peak traced memory, {:.2f}s".format(
+            result.bug_id, result.peak_memory / 1e6, result.seconds
+        ),
+        "",
+        "Largest allocations still alive at the end of the bug:",
+    ]
+    for stat in result.allocations[:limit]:
+        lines.append("")
+        lines.append("{:.1f} kB in {} blocks".format(stat.size / 1e3, stat.count))
+        lines.extend(stat.traceback.format(limit=8))
+    return "\n".join(lines) + "\n"
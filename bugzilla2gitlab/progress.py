@@ -0,0 +1,254 @@
+"""
+Live progress of a migration: a status line on the terminal and/or a JSON status file
+for headless runs, updated in the background.
+
+The models and the migrator only increment counters (see `count`), which is cheap
+enough to do for every request. Rates are moving averages over the last minute or so,
+the ETA is based on the rate of finished bugs.
+"""
+
+from collections import Counter
+import json
+import math
+import os
+import sys
+import threading
+import time
+
+from .utils import format_bytes, format_duration
+
+# Counters
+FETCHED = "fetched"
+ISSUES = "issues"
+NOTES = "notes"
+BYTES = "bytes"
+BUGS = "bugs"
+FAILED = "failed"
+
+# Rates are averaged over about this many seconds
+RATE_WINDOW = 60.0
+
+CURRENT = None
+
+
+def count(name, amount=1):
+    """
+    Add to a counter of the current progress, if any.
+    """
+    progress = CURRENT
+    if progress is not None:
+        progress.add(name, amount)
+
+
+def count_error(kind):
+    progress = CURRENT
+    if progress is not None:
+        progress.add_error(kind)
+
+
+def expect(notes=0, size=0):
+    """
+    Add the notes and attachment bytes of a bug that is about to be migrated.
+    """
+    progress = CURRENT
+    if progress is not None:
+        progress.add("expected_notes", notes)
+        progress.add("expected_bytes", size)
+
+
+class Progress:
+    """
+    Counters of a migration and the reporter thread that shows them.
+    """
+
+    def __init__(self, show=True, status_file=None, interval=1.0, stream=None):
+        self.stream = stream or sys.stdout
+        self.show = show and self.stream.isatty()
+        self.status_file = status_file
+        self.interval = interval
+        self.total = None
+        self.counters = Counter()
+        self.errors = Counter()
+        self.rates = {}
+        self.lock = threading.Lock()
+        self.output_lock = threading.RLock()
+        self.started = None
+        self.last = None
+        self.last_counters = Counter()
+        self.stopped = threading.Event()
+        self.thread = None
+        self.writer = None
+        self.original_stdout = None
+
+    def add(self, name, amount=1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def add_error(self, kind):
+        with self.lock:
+            self.errors[kind] += 1
+
+    def start(self, total=None):
+        global CURRENT
+        self.total = total
+        self.started = self.last = time.monotonic()
+        self.started_at = time.strftime("%Y-%m-%dT%H:%M:%S")
+        CURRENT = self
+        if self.show:
+            # keep the status line below everything else that is printed
+            self.original_stdout = sys.stdout
+            self.writer = _StatusLineWriter(self, sys.stdout)
+            sys.stdout = self.writer
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        global CURRENT
+        self.stopped.set()
+        self.thread.join()
+        self.update()
+        if self.show:
+            sys.stdout = self.original_stdout
+            self.stream.write("\r\x1b[K" + self.status_line() + "\n")
+            self.stream.flush()
+        CURRENT = None
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.update()
+
+    def update(self):
+        now = time.monotonic()
+        with self.lock:
+            counters = Counter(self.counters)
+        elapsed = now - self.last
+        if elapsed > 0:
+            # exponentially weighted moving average over about RATE_WINDOW seconds
+            weight = 1 - math.exp(-elapsed / RATE_WINDOW)
+            for name in [FETCHED, ISSUES, NOTES, BYTES, BUGS]:
+                rate = (counters[name] - self.last_counters[name]) / elapsed
+                if name in self.rates:
+                    self.rates[name] += weight * (rate - self.rates[name])
+                else:
+                    self.rates[name] = rate
+        self.last = now
+        self.last_counters = counters
+
+        if self.show:
+            self.writer.redraw()
+        if self.status_file:
+            self.write_status()
+
+    def remaining(self):
+        counters = self.last_counters
+        remaining = {}
+        if self.total is not None:
+            remaining[BUGS] = max(0, self.total - counters[BUGS] - counters[FAILED])
+        if counters["expected_notes"]:
+            remaining[NOTES] = max(0, counters["expected_notes"] - counters[NOTES])
+        if counters["expected_bytes"]:
+            remaining[BYTES] = max(0, counters["expected_bytes"] - counters[BYTES])
+        return remaining
+
+    def eta(self):
+        """
+        Seconds until all bugs are migrated, at the current rate.
+        """
+        remaining = self.remaining().get(BUGS)
+        rate = self.rates.get(BUGS)
+        if remaining is None or not rate:
+            return None
+        return remaining / rate
+
+    def status(self):
+        counters = self.last_counters
+        remaining = self.remaining()
+        return {
+            "started_at": self.started_at,
+            "updated_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "elapsed": round(time.monotonic() - self.started, 1),
+            "bugs": {
+                "total": self.total,
+                "done": counters[BUGS],
+                "failed": counters[FAILED],
+                "remaining": remaining.get(BUGS),
+            },
+            "notes": {"done": counters[NOTES], "remaining": remaining.get(NOTES)},
+            "bytes": {"done": counters[BYTES], "remaining": remaining.get(BYTES)},
+            "issues": counters[ISSUES],
+            "fetched": counters[FETCHED],
+            "rates": {name: round(rate, 3) for name, rate in self.rates.items()},
+            "errors": dict(self.errors),
+            "eta": None if self.eta() is None else round(self.eta()),
+        }
+
+    def write_status(self):
+        # replace the file at once, so that readers never see half of it
+        temp_file = self.status_file + ".tmp"
+        with open(temp_file, "w") as f:
+            json.dump(self.status(), f, indent=2)
+        os.replace(temp_file, self.status_file)
+
+    def status_line(self):
+        counters = self.last_counters
+        remaining = self.remaining()
+        bugs = "{}".format(counters[BUGS])
+        if self.total is not None:
+            bugs += "/{}".format(self.total)
+        parts = [
+            "bugs {} ({:.2f}/s)".format(bugs, self.rates.get(BUGS, 0)),
+            "notes {}{} ({:.1f}/s)".format(
+                counters[NOTES],
+                " +{}".format(remaining[NOTES]) if NOTES in remaining else "",
+                self.rates.get(NOTES, 0),
+            ),
+            "uploads {}{} ({}/s)".format(
+                format_bytes(counters[BYTES]),
+                (
+                    " +{}".format(format_bytes(remaining[BYTES]))
+                    if BYTES in remaining
+                    else ""
+                ),
+                format_bytes(self.rates.get(BYTES, 0)),
+            ),
+        ]
+        errors = sum(self.errors.values())
+        if counters[FAILED] or errors:
+            parts.append("failed {} errors {}".format(counters[FAILED], errors))
+        eta = self.eta()
+        if eta is not None:
+            parts.append("ETA {}".format(format_duration(eta)))
+        return " | ".join(parts)
+
+
+class _StatusLineWriter:
+    """
+    Stand-in for sys.stdout that keeps the status line at the bottom of the terminal.
+    """
+
+    def __init__(self, progress, stream):
+        self.progress = progress
+        self.stream = stream
+        self.line_start = True
+
+    def write(self, text):
+        with self.progress.output_lock:
+            if self.line_start:
+                self.stream.write("\r\x1b[K")
+            self.stream.write(text)
+            self.line_start = text.endswith("\n")
+            if self.line_start:
+                self.stream.write(self.progress.status_line())
+                self.stream.flush()
+
+    def redraw(self):
+        with self.progress.output_lock:
+            if self.line_start:
+                self.stream.write("\r\x1b[K" + self.progress.status_line())
+                self.stream.flush()
+
+    def flush(self):
+        self.stream.flush()
+
+    def __getattr__(self, name):
+        return getattr(self.stream, name)
@@ -0,0 +1,253 @@
+"""
+Bulk provisioning of the GitLab users a migration needs.
+
+The wanted users are read from user_mappings.yml or from the members of a group or project
+on another GitLab instance. They are compared with the users and the members of the
+target project (or group), and the missing users and memberships are created
+concurrently, under a request rate limit.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import logging
+
+import yaml
+
+from .utils import _perform_request, paginate, RateLimiter, RequestError
+
+# GitLab access levels
+DEVELOPER = 30
+
+# Up to this many users are looked up by username, more are found by listing all users
+LOOKUP_THRESHOLD = 500
+
+
+def users_from_mappings(user_mappings_file, misc_user=None, access_level=DEVELOPER):
+    """
+    The GitLab users of user_mappings.yml, with the Bugzilla login as email address.
+    """
+    with open(user_mappings_file) as f:
+        mappings = yaml.safe_load(f) or {}
+
+    users = {}
+    for bugzilla_user, gitlab_user in mappings.items():
+        if gitlab_user not in users:
+            users[gitlab_user] = {
+                "username": gitlab_user,
+                "name": gitlab_user,
+                "email": bugzilla_user,
+                "access_level": access_level,
+            }
+    if misc_user and misc_user not in users:
+        users[misc_user] = {
+            "username": misc_user,
+            "name": misc_user,
+            "access_level": access_level,
+        }
+    return list(users.values())
+
+
+def users_from_members(base_url, headers, source, verify=True):
+    """
+    Stream the members of a group or project, e.g. on another GitLab instance.
+    """
+    for member in paginate(
+        members_url(base_url, source), headers=headers, verify=verify
+    ):
+        yield {
+            "username": member["username"],
+            "name": member["name"],
+            "email": member.get("email") or member.get("public_email"),
+            "access_level": member["access_level"],
+        }
+
+
+def members_url(base_url, target):
+    """
+    target: ("projects", id) or ("groups", id)
+    """
+    return "{}/{}/{}/members".format(base_url, target[0], target[1])
+
+
+class Provisioner:
+    """
+    Creates users and memberships in a GitLab instance.
+    """
+
+    def __init__(
+        self,
+        base_url,
+        headers,
+        verify=True,
+        concurrency=8,
+        rate=10,
+        dry_run=False,
+        skip_confirmation=False,
+        email_template=None,
+    ):
+        self.base_url = base_url
+        self.headers = headers
+        self.verify = verify
+        self.concurrency = concurrency
+        self.limiter = RateLimiter(rate)
+        self.dry_run = dry_run
+        self.skip_confirmation = skip_confirmation
+        # e.g. "{username}@users.example.com" for users without a known email address
+        self.email_template = email_template
+
+    def existing_users(self, usernames):
+        """
+        Map the given usernames to the ids of existing users. Each username is looked up
+        on its own, unless there are more than LOOKUP_THRESHOLD of them: then all users
+        of the instance are listed instead.
+        """
+        if len(usernames) <= LOOKUP_THRESHOLD:
+            with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+                found = executor.map(self.find_user, sorted(usernames))
+            return {user["username"]: user["id"] for user in found if user}
+
+        ids = {}
+        users = paginate(
+            "{}/users".format(self.base_url),
+            headers=self.headers,
+            verify=self.verify,
+            keyset=True,
+            prefetch=2,
+        )
+        for user in users:
+            if user["username"] in usernames:
+                ids[user["username"]] = user["id"]
+        return ids
+
+    def find_user(self, username):
+        """
+        The user with the given username, None if there is none.
+        """
+        self.limiter.wait()
+        users = _perform_request(
+            "{}/users".format(self.base_url),
+            "get",
+            params={"username": username},
+            headers=self.headers,
+            verify=self.verify,
+        )
+        # the username filter is case insensitive
+        for user in users:
+            if user["username"] == username:
+                return user
+        return None
+
+    def provision(self, users, target):
+        """
+        Create the missing users and add them to the target project or group.
+        Returns the ids of all users that exist afterwards and the users that failed.
+        """
+        usernames = set(user["username"] for user in users)
+        ids = self.existing_users(usernames)
+        members = set(
+            member["username"]
+            for member in paginate(
+                members_url(self.base_url, target) + "/all",
+                headers=self.headers,
+                verify=self.verify,
+                prefetch=1,
+            )
+        )
+        print(
+            "{} users wanted, {} exist, {} are members of {} {}".format(
+                len(usernames),
+                len(ids),
+                len(members & usernames),
+                target[0][:-1],
+                target[1],
+            )
+        )
+
+        pending = [
+            user
+            for user in users
+            if user["username"] not in ids or user["username"] not in members
+        ]
+        failed = []
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            results = executor.map(
+                lambda user: self.provision_user(
+                    user,
+                    ids.get(user["username"]),
+                    user["username"] not in members,
+                    target,
+                ),
+                pending,
+            )
+            for user, (uid, error) in zip(pending, results):
+                if error:
+                    failed.append((user["username"], error))
+                elif uid is not None:
+                    ids[user["username"]] = uid
+        return ids, failed
+
+    def provision_user(self, user, uid, add_member, target):
+        """
+        Create a user unless it exists and make it a member of the target.
+        Returns the user id and the error, if any.
+        """
+        try:
+            if uid is None:
+                uid = self.create_user(user)
+            if add_member:
+                self.add_member(target, uid, user)
+        except Exception as e:
+            logging.error("Failed to provision user {}: {}".format(user["username"], e))
+            return uid, str(e)
+        return uid, None
+
+    def create_user(self, user):
+        email = user.get("email")
+        if not email and self.email_template:
+            email = self.email_template.format(**user)
+        if not email:
+            raise Exception("No email address for user {}".format(user["username"]))
+        data = {
+            "email": email,
+            "username": user["username"],
+            "name": user.get("name") or user["username"],
+            "force_random_password": True,
+            "skip_confirmation": self.skip_confirmation,
+        }
+        self.limiter.wait()
+        print("Creating user {}".format(user["username"]))
+        result = _perform_request(
+            "{}/users".format(self.base_url),
+            "post",
+            data=data,
+            headers=self.headers,
+            dry_run=self.dry_run,
+            verify=self.verify,
+        )
+        if self.dry_run:
+            return None
+        return result["id"]
+
+    def add_member(self, target, uid, user):
+        if uid is None:
+            # dry run
+            return
+        data = {"user_id": uid, "access_level": user.get("access_level", DEVELOPER)}
+        self.limiter.wait()
+        print(
+            "Adding user {} to {} {}".format(
+                user["username"], target[0][:-1], target[1]
+            )
+        )
+        try:
+            _perform_request(
+                members_url(self.base_url, target),
+                "post",
+                data=data,
+                headers=self.headers,
+                dry_run=self.dry_run,
+                verify=self.verify,
+            )
+        except RequestError as e:
+            # already a member
+            if e.status_code != 409:
+                raise
@@ -0,0 +1,275 @@
+"""
+Cross-references between migrated bugs, resolved after the migration.
+
+Migrated issues link to other bugs through show_bug.cgi: bug references in the text of
+the description and the notes (see `find_bug_links`) and the "Depends on", "Blocks",
+"See also" and duplicate links of the description table. While migrating, the journal
+records the bugs every issue links to. Once the bugs are migrated, `Relinker` points
+the links to bugs in the journal at their GitLab issues, and turns the dependencies
+between them into GitLab issue links. Only issues with such links are read (up to 100
+per request) and edited; links to bugs that were not migrated are kept.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import re
+import threading
+
+from .utils import _perform_request, get_gitlab_project, paginate, RequestError
+
+# Issues read per request
+BATCH_SIZE = 100
+
+# The row with the link to the bug itself, which is kept
+OWN_LINK_ROW = "| Bugzilla Link |"
+
+
+def _link_pattern(bugzilla_url):
+    # the target of a markdown link to a bug, e.g. ](https://bugzilla/show_bug.cgi?id=12#c3)
+    return re.compile(
+        r"\]\("
+        + re.escape(bugzilla_url)
+        + r"/show_bug\.cgi\?id=([0-9]+)(?:#c[0-9]+)?\)"
+    )
+
+
+def referenced_bugs(text, bugzilla_url):
+    """
+    The ids of the bugs a markdown text links to, in order of first appearance.
+    """
+    bugs = []
+    pattern = _link_pattern(bugzilla_url)
+    for line in (text or "").split("\n"):
+        if line.startswith(OWN_LINK_ROW):
+            continue
+        for bug_id in pattern.findall(line):
+            if bug_id not in bugs:
+                bugs.append(bug_id)
+    return bugs
+
+
+def rewrite_links(text, bugzilla_url, issue_urls):
+    """
+    Point the links to bugs in `issue_urls` (bug id: issue URL) at their issues.
+    """
+    pattern = _link_pattern(bugzilla_url)
+
+    def replace(match):
+        url = issue_urls.get(match.group(1))
+        if url is None:
+            return match.group(0)
+        return "]({})".format(url)
+
+    return "\n".join(
+        line if line.startswith(OWN_LINK_ROW) else pattern.sub(replace, line)
+        for line in text.split("\n")
+    )
+
+
+class Relinker:
+    """
+    Resolve the cross-references of the bugs in a journal, see `run`.
+    """
+
+    def __init__(self, config, journal, concurrency=4):
+        self.conf = config
+        self.journal = journal
+        self.concurrency = concurrency
+        # bug id -> (project id, issue iid)
+        self.index = {}
+        self.web_urls = {}
+        self.lock = threading.Lock()
+        self.descriptions = 0
+        self.notes = 0
+        self.links = 0
+
+    def load(self):
+        """
+        Read the journal into the index. Returns the entries of the issues that link to
+        migrated bugs, by project, and the dependencies between migrated bugs.
+        """
+        candidates = []
+        dependencies = set()
+        for bug_id, entry in self.journal.entries():
+            project_id = str(entry.get("project_id", self.conf.gitlab_project_id))
+            self.index[str(bug_id)] = (project_id, entry["issue_iid"])
+            # only what is needed later, not the comment keys
+            candidates.append(
+                (
+                    str(bug_id),
+                    {
+                        key: entry[key]
+                        for key in ("issue_iid", "description_refs", "note_refs")
+                        if key in entry
+                    },
+                )
+            )
+            for blocker in entry.get("dependson", []):
+                dependencies.add((blocker, str(bug_id)))
+            for blocked in entry.get("blocked", []):
+                dependencies.add((str(bug_id), blocked))
+
+        issues = {}
+        for bug_id, entry in candidates:
+            if "description_refs" in entry:
+                # entries of older versions do not know their links and are always read
+                references = entry["description_refs"] + entry["note_refs"]
+                if not any(bug in self.index for bug in references):
+                    continue
+            issues.setdefault(self.index[bug_id][0], []).append(entry)
+        dependencies = sorted(
+            (blocker, blocked)
+            for blocker, blocked in dependencies
+            if blocker in self.index and blocked in self.index
+        )
+        return issues, dependencies
+
+    def issue_url(self, bug_id):
+        project_id, iid = self.index[bug_id]
+        with self.lock:
+            web_url = self.web_urls.get(project_id)
+            if web_url is None:
+                web_url = self.web_urls[project_id] = get_gitlab_project(
+                    self.conf.gitlab_base_url,
+                    project_id,
+                    self.conf.default_headers,
+                    self.conf.verify,
+                )["web_url"]
+        return "{}/-/issues/{}".format(web_url, iid)
+
+    def issue_urls(self, text):
+        return {
+            bug_id: self.issue_url(bug_id)
+            for bug_id in referenced_bugs(text, self.conf.bugzilla_base_url)
+            if bug_id in self.index
+        }
+
+    def run(self):
+        issues, dependencies = self.load()
+        logging.info(
+            "Relinking {} issue(s) and {} dependencies between {} migrated bug(s)".format(
+                sum(len(entries) for entries in issues.values()),
+                len(dependencies),
+                len(self.index),
+            )
+        )
+
+        with ThreadPoolExecutor(max_workers=max(1, self.concurrency)) as executor:
+            futures = []
+            for project_id, entries in issues.items():
+                for start in range(0, len(entries), BATCH_SIZE):
+                    end = start + BATCH_SIZE
+                    batch = {entry["issue_iid"]: entry for entry in entries[start:end]}
+                    url = "{}/projects/{}/issues".format(
+                        self.conf.gitlab_base_url, project_id
+                    )
+                    params = {"iids[]": sorted(batch), "scope": "all"}
+                    for issue in paginate(
+                        url,
+                        params=params,
+                        headers=self.conf.default_headers,
+                        verify=self.conf.verify,
+                        prefetch=1,
+                    ):
+                        futures.append(
+                            executor.submit(
+                                self.relink_issue,
+                                project_id,
+                                issue,
+                                batch[issue["iid"]],
+                            )
+                        )
+            futures.extend(
+                executor.submit(self.link_issues, blocker, blocked)
+                for blocker, blocked in dependencies
+            )
+            for future in futures:
+                future.result()
+
+        summary = "Relinked {} description(s) and {} note(s), created {} issue link(s)".format(
+            self.descriptions, self.notes, self.links
+        )
+        logging.info(summary)
+        return summary
+
+    def relink_issue(self, project_id, issue, entry):
+        url = "{}/projects/{}/issues/{}".format(
+            self.conf.gitlab_base_url, project_id, issue["iid"]
+        )
+        description = issue.get("description") or ""
+        issue_urls = self.issue_urls(description)
+        if issue_urls:
+            _perform_request(
+                url,
+                "put",
+                headers=self.conf.default_headers,
+                data={
+                    "description": rewrite_links(
+                        description, self.conf.bugzilla_base_url, issue_urls
+                    )
+                },
+                dry_run=self.conf.dry_run,
+                verify=self.conf.verify,
+            )
+            with self.lock:
+                self.descriptions += 1
+
+        if "note_refs" in entry and not any(
+            bug in self.index for bug in entry["note_refs"]
+        ):
+            return
+        for note in paginate(
+            url + "/notes", headers=self.conf.default_headers, verify=self.conf.verify
+        ):
+            if note.get("system"):
+                continue
+            issue_urls = self.issue_urls(note["body"])
+            if not issue_urls:
+                continue
+            # notes are edited by their authors
+            headers = dict(self.conf.default_headers, sudo=str(note["author"]["id"]))
+            _perform_request(
+                "{}/notes/{}".format(url, note["id"]),
+                "put",
+                headers=headers,
+                data={
+                    "body": rewrite_links(
+                        note["body"], self.conf.bugzilla_base_url, issue_urls
+                    )
+                },
+                dry_run=self.conf.dry_run,
+                verify=self.conf.verify,
+            )
+            with self.lock:
+                self.notes += 1
+
+    def link_issues(self, blocker, blocked):
+        """
+        Link the issue of a bug to the issue of a bug it blocks.
+        """
+        project_id, iid = self.index[blocker]
+        target_project_id, target_iid = self.index[blocked]
+        url = "{}/projects/{}/issues/{}/links".format(
+            self.conf.gitlab_base_url, project_id, iid
+        )
+        data = {
+            "target_project_id": target_project_id,
+            "target_issue_iid": target_iid,
+            "link_type": "blocks" if self.conf.gitlab_blocking_links else "relates_to",
+        }
+        try:
+            _perform_request(
+                url,
+                "post",
+                headers=self.conf.default_headers,
+                data=data,
+                dry_run=self.conf.dry_run,
+                verify=self.conf.verify,
+            )
+        except RequestError as e:
+            if e.status_code != 409:
+                raise
+            # linked by an earlier run
+            return
+        with self.lock:
+            self.links += 1
@@ -0,0 +1,90 @@
+"""
+Routing of bugs to several GitLab projects in a single migration.
+
+The rules in project_routes.yml map the product and/or component of a bug to a GitLab
+project, the first matching rule wins. Bugs that match no rule go to the project of
+defaults.yml:
+
+    - component: ["Core", "Runtime"]
+      project: "eclipse/core"
+    - product: "Platform"
+      project: 42
+      # optional, extends component_mappings.yml for this project
+      component_mappings:
+        UI: ui
+
+Every project gets its own configuration, with its own milestone and label tables. The
+user caches are shared between all projects.
+"""
+
+from .config import _load_milestone_id_cache
+from .utils import get_gitlab_project
+
+
+def _matches(value, expected):
+    if expected is None:
+        return True
+    if isinstance(expected, list):
+        return value in expected
+    return value == expected
+
+
+class ProjectRouter:
+    """
+    Pick the configuration of the target project of a bug.
+    """
+
+    def __init__(self, config):
+        self.default = config
+        self.routes = []
+        self.targets = {str(config.gitlab_project_id): config}
+        for route in config.project_routes:
+            self.routes.append((route, self._add_target(route)))
+
+    def _add_target(self, route):
+        conf = self.default
+        project = get_gitlab_project(
+            conf.gitlab_base_url, route["project"], conf.default_headers, conf.verify
+        )
+        target = self.targets.get(str(project["id"]))
+        if target is not None:
+            return target
+
+        print(
+            "Routing bugs to GitLab project {} ({})".format(
+                project["path_with_namespace"], project["id"]
+            )
+        )
+        milestones = {}
+        if conf.map_milestones:
+            milestones = _load_milestone_id_cache(
+                project["id"], conf.gitlab_base_url, conf.default_headers, conf.verify
+            )["gitlab_milestones"]
+        target = conf._replace(
+            gitlab_project_id=project["id"],
+            gitlab_project_name=project["path_with_namespace"],
+            gitlab_milestones=milestones,
+            component_mappings=dict(
+                conf.component_mappings, **route.get("component_mappings", {})
+            ),
+        )
+        self.targets[str(project["id"])] = target
+        return target
+
+    def route(self, fields):
+        for route, target in self.routes:
+            if _matches(fields.get("product"), route.get("product")) and _matches(
+                fields.get("component"), route.get("component")
+            ):
+                return target
+        return self.default
+
+    def target(self, project_id):
+        """
+        The configuration of a project a bug was migrated to before.
+        """
+        target = self.targets.get(str(project_id))
+        if target is None:
+            # the routes have changed since
+            target = self._add_target({"project": project_id})
+        return target
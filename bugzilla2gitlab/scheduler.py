@@ -0,0 +1,121 @@
+"""
+Scheduling of bugs on several worker threads.
+
+The cost of bugs is very uneven: most need a handful of small requests, a few carry
+hundreds of MB of attachments. Bugs are classified by their number of comments and the
+size of their live attachments. Light bugs are migrated by `bug_concurrency` workers,
+heavy bugs by `heavy_bug_concurrency` workers in a separate lane whose attachment uploads
+share the bandwidth limit `heavy_upload_bandwidth`, so that light bugs keep flowing.
+"""
+
+from collections import Counter
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
+import logging
+
+from . import models, progress
+from .planner import attachment_size
+from .utils import RateLimiter
+
+LIGHT = "light"
+HEAVY = "heavy"
+
+# Number of bugs whose size is looked up at once
+SIZE_BATCH = 50
+
+
+def bug_size(fields):
+    """
+    The number of comments and the size of the live attachments of a parsed bug.
+    """
+    comments = len([c for c in fields["long_desc"] if c.get("thetext")])
+    size = sum(
+        attachment_size(attachment)
+        for attachment in fields.get("attachment", [])
+        if attachment["isobsolete"] != "1"
+    )
+    return comments, size
+
+
+class BugScheduler:
+    """
+    Migrate bugs on a light and a heavy lane of worker threads.
+    """
+
+    def __init__(self, config, sizes=None):
+        self.conf = config
+        # returns {key: (comments, attachment bytes)} for a list of keys
+        self.sizes = sizes
+        self.upload_limiter = RateLimiter(config.heavy_upload_bandwidth)
+        self.lanes = Counter()
+
+    def classify(self, size):
+        if size is None:
+            return LIGHT
+        comments, attachment_bytes = size
+        if (
+            comments >= self.conf.heavy_comment_count
+            or attachment_bytes >= self.conf.heavy_attachment_bytes
+        ):
+            return HEAVY
+        return LIGHT
+
+    def lookup_sizes(self, keys):
+        if not self.sizes:
+            return {}
+        try:
+            return self.sizes(keys)
+        except Exception as e:
+            # the bugs are migrated anyway, on the light lane
+            logging.warning(
+                "Could not look up the size of {} bug(s): {}".format(len(keys), e)
+            )
+            return {}
+
+    def run(self, items, migrate, key=str):
+        """
+        Call `migrate` for every item (bug id, file or lease) and return the results in
+        the order of the items. Stops at the first exception and raises it.
+        """
+        light = ThreadPoolExecutor(
+            max_workers=self.conf.bug_concurrency, thread_name_prefix="bug"
+        )
+        heavy = ThreadPoolExecutor(
+            max_workers=self.conf.heavy_bug_concurrency, thread_name_prefix="heavy-bug"
+        )
+        futures = []
+        try:
+            for start in range(0, len(items), SIZE_BATCH):
+                batch = items[start : start + SIZE_BATCH]
+                sizes = self.lookup_sizes([key(item) for item in batch])
+                for item in batch:
+                    size = sizes.get(key(item))
+                    if size is not None:
+                        progress.expect(*size)
+                    lane = self.classify(size)
+                    self.lanes[lane] += 1
+                    if lane == HEAVY:
+                        logging.info(
+                            "Bug {} is heavy: {} comments, {} bytes of attachments".format(
+                                key(item), *sizes[key(item)]
+                            )
+                        )
+                        futures.append(heavy.submit(self._run_heavy, migrate, item))
+                    else:
+                        futures.append(light.submit(migrate, item))
+                if any(future.done() and future.exception() for future in futures):
+                    break
+
+            wait(futures, return_when=FIRST_EXCEPTION)
+            for future in futures:
+                if future.done() and future.exception():
+                    raise future.exception()
+            return [future.result() for future in futures]
+        finally:
+            for future in futures:
+                future.cancel()
+            light.shutdown()
+            heavy.shutdown()
+
+    def _run_heavy(self, migrate, item):
+        with models.upload_limit(self.upload_limiter):
+            return migrate(item)
@@ -0,0 +1,209 @@
+"""
+Markdown of issue descriptions and comment headers.
+
+The settings that shape the markdown (include_*, show_*, timezone, the see also link
+bases) are the same for every bug, so they are compiled once per configuration into a
+list of row functions and format strings. Rendering a bug only calls the functions and
+joins their parts.
+
+The output can be wrapped in user-defined templates (str.format syntax):
+
+    description_template  {table}, {description} and {fields[...]} (the Bugzilla fields)
+    comment_template      {header}, {body}, {date} and {fields[...]}
+"""
+
+import re
+import threading
+
+from .utils import format_datetime, markdown_table_row
+
+# Templates by configuration, see `get_templates`
+_TEMPLATES = {}
+_TEMPLATES_LOCK = threading.Lock()
+
+
+def get_templates(config):
+    """
+    The templates of a configuration, compiled on first use.
+    """
+    templates = _TEMPLATES.get(id(config))
+    if templates is None or templates.config is not config:
+        with _TEMPLATES_LOCK:
+            templates = Templates(config)
+            _TEMPLATES[id(config)] = templates
+    return templates
+
+
+def _row(key):
+    # markdown_table_row as a format string with one field for the value
+    return markdown_table_row(key.replace("{", "{{").replace("}", "}}"), "{}")
+
+
+class Templates:
+    """
+    Render functions compiled from a configuration.
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.bugzilla_url = config.bugzilla_base_url
+        self.bug_link = config.bugzilla_base_url + "/show_bug.cgi?id={}"
+        self.datetime_format = config.datetime_format_string
+        # " EDT"
+        self.timezone = " {}".format(config.timezone)
+        self.table_header = markdown_table_row("", "") + markdown_table_row(
+            "---", "---"
+        )
+
+        self.rows = []
+        if config.include_bugzilla_link:
+            self.rows.append(self.link_row)
+        self.rows.extend(
+            [self.status_row, self.importance_row, self.reported_row, self.modified_row]
+        )
+        if config.include_version:
+            if config.include_version_only_when_specified:
+                self.rows.append(self.specified_version_row)
+            else:
+                self.rows.append(self.version_row)
+        if config.include_os:
+            self.rows.append(self.os_row)
+        if config.include_arch:
+            self.rows.append(self.arch_row)
+        self.rows.append(self.related_bugs_rows)
+
+        self.gerrit_base = config.see_also_gerrit_link_base_url
+        self.git_base = config.see_also_git_link_base_url
+        self.gerrit_pattern = (
+            re.compile(self.gerrit_base + r"/c/.*/\+/") if self.gerrit_base else None
+        )
+        self.git_pattern = (
+            re.compile(self.git_base + "/.*id=") if self.git_base else None
+        )
+
+        # "By John Doe (jdoe@example.com) on " and "Sep 11, 2017 09:42\n\n"
+        self.author_format = "By {who_name}"
+        if config.show_email:
+            self.author_format += " ({who})"
+        self.date_format = ""
+        if config.show_datetime_in_comments:
+            self.author_format += " on "
+            self.date_format = "{date}\n\n"
+        else:
+            self.author_format += "\n\n"
+
+        self.description_template = config.description_template
+        self.comment_template = config.comment_template
+
+    def description(self, fields, formatted_created_at, reporter, text):
+        """
+        The metadata table of a bug, followed by the text of its first comment.
+        """
+        parts = [self.table_header]
+        for row in self.rows:
+            row(parts, fields, formatted_created_at)
+        if reporter is not None:
+            parts.append(_row("Reporter").format(reporter))
+        table = "".join(parts)
+        if self.description_template:
+            return self.description_template.format(
+                table=table, description=text, fields=fields
+            )
+        return table + text
+
+    def comment(self, fields, formatted_bug_when, show_author, text):
+        """
+        The body of a note: the author (for comments by the generic user) and the date,
+        followed by the text of the comment.
+        """
+        parts = []
+        if show_author:
+            parts.append(
+                self.author_format.format(
+                    who=fields["who"], who_name=fields["who_name"]
+                )
+            )
+        parts.append(self.date_format.format(date=formatted_bug_when))
+        header = "".join(parts)
+        if self.comment_template:
+            return self.comment_template.format(
+                header=header, body=text, date=formatted_bug_when, fields=fields
+            )
+        return header + text
+
+    def link_row(self, parts, fields, formatted_created_at):
+        bug_id = fields["bug_id"]
+        parts.append(
+            _row("Bugzilla Link").format(
+                "[{}]({})".format(bug_id, self.bug_link.format(bug_id))
+            )
+        )
+
+    def status_row(self, parts, fields, formatted_created_at):
+        if not fields.get("bug_status"):
+            return
+        status = fields["bug_status"]
+        if fields.get("resolution"):
+            status += " " + fields["resolution"]
+            if fields["resolution"] == "DUPLICATE":
+                status += " of [bug {}]({})".format(
+                    fields["dup_id"], self.bug_link.format(fields["dup_id"])
+                )
+        parts.append(_row("Status").format(status))
+
+    def importance_row(self, parts, fields, formatted_created_at):
+        if fields.get("priority"):
+            parts.append(
+                _row("Importance").format(
+                    "{} {}".format(fields["priority"], fields["bug_severity"])
+                )
+            )
+
+    def reported_row(self, parts, fields, formatted_created_at):
+        parts.append(_row("Reported").format(formatted_created_at + self.timezone))
+
+    def modified_row(self, parts, fields, formatted_created_at):
+        modified = format_datetime(fields["delta_ts"], self.datetime_format)
+        parts.append(_row("Modified").format(modified + self.timezone))
+
+    def version_row(self, parts, fields, formatted_created_at):
+        parts.append(_row("Version").format(fields.get("version")))
+
+    def specified_version_row(self, parts, fields, formatted_created_at):
+        if fields.get("version") != "unspecified":
+            self.version_row(parts, fields, formatted_created_at)
+
+    def os_row(self, parts, fields, formatted_created_at):
+        parts.append(_row("OS").format(fields.get("op_sys")))
+
+    def arch_row(self, parts, fields, formatted_created_at):
+        parts.append(_row("Architecture").format(fields.get("rep_platform")))
+
+    def related_bugs_rows(self, parts, fields, formatted_created_at):
+        if fields.get("dependson"):
+            links = [
+                "[{}]({})".format(bug, self.bug_link.format(bug))
+                for bug in fields["dependson"]
+            ]
+            parts.append(_row("Depends on").format(", ".join(links)))
+        if fields.get("blocked"):
+            links = [
+                "[{}]({})".format(bug, self.bug_link.format(bug))
+                for bug in fields["blocked"]
+            ]
+            parts.append(_row("Blocks").format(", ".join(links)))
+        if fields.get("see_also"):
+            links = [self.see_also_link(see_also) for see_also in fields["see_also"]]
+            parts.append(_row("See also").format(", ".join(links)))
+
+    def see_also_link(self, see_also):
+        if self.gerrit_base and self.gerrit_base in see_also:
+            gerrit_id = self.gerrit_pattern.sub("", see_also)
+            return "[Gerrit change {}]({})".format(gerrit_id, see_also)
+        if self.git_base and self.git_base in see_also:
+            commit_id = self.git_pattern.sub("", see_also)[0:8]
+            return "[Git commit {}]({})".format(commit_id, see_also)
+        if self.bugzilla_url in see_also:
+            see_also = see_also.replace(self.bug_link.format(""), "")
+            return "[{}]({})".format(see_also, self.bug_link.format(see_also))
+        return see_also
@@ -0,0 +1,163 @@
+"""
+A pool of GitLab admin tokens, below `_perform_request`.
+
+GitLab rate limits every user separately, so requests made with the token of
+`gitlab_private_token` are spread over the tokens of `gitlab_private_tokens` as well.
+Every token has its own budget (`gitlab_token_rate` requests per second) and is paused
+when GitLab reports that its rate limit is used up (429, RateLimit-Remaining: 0).
+Tokens that GitLab rejects (401, or 403 for sudo) are no longer used, and the request
+is repeated with another token. All tokens must belong to admins: sudo, and thus the
+author of issues and notes, works the same with any of them.
+"""
+
+import logging
+import threading
+import time
+
+from .utils import RateLimiter
+
+# Seconds a token is paused after a 429 without a Retry-After header
+DEFAULT_RETRY_AFTER = 60
+
+
+class GitLabToken:
+    def __init__(self, value, rate=None):
+        self.value = value
+        self.limiter = RateLimiter(rate)
+        self.paused_until = 0
+        self.revoked = False
+        self.in_flight = 0
+        self.requests = 0
+        self.rate_limited = 0
+
+    def __str__(self):
+        # never log a whole token
+        return "...{}".format(self.value[-4:])
+
+    def usable(self, now):
+        return not self.revoked and self.paused_until <= now
+
+
+class TokenPool:
+    """
+    Hands out the token that is free the soonest, see `acquire` and `release`.
+    """
+
+    def __init__(self, tokens, rate=None):
+        values = []
+        for token in tokens:
+            if token and token not in values:
+                values.append(token)
+        self.tokens = [GitLabToken(value, rate) for value in values]
+        self.values = set(values)
+        self.lock = threading.Lock()
+
+    def __contains__(self, value):
+        return value in self.values
+
+    def __len__(self):
+        return len(self.tokens)
+
+    def acquire(self):
+        """
+        Take a token for one request, waiting for its budget.
+        """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                usable = [token for token in self.tokens if token.usable(now)]
+                if usable:
+                    token = min(
+                        usable,
+                        key=lambda token: (
+                            max(token.limiter.next_slot, now),
+                            token.in_flight,
+                            token.requests,
+                        ),
+                    )
+                    token.in_flight += 1
+                    token.requests += 1
+                    break
+                paused = [
+                    token.paused_until for token in self.tokens if not token.revoked
+                ]
+                if not paused:
+                    raise Exception("None of the GitLab tokens is accepted anymore")
+                delay = min(paused) - now
+            logging.warning(
+                "All GitLab tokens are rate limited, waiting {:.0f}s".format(delay)
+            )
+            time.sleep(delay)
+        token.limiter.wait()
+        return token
+
+    def release(self, token, response):
+        """
+        Return a token after its request. Returns True if the request should be repeated
+        with another token.
+        """
+        with self.lock:
+            token.in_flight -= 1
+            if response is None:
+                return False
+            now = time.monotonic()
+            if response.status_code == 429:
+                token.rate_limited += 1
+                token.paused_until = now + _retry_after(response)
+                logging.warning(
+                    "GitLab token {} is rate limited for {:.0f}s".format(
+                        token, token.paused_until - now
+                    )
+                )
+                return True
+            if response.status_code == 401 or (
+                response.status_code == 403 and _sudo_refused(response)
+            ):
+                token.revoked = True
+                logging.warning(
+                    "GitLab token {} was refused ({}), it is no longer used".format(
+                        token, response.status_code
+                    )
+                )
+                return any(not other.revoked for other in self.tokens)
+            if response.headers.get("RateLimit-Remaining") == "0":
+                # the request went through, but the next one would not
+                token.paused_until = now + _rate_limit_reset(response)
+            return False
+
+    def summary(self):
+        with self.lock:
+            tokens = ", ".join(
+                "{} {} requests{}{}".format(
+                    token,
+                    token.requests,
+                    (
+                        " ({} rate limited)".format(token.rate_limited)
+                        if token.rate_limited
+                        else ""
+                    ),
+                    " (refused)" if token.revoked else "",
+                )
+                for token in self.tokens
+            )
+        return "GitLab tokens: {}".format(tokens)
+
+
+def _retry_after(response):
+    try:
+        return max(1, int(response.headers.get("Retry-After")))
+    except (TypeError, ValueError):
+        return _rate_limit_reset(response)
+
+
+def _rate_limit_reset(response):
+    # RateLimit-Reset is a Unix time
+    try:
+        return max(1, int(response.headers.get("RateLimit-Reset")) - time.time())
+    except (TypeError, ValueError):
+        return DEFAULT_RETRY_AFTER
+
+
+def _sudo_refused(response):
+    content = response.content or b""
+    return b"sudo" in content or b"insufficient_scope" in content
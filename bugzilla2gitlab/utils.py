@@ -1,22 +1,215 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from getpass import getpass
-
+import json
 import logging
+import os
+import queue
+import re
+import threading
+import time
+from urllib.parse import urlsplit
+
 import dateutil.parser
+import dateutil.tz
 from defusedxml import ElementTree
 import pytz
-import requests, os, json
-
+import requests
 from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from requests.packages.urllib3.exceptions import NewConnectionError
 from requests.packages.urllib3.util.retry import Retry
 
+from .latency import (
+    DeadlineExceeded,
+    DEFAULT_HEDGE_ENDPOINTS,
+    endpoint,
+    hedged,
+    LatencyStats,
+    remaining,
+)
+
 SESSION = None
+SESSION_LOCK = threading.Lock()
+
+# One adapter (and thus one connection pool) per host, see `configure_http`
+ADAPTERS = {}
+
+HTTP_SETTINGS = {
+    "pool_maxsize": 10,
+    "timeout": None,
+    "endpoint_timeouts": [],
+    "keepalive_timeout": None,
+    "compression": True,
+    "hedge_percentile": None,
+    "hedge_endpoints": [],
+}
+
+# Headers, form fields and query parameters that are left out of error messages
+SECRET_KEYS = {
+    "private-token",
+    "authorization",
+    "api_key",
+    "bugzilla_api_key",
+    "bugzilla_password",
+    "password",
+}
+SECRET_PARAMS = re.compile(r"([?&](?:api_key|Bugzilla_api_key)=)[^&#]*", re.I)
+
+# Latencies of the requests, and the threads that send hedged requests, see latency.py
+LATENCY = LatencyStats()
+HEDGE_EXECUTOR = None
+
+# Cache of GET responses, see cache.py and `set_cache`
+CACHE = None
+
+# GitLab tokens that requests are spread over, see tokens.py and `set_token_pool`
+TOKEN_POOL = None
+
+# Responses that are worth retrying later, see `is_transient`
+TRANSIENT_STATUS_CODES = [408, 429, 500, 502, 503, 504]
 
 retry_strategy = Retry(
     total=3,
     status_forcelist=[429, 500, 502, 503, 504],
     allowed_methods=["HEAD", "GET", "OPTIONS"]
 )
-adapter = HTTPAdapter(max_retries=retry_strategy)
+
+
+def configure_http(pool_maxsize=10, connect_timeout=None, read_timeout=None,
+                   keepalive_timeout=None, compression=True, endpoint_timeouts=None,
+                   hedge_percentile=None, hedge_endpoints=None):
+    """
+    Configure the HTTP session shared by all requests.
+    pool_maxsize: number of connections kept open per host, should match the number
+        of concurrent requests.
+    connect_timeout, read_timeout: seconds to wait for a connection and for data.
+    keepalive_timeout: seconds after which idle connections are no longer trusted, set
+        it below the keep-alive timeout of the servers (Apache closes idle connections
+        after 5 seconds by default).
+    compression: ask for gzip/deflate compressed responses.
+    endpoint_timeouts: connect and read timeouts of some endpoints, by regular expression
+        on the URL path, e.g. {"/show_bug.cgi$": [5, 60]}.
+    hedge_percentile: hedge GETs to hedge_endpoints (regular expressions on the URL
+        path) that take longer than this percentile of the recent latencies.
+    """
+    global SESSION, LATENCY, HEDGE_EXECUTOR
+    with SESSION_LOCK:
+        HTTP_SETTINGS["pool_maxsize"] = pool_maxsize
+        HTTP_SETTINGS["timeout"] = None
+        if connect_timeout or read_timeout:
+            HTTP_SETTINGS["timeout"] = (connect_timeout, read_timeout)
+        HTTP_SETTINGS["endpoint_timeouts"] = [
+            (re.compile(pattern), tuple(timeouts))
+            for pattern, timeouts in (endpoint_timeouts or {}).items()
+        ]
+        HTTP_SETTINGS["keepalive_timeout"] = keepalive_timeout
+        HTTP_SETTINGS["compression"] = compression
+        HTTP_SETTINGS["hedge_percentile"] = hedge_percentile
+        HTTP_SETTINGS["hedge_endpoints"] = [
+            re.compile(pattern) for pattern in (hedge_endpoints or DEFAULT_HEDGE_ENDPOINTS)
+        ]
+        if SESSION:
+            SESSION.close()
+        SESSION = None
+        LATENCY = LatencyStats()
+        if HEDGE_EXECUTOR is not None:
+            HEDGE_EXECUTOR.shutdown(wait=False)
+        HEDGE_EXECUTOR = None
+        if hedge_percentile:
+            # the request and its hedge
+            HEDGE_EXECUTOR = ThreadPoolExecutor(max_workers=2 * pool_maxsize)
+        ADAPTERS.clear()
+
+
+def set_cache(cache):
+    """
+    Cache GET responses in the given ResponseCache, or not at all with None.
+    """
+    global CACHE
+    CACHE = cache
+
+
+def set_token_pool(pool):
+    """
+    Spread the requests made with one of the tokens of a TokenPool over all of them, or
+    send every request with its own token with None.
+    """
+    global TOKEN_POOL
+    TOKEN_POOL = pool
+
+
+class _KeepAlivePool:
+    """
+    Connection pool that does not reuse connections which have been idle for longer than
+    the keep-alive timeout: the server may have closed them already, and a request sent
+    on such a connection fails. The connection is reopened instead.
+    """
+
+    def _get_conn(self, timeout=None):
+        conn = super()._get_conn(timeout)
+        keepalive_timeout = HTTP_SETTINGS["keepalive_timeout"]
+        last_used = getattr(conn, "last_used", None)
+        if keepalive_timeout and last_used is not None and getattr(conn, "auto_open", 1):
+            idle = time.monotonic() - last_used
+            if idle > keepalive_timeout and conn.sock is not None:
+                logging.debug(
+                    "Connection to {} idle for {:.1f}s, reconnecting.".format(self.host, idle))
+                conn.close()
+        return conn
+
+    def _put_conn(self, conn):
+        if conn is not None:
+            conn.last_used = time.monotonic()
+        super()._put_conn(conn)
+
+
+class KeepAliveHTTPConnectionPool(_KeepAlivePool, HTTPConnectionPool):
+    pass
+
+
+class KeepAliveHTTPSConnectionPool(_KeepAlivePool, HTTPSConnectionPool):
+    pass
+
+
+class KeepAliveAdapter(HTTPAdapter):
+    """
+    HTTPAdapter whose pools drop idle connections, see `_KeepAlivePool`.
+    """
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            "http": KeepAliveHTTPConnectionPool,
+            "https": KeepAliveHTTPSConnectionPool,
+        }
+
+
+def _get_session(url):
+    """
+    Return the shared session, with a connection pool for the host of `url`.
+    Connections that have been idle for longer than the keep-alive timeout are reopened,
+    so that requests do not fail on connections the server has already closed.
+    """
+    global SESSION
+    parts = urlsplit(url)
+    origin = "{}://{}".format(parts.scheme, parts.netloc)
+    with SESSION_LOCK:
+        if SESSION is None:
+            SESSION = requests.Session()
+            encoding = "gzip, deflate" if HTTP_SETTINGS["compression"] else "identity"
+            SESSION.headers["Accept-Encoding"] = encoding
+
+        if origin not in ADAPTERS:
+            adapter = KeepAliveAdapter(
+                pool_connections=1,
+                pool_maxsize=HTTP_SETTINGS["pool_maxsize"],
+                max_retries=retry_strategy,
+            )
+            SESSION.mount(origin + "/", adapter)
+            ADAPTERS[origin] = adapter
+    return SESSION
+
 
 def _perform_request(
     url,
@@ -37,31 +230,325 @@ def _perform_request(
         logging.info(msg)
         return 0
 
-    global SESSION
-    if not SESSION:
-        SESSION = requests.Session()
-        SESSION.mount("https://", adapter)
-        SESSION.mount("http://", adapter)
+    cache = CACHE
+    cached = None
+    ttl = cache.ttl(url) if cache is not None and method == "get" else None
+    if ttl is not None:
+        key = cache.key(url, params, headers)
+        cached, fresh = cache.get(key, ttl)
+        if fresh:
+            return _cached_result(cached, json)
+        if cached is not None:
+            headers = dict(headers, **cached.validators())
+
+    timeout = _timeout(url, method)
+    session = _get_session(url)
+    func = getattr(session, method)
+    name = endpoint(url)
+    latency = LATENCY
+    pool = TOKEN_POOL
+    if pool is not None and headers.get("private-token") not in pool:
+        pool = None
+
+    for attempt in range(len(pool) if pool is not None else 1):
+        token = None
+        if pool is not None:
+            token = pool.acquire()
+            headers = dict(headers, **{"private-token": token.value})
+        if attempt and hasattr(data, "seek"):
+            # a streamed body is sent again from the start
+            data.seek(0)
+        result = None
+        started = time.monotonic()
+        try:
+            if files:
+                result = func(url, files=files, headers=headers, verify=verify, timeout=timeout)
+            else:
+                def send():
+                    return func(url, params=params, data=data, headers=headers, verify=verify,
+                                timeout=timeout)
+
+                delay = _hedge_delay(url, method, name, latency)
+                if delay is None:
+                    result = send()
+                else:
+                    result, won = hedged(send, delay, HEDGE_EXECUTOR)
+                    if won is not None:
+                        latency.hedge(name, won)
+        except requests.exceptions.Timeout:
+            latency.timeout(name)
+            raise
+        finally:
+            # repeat the request with another token if this one was refused
+            retry = token is not None and pool.release(token, result)
+        latency.record(name, time.monotonic() - started)
+        if not retry:
+            break
 
-    func = getattr(SESSION, method)
+    if cache is not None and method != "get" and 200 <= result.status_code < 300:
+        cache.invalidate(url)
 
-    if files:
-        result = func(url, files=files, headers=headers, verify=verify)
-    else:
-        result = func(url, params=params, data=data, headers=headers, verify=verify)
+    if cached is not None and result.status_code == 304:
+        cache.revalidated(key, cached)
+        return _cached_result(cached, json)
 
     if result.status_code in [200, 201]:
+        if ttl is not None and result.status_code == 200:
+            cache.put(key, url, result)
         if json:
             return result.json()
         return result
 
-    raise Exception(
+    raise RequestError(
         "{} failed requests: [{}] Response: [{}] Request data: [{}] Url: [{}] Headers: [{}]".format(
-            result.status_code, result.reason, result.content, data, url, headers
-        )
+            result.status_code, result.reason, result.content, _redact(data), _redact_url(url),
+            _redact(headers)
+        ),
+        result.status_code,
     )
 
 
+def _redact(values):
+    """
+    A copy of request headers or data without the values of tokens and passwords, for
+    error messages, which end up in logs and in the dead-letter file.
+    """
+    if not isinstance(values, dict):
+        return values
+    return {k: "[redacted]" if k.lower() in SECRET_KEYS else v for k, v in values.items()}
+
+
+def _redact_url(url):
+    return SECRET_PARAMS.sub(lambda match: match.group(1) + "[redacted]", url)
+
+
+def _timeout(url, method="get"):
+    """
+    The connect and read timeouts of a request, shortened to the time left of the bug.
+    Requests that write are not sent once the time is up, but never cut short: GitLab
+    may save what was posted after the client gave up, and the bug would be retried.
+    """
+    timeout = HTTP_SETTINGS["timeout"]
+    path = urlsplit(url).path
+    for pattern, endpoint_timeout in HTTP_SETTINGS["endpoint_timeouts"]:
+        if pattern.search(path):
+            timeout = endpoint_timeout
+            break
+    left = remaining()
+    if left is None or method not in ("get", "head"):
+        return timeout
+    connect, read = timeout or (None, None)
+    return (min(connect or left, left), min(read or left, left))
+
+
+def _hedge_delay(url, method, name, latency):
+    """
+    Seconds after which a second, identical request is sent, None to not hedge.
+    """
+    if method != "get" or not HTTP_SETTINGS["hedge_percentile"] or HEDGE_EXECUTOR is None:
+        return None
+    path = urlsplit(url).path
+    if not any(pattern.search(path) for pattern in HTTP_SETTINGS["hedge_endpoints"]):
+        return None
+    return latency.threshold(name, HTTP_SETTINGS["hedge_percentile"])
+
+
+def _cached_result(cached, as_json):
+    if as_json:
+        return json.loads(cached.content)
+    return cached.response()
+
+
+def paginate(url, params={}, headers={}, verify=True, keyset=False, prefetch=0):
+    """
+    Iterate lazily over the items of a paginated GitLab list endpoint, 100 items per
+    page, following the `Link` headers.
+    keyset: use keyset pagination (ordered by id), which stays fast on the last pages of
+        large collections. Falls back to offset pagination where GitLab does not support it.
+    prefetch: number of pages fetched ahead in the background while the items of the
+        current page are consumed.
+    """
+    params = dict(params, per_page=100)
+    if keyset:
+        params.update(pagination="keyset", order_by="id", sort="asc")
+    pages = _fetch_pages(url, params, headers, verify)
+    if prefetch:
+        pages = _prefetch(pages, prefetch)
+    for page in pages:
+        for item in page:
+            yield item
+
+
+def _fetch_pages(url, params, headers, verify):
+    first = True
+    while url:
+        try:
+            result = _perform_request(url, "get", params=params, headers=headers, json=False,
+                                      verify=verify)
+        except RequestError as e:
+            if not (first and params.get("pagination") == "keyset" and e.status_code in [400, 405]):
+                raise
+            logging.info(
+                "Keyset pagination is not supported for {}, using offset pagination.".format(url))
+            params = {k: v for k, v in params.items()
+                      if k not in ["pagination", "order_by", "sort"]}
+            continue
+        yield result.json()
+        url = result.links.get("next", {}).get("url")
+        # the next link carries all query parameters
+        params = {}
+        first = False
+
+
+def _prefetch(iterator, size):
+    """
+    Run an iterator in a background thread, at most `size` items ahead of the consumer.
+    """
+    items = queue.Queue(maxsize=size)
+    stopped = threading.Event()
+
+    def put(item):
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterator:
+                if not put((item, None)):
+                    return
+        except Exception as e:
+            put((None, e))
+            return
+        put((None, None))
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            item, error = items.get()
+            if error is not None:
+                raise error
+            if item is None:
+                return
+            yield item
+    finally:
+        # the consumer may stop early
+        stopped.set()
+
+
+class RequestError(Exception):
+    """
+    A request that was answered with an error status.
+    """
+
+    def __init__(self, message, status_code):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def is_transient(error):
+    """
+    Tell whether a failure may go away when the request is repeated later: server
+    errors, rate limiting, timeouts and connection problems.
+    """
+    if isinstance(error, RequestError):
+        return error.status_code in TRANSIENT_STATUS_CODES
+    return isinstance(error, (
+        requests.exceptions.ConnectionError,
+        requests.exceptions.Timeout,
+        requests.exceptions.RetryError,
+    ))
+
+
+def is_unsent(error):
+    """
+    Tell whether a failed request certainly did not reach the server, so that sending a
+    POST again cannot create anything twice: it was refused by rate limiting, no
+    connection could be opened or the time budget of the bug ran out before it was sent.
+    Timeouts and server errors may come after GitLab saved what was posted.
+    """
+    if isinstance(error, DeadlineExceeded):
+        return True
+    if isinstance(error, RequestError):
+        return error.status_code == 429
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(error, requests.exceptions.ConnectionError):
+        reason = error.args[0] if error.args else None
+        reason = getattr(reason, "reason", reason)
+        return isinstance(reason, NewConnectionError)
+    return False
+
+
+class RateLimiter:
+    """
+    Spread work evenly over time, at most `rate` units (requests, bytes) per second over
+    all threads.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.next_slot = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait(self, amount=1):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            delay = self.next_slot - now
+            self.next_slot = max(now, self.next_slot) + amount / float(self.rate)
+        if delay > 0:
+            time.sleep(delay)
+
+
+class ThrottledBody:
+    """
+    A request body that is sent in chunks of at most `chunk_size` bytes, each waiting
+    for its share of the bandwidth of a RateLimiter, so that a large upload is spread
+    over its whole duration instead of waiting for all of its bytes up front.
+    """
+
+    def __init__(self, body, limiter, chunk_size=64 * 1024):
+        self.body = body
+        self.limiter = limiter
+        self.chunk_size = chunk_size
+        self.position = 0
+
+    def __len__(self):
+        return len(self.body)
+
+    def __iter__(self):
+        # requests streams bodies that can be iterated over
+        chunk = self.read(self.chunk_size)
+        while chunk:
+            yield chunk
+            chunk = self.read(self.chunk_size)
+
+    def __repr__(self):
+        return "<{} bytes>".format(len(self.body))
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.chunk_size:
+            size = self.chunk_size
+        chunk = self.body[self.position:self.position + size]
+        self.position += len(chunk)
+        if chunk:
+            self.limiter.wait(len(chunk))
+        return chunk
+
+    def tell(self):
+        return self.position
+
+    def seek(self, position, whence=0):
+        self.position = position if whence == 0 else len(self.body) + position
+        return self.position
+
+
 def markdown_table_row(key, value):
     """
     Create a row in a markdown table.
@@ -69,11 +556,55 @@ def markdown_table_row(key, value):
     return u"| {} | {} |\n".format(key, value)
 
 
+def format_bytes(size):
+    for unit in ["B", "kB", "MB", "GB"]:
+        if size < 1000:
+            return "{:.0f} {}".format(size, unit)
+        size /= 1000.0
+    return "{:.1f} TB".format(size)
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "{}h {:02d}m {:02d}s".format(hours, minutes, seconds)
+
+
+# Bugzilla timestamps, e.g. "2017-09-11 09:42:36 -0400"
+BUGZILLA_DATETIME = re.compile(
+    r"^(\d{4})-(\d\d)-(\d\d) (\d\d):(\d\d)(?::(\d\d))? ([+-])(\d\d)(\d\d)$")
+TZ_OFFSETS = {}
+
+
+def parse_datetime(datestr):
+    """
+    Parse a datetime string. Bugzilla's fixed format is parsed directly, with one cached
+    timezone object per offset, everything else is left to dateutil.
+    """
+    match = BUGZILLA_DATETIME.match(datestr)
+    if not match:
+        return dateutil.parser.parse(datestr)
+
+    year, month, day, hour, minute, second, sign, offset_hours, offset_minutes = match.groups()
+    offset = sign + offset_hours + offset_minutes
+    tzinfo = TZ_OFFSETS.get(offset)
+    if tzinfo is None:
+        seconds = int(offset_hours) * 3600 + int(offset_minutes) * 60
+        if seconds == 0:
+            tzinfo = dateutil.tz.tzutc()
+        else:
+            # the same timezone objects dateutil.parser returns
+            tzinfo = dateutil.tz.tzoffset(None, -seconds if sign == "-" else seconds)
+        TZ_OFFSETS[offset] = tzinfo
+    return datetime(int(year), int(month), int(day), int(hour), int(minute),
+                    int(second or 0), tzinfo=tzinfo)
+
+
 def format_datetime(datestr, formatting):
     """
     Apply a datetime format to a string, according to the formatting string.
     """
-    parsed_dt = dateutil.parser.parse(datestr)
+    parsed_dt = parse_datetime(datestr)
     return parsed_dt.strftime(formatting)
 
 
@@ -81,10 +612,23 @@ def format_utc(datestr):
     """
     Convert datetime string to UTC format recognized by GitLab.
     """
-    parsed_dt = dateutil.parser.parse(datestr)
+    return _format_utc(parse_datetime(datestr))
+
+
+def format_timestamps(datestr, formatting):
+    """
+    Parse a datetime string once and return both the UTC format recognized by GitLab
+    and the string formatted according to the formatting string.
+    """
+    parsed_dt = parse_datetime(datestr)
+    return _format_utc(parsed_dt), parsed_dt.strftime(formatting)
+
+
+def _format_utc(parsed_dt):
     utc_dt = parsed_dt.astimezone(pytz.utc)
     return utc_dt.strftime("%Y-%m-%dT%H:%M:%SZ")
 
+
 def fetch_bug_list(bugzilla_url, bugzilla_api_token, product, components, status, max_no_of_bugs):
     status_filter = ""
     for s in status:
@@ -114,6 +658,51 @@ def fetch_bug_list(bugzilla_url, bugzilla_api_token, product, components, status
         buglist.append(bug["id"])
     return buglist
 
+
+def fetch_changed_bug_list(bugzilla_url, bugzilla_api_token, product, components, since):
+    """
+    Fetch ids and status of all bugs of a product that changed since the given UTC time.
+    """
+    components_list = ""
+    for component in components:
+        # quickfix to deal with ampersands in component names
+        component = component.replace("&", "%26")
+        components_list += "&component={}".format(component)
+
+    url = "{}/rest/bug?product={}{}&last_change_time={}&include_fields=id,status&api_key={}".format(
+        bugzilla_url, product, components_list, since, bugzilla_api_token)
+    response = _perform_request(url, "get", json=True)
+    msg = "Found {} bugs changed since {} for product={}, component={}".format(
+        len(response["bugs"]), since, product, components)
+    print(msg)
+    logging.info(msg)
+
+    return [(bug["id"], bug["status"]) for bug in response["bugs"]]
+
+
+def fetch_bug_sizes(bugzilla_url, bugzilla_api_token, bug_ids):
+    """
+    Fetch the number of comments and the size of the live attachments of several bugs,
+    without their contents. Returns {bug id: (comments, attachment bytes)}.
+    """
+    ids = "".join("&ids={}".format(bug_id) for bug_id in bug_ids[1:])
+    url = "{}/rest/bug/{}/attachment?exclude_fields=data&api_key={}{}".format(
+        bugzilla_url, bug_ids[0], bugzilla_api_token, ids)
+    attachments = _perform_request(url, "get", json=True)["bugs"]
+    url = "{}/rest/bug/{}/comment?include_fields=id&api_key={}{}".format(
+        bugzilla_url, bug_ids[0], bugzilla_api_token, ids)
+    comments = _perform_request(url, "get", json=True)["bugs"]
+
+    sizes = {}
+    for bug_id in bug_ids:
+        size = sum(
+            attachment["size"] for attachment in attachments.get(str(bug_id), [])
+            if not attachment.get("is_obsolete")
+        )
+        sizes[str(bug_id)] = (len(comments.get(str(bug_id), {}).get("comments", [])), size)
+    return sizes
+
+
 def save_bug_list(buglist, file):
     # dump bug numbers to file
     # Create new file if it does not exist yet
@@ -127,6 +716,7 @@ def save_bug_list(buglist, file):
         buglist_file.write("{}\n".format(bug))
     buglist_file.close()
 
+
 def load_bugzilla_bug(file):
     """
     Read bug XML, return all fields and values in a dictionary.
@@ -140,13 +730,16 @@ def load_bugzilla_bug(file):
         raise Exception ("File {} not found!".format(file))
     return bug_fields
 
-def get_bugzilla_bug(bugzilla_url, bug_id):
+
+def get_bugzilla_bug(bugzilla_url, bug_id, attachment_data=True):
     """
     Read bug XML, return all fields and values in a dictionary.
+    attachment_data: include the (base64) data of the attachments.
     """
-    bug_xml = _fetch_bug_content(bugzilla_url, bug_id)
+    bug_xml = _fetch_bug_content(bugzilla_url, bug_id, attachment_data)
     return parse_bug_fields(bug_xml)
 
+
 def parse_bug_fields(bug_xml):
     tree = ElementTree.fromstring(bug_xml)
 
@@ -185,8 +778,10 @@ def parse_bug_fields(bug_xml):
     return bug_fields
 
 
-def _fetch_bug_content(url, bug_id):
+def _fetch_bug_content(url, bug_id, attachment_data=True):
     url = "{}/show_bug.cgi?ctype=xml&id={}".format(url, bug_id)
+    if not attachment_data:
+        url += "&excludefield=attachmentdata"
     response = _perform_request(url, "get", json=False)
     return response.content
 
@@ -223,11 +818,17 @@ def bugzilla_login(url, user, password):
 
 
 def get_gitlab_project_id(url, ns_project_name, headers):
+    return get_gitlab_project(url, ns_project_name, headers)["id"]
+
+
+def get_gitlab_project(url, project, headers, verify=True):
+    """
+    Look up a GitLab project by id or by "<namespace>/<project name>".
+    """
     # namespace and project name must be url-encoded! <YOUR-NAMESPACE>%2F<YOUR-PROJECT-NAME>
-    ns_project_name = ns_project_name.replace('/','%2F')
-    url = "{}/projects/{}".format(url, ns_project_name)
-    response = _perform_request(url, "get", json=True, headers=headers)
-    return response["id"]
+    project = str(project).replace('/','%2F')
+    url = "{}/projects/{}".format(url, project)
+    return _perform_request(url, "get", json=True, headers=headers, verify=verify)
 
 
 def set_admin_permission(url, id, admin, headers):
@@ -242,6 +843,7 @@ def set_admin_permission(url, id, admin, headers):
     response = _perform_request(url, "put", json=True, headers=headers)
     return response
 
+
 def is_admin(url, id, headers):
     response = get_gitlab_user(url, id, headers)
     # FIXME
@@ -252,11 +854,13 @@ def is_admin(url, id, headers):
         logging.error("ERROR: is_admin was not found in response.")
         logging.error(json.dumps(response, indent=4))
 
+
 def get_gitlab_user(url, id, headers):
     url = "{}/users/{}".format(url, id)
     response = _perform_request(url, "get", json=True, headers=headers)
     return response
 
+
 def validate_list(integer_list):
     """
     Ensure that the user-supplied input is a list of integers, or a list of strings
@@ -281,6 +885,7 @@ def validate_list(integer_list):
                     "and is therefore an invalid bug id.".format(i)
                 ) from ValueError
 
+
 def add_user_mapping(file, bugzilla_user, gitlab_user):
     #TODO: create file, if it does not exist yet?
     user_mappings_file = open(file, "a")
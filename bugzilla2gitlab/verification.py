@@ -0,0 +1,279 @@
+"""
+Verification of a migration: compare the GitLab issues with the bugs they were
+migrated from, without writing anything.
+
+The issues of every target project are streamed through the paginated issue list, a few
+pages ahead, so tens of thousands of issues are checked with a few hundred requests.
+The number of notes comes from `user_notes_count`; notes are only listed (concurrently)
+for the issues whose attachments are linked from notes. What every issue should look
+like follows the rules of `IssueThread`, from the bugs or from the journal.
+"""
+
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import re
+
+from . import models
+from .utils import paginate
+
+# Links to uploaded attachments, e.g. /uploads/e943e69eb2478529f2f1c7c7ea00fb46/mail_route.zip
+UPLOAD_LINK = re.compile(r"/uploads/[0-9a-f]+/[^)\"\s]+")
+# The bug of an issue, see `Templates.link_row` and use_bugzilla_id_in_title
+BUGZILLA_LINK = re.compile(r"^\| Bugzilla Link \| \[([0-9]+)\]\(", re.M)
+TITLE_BUG_ID = re.compile(r"^\[Bug ([0-9]+)\] ")
+
+
+def expected_issue(conf, fields, entry=None):
+    """
+    The issue a bug is migrated to by `IssueThread`. With a journal entry, the issue
+    iid and project are taken from it.
+    """
+    models.set_config(conf)
+    comments = fields["long_desc"]
+    long_desc = [c for c in comments if c.get("thetext")]
+    # the first comment becomes the description if the reporter wrote it
+    described = (
+        bool(comments)
+        and comments[0]["who"] == fields["reporter"]
+        and bool(comments[0].get("thetext"))
+    )
+    notes = long_desc[1:] if described else long_desc
+
+    attachments = {a["attachid"]: a for a in fields.get("attachment", [])}
+    live = [
+        c["attachid"]
+        for c in long_desc
+        if c.get("attachid") in attachments
+        and attachments[c["attachid"]]["isobsolete"] != "1"
+    ]
+    note_uploads = [c["attachid"] for c in notes if c.get("attachid") in live]
+
+    try:
+        labels = models.get_labels(
+            fields["component"],
+            fields.get("op_sys"),
+            fields.get("keywords"),
+            fields["bug_severity"],
+            fields["status_whiteboard"],
+        )
+    except models.UnmappedComponentError:
+        # the migration fails for this bug, the missing issue is reported
+        labels = None
+
+    title = fields["short_desc"]
+    if conf.use_bugzilla_id_in_title:
+        title = "[Bug {}] {}".format(fields["bug_id"], fields["short_desc"])
+
+    expected = {
+        "project_id": conf.gitlab_project_id,
+        "issue_iid": None,
+        "title": title,
+        "labels": labels,
+        "state": (
+            "closed"
+            if fields["bug_status"] in conf.bugzilla_closed_states
+            else "opened"
+        ),
+        "notes": len(notes),
+        "uploads": len(set(live)),
+        "note_uploads": bool(note_uploads),
+    }
+    if entry is not None:
+        expected["project_id"] = entry.get("project_id", conf.gitlab_project_id)
+        expected["issue_iid"] = entry["issue_iid"]
+    return expected
+
+
+def journal_expectation(conf, entry):
+    """
+    The issue of a bug as recorded in the journal. The title is not recorded, and the
+    number of notes only by newer versions.
+    """
+    return {
+        "project_id": entry.get("project_id", conf.gitlab_project_id),
+        "issue_iid": entry["issue_iid"],
+        "title": None,
+        "labels": entry["labels"].split(",") if entry["labels"] else [],
+        "state": (
+            "closed" if entry["status"] in conf.bugzilla_closed_states else "opened"
+        ),
+        "notes": entry.get("note_count"),
+        "uploads": len(entry["attachment_ids"]),
+        "note_uploads": bool(entry["attachment_ids"]),
+    }
+
+
+class Verification:
+    """
+    Expected issues by bug id, checked against the issues of their projects by `run`.
+    """
+
+    def __init__(self, config, concurrency=4):
+        self.conf = config
+        self.concurrency = concurrency
+        self.expected = {}
+        self.differences = Counter()
+        self.checked = 0
+        self.failed = 0
+
+    def add_bug(self, conf, fields, entry=None):
+        self.expected[str(fields["bug_id"])] = expected_issue(conf, fields, entry)
+
+    def add_entry(self, bug_id, entry):
+        self.expected[str(bug_id)] = journal_expectation(self.conf, entry)
+
+    def bug_id(self, issue):
+        """
+        The bug an issue was migrated from, None if it cannot be told.
+        """
+        if self.conf.use_bugzilla_id:
+            return str(issue["iid"])
+        match = BUGZILLA_LINK.search(issue.get("description") or "")
+        if match is None:
+            match = TITLE_BUG_ID.match(issue.get("title") or "")
+        return match.group(1) if match else None
+
+    def find_issues(self, project_id, expected):
+        """
+        Stream the issues of a project until the issues of all expected bugs are found.
+        Returns {bug id: issue}.
+        """
+        if not (
+            self.conf.use_bugzilla_id
+            or self.conf.include_bugzilla_link
+            or self.conf.use_bugzilla_id_in_title
+        ):
+            if not all(e["issue_iid"] for e in expected.values()):
+                raise Exception(
+                    "Cannot find the issues of the bugs without a journal, use_bugzilla_id, "
+                    "include_bugzilla_link or use_bugzilla_id_in_title"
+                )
+        iids = {
+            str(e["issue_iid"]): bug_id
+            for bug_id, e in expected.items()
+            if e["issue_iid"]
+        }
+        found = {}
+        url = "{}/projects/{}/issues".format(self.conf.gitlab_base_url, project_id)
+        for issue in paginate(
+            url,
+            params={"scope": "all"},
+            headers=self.conf.default_headers,
+            verify=self.conf.verify,
+            keyset=True,
+            prefetch=self.concurrency,
+        ):
+            bug_id = iids.get(str(issue["iid"]))
+            if bug_id is None and len(iids) < len(expected):
+                bug_id = self.bug_id(issue)
+            if bug_id in expected and bug_id not in found:
+                found[bug_id] = issue
+                if len(found) == len(expected):
+                    break
+        return found
+
+    def note_bodies(self, issue):
+        url = "{}/projects/{}/issues/{}/notes".format(
+            self.conf.gitlab_base_url, issue["project_id"], issue["iid"]
+        )
+        return [
+            note["body"]
+            for note in paginate(
+                url, headers=self.conf.default_headers, verify=self.conf.verify
+            )
+            if not note.get("system")
+        ]
+
+    def compare(self, expected, issue, notes=()):
+        """
+        The differences between an expected and an actual issue, {} if there are none.
+        """
+        if issue is None:
+            return {"issue": "missing"}
+        differences = {}
+        if expected["title"] is not None and issue["title"] != expected["title"]:
+            differences["title"] = [expected["title"], issue["title"]]
+        if issue["state"] != expected["state"]:
+            differences["state"] = [expected["state"], issue["state"]]
+        if expected["labels"] is not None:
+            missing = [
+                label for label in expected["labels"] if label not in issue["labels"]
+            ]
+            unexpected = [
+                label for label in issue["labels"] if label not in expected["labels"]
+            ]
+            if missing or unexpected:
+                differences["labels"] = {"missing": missing, "unexpected": unexpected}
+        if (
+            expected["notes"] is not None
+            and issue.get("user_notes_count") != expected["notes"]
+        ):
+            differences["notes"] = [expected["notes"], issue.get("user_notes_count")]
+        links = set(UPLOAD_LINK.findall(issue.get("description") or ""))
+        for body in notes:
+            links.update(UPLOAD_LINK.findall(body))
+        if len(links) != expected["uploads"]:
+            differences["uploads"] = [expected["uploads"], len(links)]
+        return differences
+
+    def run(self, report_file):
+        """
+        Check all expected issues and write the differences to report_file, one JSON
+        object per bug that differs. Returns a summary.
+        """
+        by_project = defaultdict(dict)
+        for bug_id, expected in self.expected.items():
+            by_project[str(expected["project_id"])][bug_id] = expected
+        found = {}
+        for project_id, expected in by_project.items():
+            print("Reading the issues of GitLab project {}...".format(project_id))
+            found.update(self.find_issues(project_id, expected))
+
+        with_notes = [
+            bug_id
+            for bug_id, issue in found.items()
+            if self.expected[bug_id]["note_uploads"]
+        ]
+        notes = {}
+        with ThreadPoolExecutor(max_workers=max(1, self.concurrency)) as executor:
+            for bug_id, bodies in zip(
+                with_notes,
+                executor.map(self.note_bodies, [found[b] for b in with_notes]),
+            ):
+                notes[bug_id] = bodies
+
+        with open(report_file, "w") as f:
+            for bug_id in sorted(self.expected, key=int):
+                issue = found.get(bug_id)
+                differences = self.compare(
+                    self.expected[bug_id], issue, notes.get(bug_id, ())
+                )
+                self.checked += 1
+                if not differences:
+                    continue
+                self.failed += 1
+                self.differences.update(differences.keys())
+                entry = {
+                    "bug_id": int(bug_id),
+                    "issue_iid": issue["iid"] if issue else None,
+                    "differences": differences,
+                }
+                f.write(json.dumps(entry) + "\n")
+
+        summary = self.summary(report_file)
+        logging.info(summary)
+        return summary
+
+    def summary(self, report_file):
+        lines = [
+            "Verified {} bug(s): {} match, {} differ".format(
+                self.checked, self.checked - self.failed, self.failed
+            )
+        ]
+        for kind, count in self.differences.most_common():
+            lines.append("  {:>9}  {}".format(count, kind))
+        if self.failed:
+            lines.append("See {}".format(report_file))
+        return "\n".join(lines)
@@ -1,13 +1,96 @@
+import base64
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import io
+import json
 import os.path
 import random
+import re
+import socket
+import sqlite3
+import threading
+import time
+
+import dateutil.parser
+import pytest
+import pytz
+import requests
+import yaml
 
 from bugzilla2gitlab import Migrator
+import bugzilla2gitlab.cache
 import bugzilla2gitlab.config
+import bugzilla2gitlab.coordination
+import bugzilla2gitlab.graphql
+import bugzilla2gitlab.journal
+import bugzilla2gitlab.latency
+import bugzilla2gitlab.migrator
+import bugzilla2gitlab.models
+import bugzilla2gitlab.planner
+import bugzilla2gitlab.profiling
+import bugzilla2gitlab.progress
+import bugzilla2gitlab.relinking
+import bugzilla2gitlab.provisioning
+import bugzilla2gitlab.routing
+import bugzilla2gitlab.scheduler
+import bugzilla2gitlab.sources
+import bugzilla2gitlab.tokens
 import bugzilla2gitlab.utils
+import bugzilla2gitlab.verification
 
 TEST_DATA_PATH = os.path.join(os.path.dirname(__file__), "test_data")
 
 
+def load_test_config(monkeypatch, **overrides):
+
+    def mock_getuserid(username, gitlab_url, headers, verify):
+        return random.randint(1, 100)
+
+    def mock_loadmilestoneidcache(project_id, gitlab_url, headers, verify):
+        return {"gitlab_milestones": {"Foo": 1}}
+
+    monkeypatch.setattr(bugzilla2gitlab.config, '_get_user_id', mock_getuserid)
+    monkeypatch.setattr(bugzilla2gitlab.config, '_load_milestone_id_cache',
+                        mock_loadmilestoneidcache)
+    conf = bugzilla2gitlab.config.get_config(os.path.join(TEST_DATA_PATH, "config"))
+    return conf._replace(**overrides)
+
+
+class FakeGitLab:
+    """
+    Stand-in for `_perform_request` that records requests and answers like GitLab.
+    """
+
+    def __init__(self):
+        self.requests = []
+
+    def __call__(self, url, method, data={}, params={}, headers={}, files={}, json=True,
+                 dry_run=False, verify=True):
+        if url.endswith("/uploads") and not files:
+            # a throttled upload, see ThrottledBody
+            data = b"".join(data)
+            name = re.search(rb'filename="([^"]*)"', data).group(1).decode()
+            files = {"file": (name, data)}
+        self.requests.append((method, url, dict(data) if isinstance(data, dict) else data, dict(headers)))
+        if files:
+            return {"markdown": "[{0}](/uploads/abc/{0})".format(files["file"][0])}
+        if method == "post" and url.endswith("/issues"):
+            return {"iid": 7, "id": 707}
+        if method == "get" and "/history" in url:
+            return {"bugs": [{"history": [{"who": "bmc"}]}]}
+        if method == "get" and "/users/" in url:
+            return {"is_admin": True}
+        return {}
+
+    def find(self, method, suffix):
+        return [r for r in self.requests if r[0] == method and r[1].endswith(suffix)]
+
+    def install(self, monkeypatch):
+        monkeypatch.setattr(bugzilla2gitlab.models, "_perform_request", self)
+        monkeypatch.setattr(bugzilla2gitlab.utils, "_perform_request", self)
+        return self
+
+
 def test_config(monkeypatch):
 
     def mockreturn(username, gitlab_url, headers, verify):
@@ -74,7 +157,7 @@ def test_Migrator(monkeypatch):
     def mock_loadmilestoneidcache(project_id, gitlab_url, headers, verify):
         return {"gitlab_milestones": {"Foo": 1}}
 
-    def mock_fetchbugcontent(url, bug_id):
+    def mock_fetchbugcontent(url, bug_id, attachment_data=True):
         bug_file = "bug-{}.xml".format(bug_id)
         with open(os.path.join(TEST_DATA_PATH, bug_file), "r") as f:
             content = f.read()
@@ -89,3 +172,1348 @@ def test_Migrator(monkeypatch):
     # just test that it works without throwing any exceptions
     client = Migrator(os.path.join(TEST_DATA_PATH, "config"))
     client.migrate([bug_id])
+
+
+def test_lease_store(tmp_path):
+    url = "sqlite:///{}".format(tmp_path / "leases.db")
+    coordination = bugzilla2gitlab.coordination
+    store_a = coordination.LeaseStore(url, "a", lease_duration=60)
+    store_b = coordination.LeaseStore(url, "b", lease_duration=60)
+    store_a.seed([1, 2, 3])
+    store_b.seed([1, 2, 3])
+
+    # workers never lease the same bug
+    leases_a = store_a.claim(2)
+    leases_b = store_b.claim(2)
+    assert [lease.bug_id for lease in leases_a] == [1, 2]
+    assert [lease.bug_id for lease in leases_b] == [3]
+    assert store_b.claim(2) == []
+
+    assert store_a.begin_create(leases_a[0])
+    assert store_a.complete(leases_a[0], 42)
+    assert store_a.release(leases_a[1])
+
+    # a crashed worker's leases expire and are taken over
+    assert store_b.begin_create(leases_b[0])
+    store_b.lease_duration = -1
+    assert store_b.heartbeat(leases_b) == []
+    taken_over = store_a.claim(5)
+    assert [(lease.bug_id, lease.reconcile) for lease in taken_over] == [(2, False), (3, True)]
+
+    # the old lease can neither be extended nor used to create the issue
+    assert store_b.heartbeat(leases_b) == leases_b
+    assert not store_b.begin_create(leases_b[0])
+
+    taken_over = taken_over[1]
+    assert store_a.fail(taken_over, "boom")
+    assert store_a.counts() == {"done": 1, "leased": 1, "orphaned": 1}
+
+
+def test_migrate_leased(monkeypatch, tmp_path):
+    conf = load_test_config(monkeypatch, dry_run=False, component_mapping_auto=True,
+                            include_bugzilla_link=True)
+    gitlab = FakeGitLab().install(monkeypatch)
+
+    def get_bugzilla_bug(bugzilla_url, bug_id, attachment_data=True):
+        if str(bug_id) == "4":
+            raise bugzilla2gitlab.utils.RequestError("502 failed requests", 502)
+        fields = bugzilla2gitlab.utils.load_bugzilla_bug(os.path.join(TEST_DATA_PATH, "bug-103.xml"))
+        fields["bug_id"] = str(bug_id)
+        return fields
+
+    class Counters:
+        def __init__(self):
+            self.counters = collections.Counter()
+            self.errors = collections.Counter()
+
+        def add(self, name, amount=1):
+            self.counters[name] += amount
+
+        def add_error(self, kind):
+            self.errors[kind] += 1
+
+    counters = Counters()
+    monkeypatch.setattr(bugzilla2gitlab.progress, "CURRENT", counters)
+    monkeypatch.setattr(bugzilla2gitlab.sources, "get_bugzilla_bug", get_bugzilla_bug)
+    monkeypatch.setattr(bugzilla2gitlab.migrator, "find_migrated_issue", lambda config, bug_id: None)
+    monkeypatch.setattr(bugzilla2gitlab.migrator, "get_config", lambda path: conf)
+    migrator = Migrator(os.path.join(TEST_DATA_PATH, "config"))
+
+    url = "sqlite:///{}".format(tmp_path / "leases.db")
+    store_a = bugzilla2gitlab.coordination.LeaseStore(url, "a", lease_duration=60)
+    store_b = bugzilla2gitlab.coordination.LeaseStore(url, "b", lease_duration=60)
+    store_a.seed([1, 2, 3])
+    # worker b stalls while creating two issues
+    leases_b = store_b.claim(2)
+    for lease in leases_b:
+        store_b.begin_create(lease)
+    store_b.lease_duration = -1
+    store_b.heartbeat(leases_b)
+    heartbeat = bugzilla2gitlab.coordination.LeaseHeartbeat(store_a)
+    first, second, third = store_a.claim(3)
+    assert first.reconcile and second.reconcile and not third.reconcile
+
+    # no issue is found, but the search of include_bugzilla_link may lag behind
+    migrator.migrate_leased(store_a, heartbeat, first)
+    assert gitlab.find("post", "/issues") == []
+
+    # with use_bugzilla_id, a missing issue is certainly missing
+    migrator.conf = conf._replace(use_bugzilla_id=True)
+    monkeypatch.setattr(migrator.router, "route", lambda fields: migrator.conf)
+    migrator.migrate_leased(store_a, heartbeat, second)
+    assert len(gitlab.find("post", "/issues")) == 1
+
+    # a lease the heartbeat lost is not used to create the issue
+    heartbeat.lost.add(third)
+    migrator.migrate_leased(store_a, heartbeat, third)
+    assert len(gitlab.find("post", "/issues")) == 1
+    assert store_a.counts() == {"creating": 1, "done": 1, "orphaned": 1}
+    # every bug is counted
+    assert (counters.counters["bugs"], counters.counters["failed"]) == (1, 1)
+    assert counters.errors == {"partial": 1, "lost_lease": 1}
+
+    # a transient failure before the issue is created is retried after a pause
+    migrator.conf = migrator.conf._replace(deferred_retries=1, retry_backoff=0.05)
+    store_a.seed([4])
+    (fourth,) = store_a.claim(1)
+    migrator.migrate_leased(store_a, heartbeat, fourth)
+    assert store_a.claim(1) == []
+    assert store_a.next_retry() > time.time()
+    time.sleep(0.1)
+    (fourth,) = store_a.claim(1)
+    assert fourth.attempts == 1
+    # until the retries are used up
+    with pytest.raises(bugzilla2gitlab.utils.RequestError):
+        migrator.migrate_leased(store_a, heartbeat, fourth)
+    assert store_a.counts()["failed"] == 1
+    assert store_a.next_retry() is None
+
+
+def test_sync(monkeypatch, tmp_path):
+    journal_store = "sqlite:///{}".format(tmp_path / "journal.db")
+    conf = load_test_config(monkeypatch, dry_run=False, component_mapping_auto=True,
+                            journal_store=journal_store)
+    gitlab = FakeGitLab().install(monkeypatch)
+    bug_file = os.path.join(TEST_DATA_PATH, "bug-103.xml")
+
+    issue_thread = bugzilla2gitlab.models.IssueThread(
+        conf, bugzilla2gitlab.utils.load_bugzilla_bug(bug_file))
+    issue_thread.save()
+    journal = bugzilla2gitlab.journal.Journal(journal_store)
+    journal.record(issue_thread.bug_id, issue_thread.issue.id, issue_thread.journal_entry())
+    assert len(gitlab.find("post", "/issues/7/notes")) == 1
+
+    # the bug is reopened and gets a new comment
+    fields = bugzilla2gitlab.utils.load_bugzilla_bug(bug_file)
+    fields["bug_status"] = "REOPENED"
+    fields["delta_ts"] = "2022-01-01 10:00:00 +0000"
+    fields["long_desc"].append({"commentid": "99999", "who": "cyeh", "who_name": "Chris Yeh",
+                                "bug_when": "2022-01-01 10:00:00 +0000",
+                                "thetext": "Still broken"})
+    gitlab.requests.clear()
+    issue_update = bugzilla2gitlab.models.IssueUpdate(conf, fields, journal.get(103))
+    issue_update.save()
+
+    notes = gitlab.find("post", "/issues/7/notes")
+    assert len(notes) == 1
+    assert notes[0][2]["body"].endswith("Still broken")
+    assert [r[2] for r in gitlab.find("put", "/issues/7")][-1] == {"state_event": "reopen"}
+
+    journal.record(issue_update.bug_id, issue_update.issue.id, issue_update.journal_entry())
+    assert journal.get(103)["comment_keys"][-1] == "99999"
+    assert journal.get(103)["status"] == "REOPENED"
+    assert journal.get(103)["note_count"] == 2
+
+
+def test_concurrent_notes(monkeypatch):
+    bug_file = os.path.join(TEST_DATA_PATH, "bug-103.xml")
+
+    def post_notes(note_concurrency, fail_once=()):
+        conf = load_test_config(monkeypatch, dry_run=False, component_mapping_auto=True,
+                                bugzilla_closed_states=[], note_concurrency=note_concurrency)
+        gitlab = FakeGitLab().install(monkeypatch)
+        failed = set()
+        lock = threading.Lock()
+
+        def post(url, method, data={}, **kwargs):
+            if url.endswith("/notes"):
+                time.sleep(random.random() / 1000)
+                text = data["body"].rpartition("\n")[2]
+                with lock:
+                    if text in fail_once and text not in failed:
+                        failed.add(text)
+                        if text == "Comment 20":
+                            # saved by GitLab, but the response is lost
+                            gitlab(url, method, data=data, **kwargs)
+                            raise requests.exceptions.ReadTimeout("Read timed out")
+                        raise bugzilla2gitlab.utils.RequestError("429 failed requests", 429)
+            return gitlab(url, method, data=data, **kwargs)
+
+        def paginate(url, **kwargs):
+            assert url.endswith("/issues/7/notes")
+            return [{"body": r[2]["body"], "system": False} for r in gitlab.find("post", "/notes")]
+
+        monkeypatch.setattr(bugzilla2gitlab.models, "_perform_request", post)
+        monkeypatch.setattr(bugzilla2gitlab.models, "paginate", paginate)
+        fields = bugzilla2gitlab.utils.load_bugzilla_bug(bug_file)
+        for i in range(40):
+            # pairs of comments share a timestamp
+            fields["long_desc"].append({
+                "commentid": str(1000 + i), "who": random.choice(["matt", "cyeh"]),
+                "who_name": "", "bug_when": "2009-01-01 10:{:02d}:00 +0000".format(i // 2),
+                "thetext": "Comment {}".format(i)})
+        bugzilla2gitlab.models.IssueThread(conf, fields).save()
+        notes = [(r[2]["created_at"], r[2]["body"]) for r in gitlab.find("post", "/notes")]
+        assert not bugzilla2gitlab.models.ADMIN_ELEVATIONS
+        assert failed == set(fail_once)
+        # GitLab sorts by created_at, ties by insertion order
+        return sorted(notes, key=lambda note: note[0])
+
+    serial = post_notes(1)
+    assert len(serial) == 41
+    # the note that timed out after it was saved is not posted twice
+    concurrent = post_notes(8, fail_once={"Comment 3", "Comment 20"})
+    assert concurrent == serial
+
+
+def test_attachment_preupload(monkeypatch):
+    users = {"jdoe@domain.com": "mcline", "attachment@domain.com": "cyeh",
+             "default_assignee@domain.com": "cyeh"}
+    conf = load_test_config(monkeypatch, dry_run=False, component_mapping_auto=True,
+                            attachment_concurrency=4)
+    conf.bugzilla_users.update(users)
+    gitlab = FakeGitLab().install(monkeypatch)
+    fields = bugzilla2gitlab.utils.load_bugzilla_bug(
+        os.path.join(os.path.dirname(__file__), "test_xmls", "attachments.xml"))
+
+    issue_thread = bugzilla2gitlab.models.IssueThread(conf, fields)
+    # all live attachments are uploaded while loading, obsolete ones are not
+    assert [r[2] for r in gitlab.requests] == [{}, {}, {}]
+    assert len(gitlab.find("post", "/uploads")) == 3
+    issue_thread.save()
+    assert len(gitlab.find("post", "/uploads")) == 3
+
+    bodies = [r[2]["body"] for r in gitlab.find("post", "/notes")]
+    assert "~~attachment 200001~~ (attachment deleted)" in bodies[0]
+    assert "[file2.txt](/uploads/abc/file2.txt)" in bodies[1]
+    assert '<img src="/uploads/abc/buggie.png"' in bodies[3]
+
+
+def test_plan(monkeypatch):
+    conf = load_test_config(monkeypatch, component_mapping_auto=True)
+    plan = bugzilla2gitlab.planner.MigrationPlan(conf, fetched=False)
+    plan.add_bug(bugzilla2gitlab.utils.load_bugzilla_bug(
+        os.path.join(os.path.dirname(__file__), "test_xmls", "attachments.xml")))
+    plan.add_bug(bugzilla2gitlab.utils.load_bugzilla_bug(
+        os.path.join(TEST_DATA_PATH, "bug-103.xml")))
+
+    assert plan.bugs == 2
+    assert plan.comments == 5
+    assert (plan.live_attachments, plan.obsolete_attachments) == (3, 1)
+    assert plan.live_bytes > 0
+    assert plan.unresolved_users == {"jdoe@domain.com", "attachment@domain.com",
+                                     "default_assignee@domain.com"}
+    requests = plan.requests
+    assert requests[bugzilla2gitlab.planner.UPLOAD] == 3
+    assert requests[bugzilla2gitlab.planner.CREATE_ISSUE] == 2
+    assert requests[bugzilla2gitlab.planner.CREATE_NOTE] == 5
+    assert requests[bugzilla2gitlab.planner.SEARCH_USER] == 3
+    assert requests[bugzilla2gitlab.planner.CLOSE_ISSUE] == 1
+    assert bugzilla2gitlab.planner.FETCH_BUG not in requests
+
+    total = plan.total_requests()
+    assert plan.estimate(rate=10, concurrency=1, latency=0, bandwidth=0) == total / 10
+    # the upload bandwidth is shared by all concurrent requests
+    bandwidth = plan.live_bytes / 100.0
+    estimate = plan.estimate(rate=0, concurrency=4, latency=1, bandwidth=bandwidth)
+    assert estimate == pytest.approx(total / 4.0 + 100)
+    assert total / 4.0 < 100
+    assert "API calls per endpoint" in plan.report(
+        10, 1, 0.1, 1e6, existing_labels={(conf.gitlab_project_id, "bugzilla")})
+
+    # unmapped components are reported, other errors are not hidden
+    plan = bugzilla2gitlab.planner.MigrationPlan(
+        conf._replace(component_mapping_auto=False), fetched=False)
+    fields = bugzilla2gitlab.utils.load_bugzilla_bug(os.path.join(TEST_DATA_PATH, "bug-103.xml"))
+    plan.add_bug(dict(fields, component="Unmapped"))
+    assert plan.unmapped_components == {"Unmapped"}
+    with pytest.raises(KeyError):
+        plan.add_bug({k: v for k, v in fields.items() if k != "bug_severity"})
+
+
+def test_format_timestamps():
+    formatting = "%b %d, %Y %H:%M %Z %z"
+    for datestr in ["2017-09-11 09:42:36 -0400", "2000-09-18 02:47:33 -0700",
+                    "2021-12-14 20:40:47 +0000", "2010-06-08 10:25 +0530",
+                    "2017-09-11T09:42:36Z", "Sep 11 2017 09:42:36 -0400"]:
+        parsed_dt = dateutil.parser.parse(datestr)
+        assert bugzilla2gitlab.utils.format_timestamps(datestr, formatting) == (
+            parsed_dt.astimezone(pytz.utc).strftime("%Y-%m-%dT%H:%M:%SZ"),
+            parsed_dt.strftime(formatting))
+
+
+def test_batch_mode(monkeypatch, tmp_path):
+    dead_letter_file = str(tmp_path / "dead_letters.jsonl")
+    conf = load_test_config(monkeypatch, dry_run=False, component_mapping_auto=True,
+                            dead_letter_file=dead_letter_file, deferred_retries=2,
+                            retry_backoff=0)
+
+    class FlakyGitLab(FakeGitLab):
+        def __call__(self, url, method, data={}, **kwargs):
+            if method == "post" and data.get("body", "").endswith("Unlucky note"):
+                raise bugzilla2gitlab.utils.RequestError("500 failed requests", 500)
+            return super().__call__(url, method, data, **kwargs)
+
+    gitlab = FlakyGitLab().install(monkeypatch)
+    attempts = []
+
+    def get_bugzilla_bug(bugzilla_url, bug_id, attachment_data=True):
+        attempts.append(bug_id)
+        if bug_id == "1" and attempts.count("1") == 1:
+            raise bugzilla2gitlab.utils.RequestError("502 failed requests", 502)
+        if bug_id == "2":
+            raise Exception("Found more than one GitLab user for email")
+        fields = bugzilla2gitlab.utils.load_bugzilla_bug(os.path.join(TEST_DATA_PATH, "bug-103.xml"))
+        fields["bug_id"] = bug_id
+        if bug_id == "3":
+            fields["long_desc"].append({"commentid": "99999", "who": "cyeh", "who_name": "Chris Yeh",
+                                        "bug_when": "2022-01-01 10:00:00 +0000",
+                                        "thetext": "Unlucky note"})
+        return fields
+
+    monkeypatch.setattr(bugzilla2gitlab.sources, "get_bugzilla_bug", get_bugzilla_bug)
+    monkeypatch.setattr(bugzilla2gitlab.migrator, "get_config", lambda path: conf)
+    migrator = Migrator(os.path.join(TEST_DATA_PATH, "config"))
+    migrator.migrate_batch(["1", "2", "3"])
+
+    # the transient failure is retried after the other bugs, the others are not
+    assert attempts == ["1", "2", "3", "1"]
+    assert len(gitlab.find("post", "/issues")) == 2
+    with open(dead_letter_file) as f:
+        dead_letters = {entry["bug_id"]: entry for entry in map(json.loads, f)}
+    assert sorted(dead_letters) == [2, 3]
+    assert dead_letters[2]["error_type"] == "permanent"
+    assert dead_letters[3]["error_type"] == "partial"
+    assert dead_letters[3]["issue_iid"] == 7
+    assert dead_letters[3]["cause"] == "RequestError"
+    assert dead_letters[2]["cause"] is None
+
+
+def test_uncertain_issue_creation(monkeypatch, tmp_path):
+    dead_letter_file = str(tmp_path / "dead_letters.jsonl")
+    conf = load_test_config(monkeypatch, dry_run=False, component_mapping_auto=True,
+                            dead_letter_file=dead_letter_file, deferred_retries=2,
+                            retry_backoff=0, include_bugzilla_link=True)
+    created = []
+
+    class TimeoutGitLab(FakeGitLab):
+        def __call__(self, url, method, data={}, **kwargs):
+            if method == "post" and url.endswith("/issues"):
+                created.append(data["title"])
+                if created.count(data["title"]) == 1:
+                    if data["title"] == "Bug 5":
+                        # refused before GitLab created anything
+                        raise bugzilla2gitlab.utils.RequestError("429 failed requests", 429)
+                    raise requests.exceptions.ReadTimeout("Read timed out")
+            return super().__call__(url, method, data, **kwargs)
+
+    perform_request = bugzilla2gitlab.utils._perform_request
+    TimeoutGitLab().install(monkeypatch)
+
+    def get_bugzilla_bug(bugzilla_url, bug_id, attachment_data=True):
+        fields = bugzilla2gitlab.utils.load_bugzilla_bug(os.path.join(TEST_DATA_PATH, "bug-103.xml"))
+        fields.update(bug_id=bug_id, short_desc="Bug {}".format(bug_id))
+        return fields
+
+    lookups = []
+
+    def find_migrated_issue(config, bug_id):
+        lookups.append(bug_id)
+        return 9 if bug_id == "4" else None
+
+    monkeypatch.setattr(bugzilla2gitlab.sources, "get_bugzilla_bug", get_bugzilla_bug)
+    monkeypatch.setattr(bugzilla2gitlab.migrator, "find_migrated_issue", find_migrated_issue)
+    monkeypatch.setattr(bugzilla2gitlab.migrator, "get_config", lambda path: conf)
+    migrator = Migrator(os.path.join(TEST_DATA_PATH, "config"))
+    migrator.migrate_batch(["4", "5", "6"])
+
+    # timed out issues are looked up before they are created again, rate limited ones not
+    assert lookups == ["4", "6"]
+    assert created == ["Bug 4", "Bug 5", "Bug 6", "Bug 5", "Bug 6"]
+    with open(dead_letter_file) as f:
+        dead_letters = [json.loads(line) for line in f]
+    assert [(e["bug_id"], e["error_type"], e["issue_iid"]) for e in dead_letters] == [(4, "partial", 9)]
+
+    # tokens and passwords are left out of error messages
+    class Session:
+        def post(self, url, **kwargs):
+            response = requests.Response()
+            response.status_code = 502
+            response.reason = "Bad Gateway"
+            response._content = b""
+            return response
+
+    monkeypatch.setattr(bugzilla2gitlab.utils, "_get_session", lambda url: Session())
+    with pytest.raises(bugzilla2gitlab.utils.RequestError) as error:
+        perform_request(
+            "https://bugzilla/index.cgi?api_key=SECRET1", "post",
+            data={"Bugzilla_password": "SECRET2"}, headers={"private-token": "SECRET3"})
+    assert "502" in str(error.value)
+    assert "SECRET" not in str(error.value)
+
+
+def test_profiler(tmp_path):
+    profiler = bugzilla2gitlab.profiling.BugProfiler(
+        str(tmp_path), mode="sampling", top=2, memory=True, interval=0.001)
+    for bug_id, size in [(1, 10), (2, 1000000), (3, 100), (4, 10)]:
+        with profiler.profile(bug_id):
+            data = [0] * size
+            time.sleep(0.02 if bug_id == 3 else 0.005)
+            del data
+
+    assert 3 in [result.bug_id for _, _, result in profiler.slowest]
+    assert 2 in [result.bug_id for _, _, result in profiler.largest]
+    profiler.write()
+    files = os.listdir(str(tmp_path))
+    assert "summary.txt" in files
+    assert "bug-2.alloc.txt" in files
+    with open(str(tmp_path / "bug-3.folded")) as f:
+        stack, count = f.readline().rsplit(" ", 1)
+    assert stack.startswith("MainThread;") and int(count) > 0
+
+    profiler = bugzilla2gitlab.profiling.BugProfiler(str(tmp_path), top=1)
+    with profiler.profile(5):
+        sum(range(1000))
+    profiler.write()
+    assert "bug-5.prof" in os.listdir(str(tmp_path))
+
+
+def test_provision_users(monkeypatch, tmp_path):
+    users = [{"id": 1, "username": "alice"}, {"id": 2, "username": "bob"}]
+    members = [{"id": 1, "username": "alice"}]
+
+    def paginate(url, params={}, headers={}, verify=True, **kwargs):
+        return iter(members if url.endswith("/members/all") else users)
+
+    class Target(FakeGitLab):
+        def __call__(self, url, method, data={}, params={}, **kwargs):
+            super().__call__(url, method, data, **kwargs)
+            if method == "get":
+                # the username filter is case insensitive
+                return [u for u in users if u["username"].lower() == params["username"].lower()]
+            if url.endswith("/users"):
+                return {"id": 3}
+            if data.get("user_id") == 1:
+                raise bugzilla2gitlab.utils.RequestError("409 Member already exists", 409)
+            return {}
+
+    gitlab = Target()
+    monkeypatch.setattr(bugzilla2gitlab.provisioning, "paginate", paginate)
+    monkeypatch.setattr(bugzilla2gitlab.provisioning, "_perform_request", gitlab)
+
+    mappings = tmp_path / "user_mappings.yml"
+    mappings.write_text("---\nalice@example.com: alice\nbob@example.com: bob\ncarol@example.com: carol\n")
+    wanted = bugzilla2gitlab.provisioning.users_from_mappings(str(mappings), "bugzilla")
+    provisioner = bugzilla2gitlab.provisioning.Provisioner(
+        "https://gitlab", {}, rate=0, email_template="{username}@example.com")
+    ids, failed = provisioner.provision(wanted, ("projects", 5))
+
+    lookups = [r for r in gitlab.requests if r[0] == "get"]
+    assert len(lookups) == 4
+    created = [r[2]["username"] for r in gitlab.requests
+               if r[0] == "post" and r[1].endswith("/users")]
+    assert sorted(created) == ["bugzilla", "carol"]
+    assert not failed
+    added = sorted(r[2]["user_id"] for r in gitlab.requests if r[1].endswith("/projects/5/members"))
+    assert added == [2, 3, 3]
+    assert ids == {"alice": 1, "bob": 2, "carol": 3, "bugzilla": 3}
+
+    # many users are found by listing all users
+    users.append({"id": 4, "username": "Carol"})
+    monkeypatch.setattr(bugzilla2gitlab.provisioning, "LOOKUP_THRESHOLD", 1)
+    gitlab.requests = []
+    assert provisioner.existing_users({"alice", "carol"}) == {"alice": 1}
+    assert not gitlab.requests
+    monkeypatch.setattr(bugzilla2gitlab.provisioning, "LOOKUP_THRESHOLD", 500)
+    assert provisioner.existing_users({"alice", "carol"}) == {"alice": 1}
+    assert len(gitlab.requests) == 2
+
+    bugzilla2gitlab.config.save_user_ids(str(tmp_path), ids)
+    monkeypatch.setattr(bugzilla2gitlab.config, "_get_user_id", None)
+    cache = bugzilla2gitlab.config._load_user_id_cache(str(tmp_path), "https://gitlab", {}, True)
+    assert cache["gitlab_users"] == {"alice": "1", "bob": "2", "carol": "3"}
+
+
+def test_paginate(monkeypatch):
+    requests = []
+
+    class Page:
+        def __init__(self, items, next_url):
+            self.items = items
+            self.links = {"next": {"url": next_url}} if next_url else {}
+
+        def json(self):
+            return self.items
+
+    def perform_request(url, method, params={}, headers={}, json=True, verify=True):
+        requests.append((url, dict(params)))
+        if params.get("pagination") == "keyset":
+            raise bugzilla2gitlab.utils.RequestError("405 Method Not Allowed", 405)
+        page = int(url.rsplit("page=", 1)[1]) if "page=" in url else 1
+        next_url = "https://gitlab/users?page={}".format(page + 1) if page < 3 else None
+        return Page(list(range((page - 1) * 100, page * 100)), next_url)
+
+    monkeypatch.setattr(bugzilla2gitlab.utils, "_perform_request", perform_request)
+
+    users = bugzilla2gitlab.utils.paginate("https://gitlab/users", params={"search": "x"}, prefetch=1)
+    assert list(users) == list(range(300))
+    assert requests[0] == ("https://gitlab/users", {"search": "x", "per_page": 100})
+    assert requests[1:] == [("https://gitlab/users?page=2", {}), ("https://gitlab/users?page=3", {})]
+
+    # items are yielded lazily and keyset pagination falls back to offset pagination
+    requests.clear()
+    users = bugzilla2gitlab.utils.paginate("https://gitlab/users", keyset=True)
+    assert next(users) == 0
+    assert [r[1].get("pagination") for r in requests] == ["keyset", None]
+
+
+def test_project_routes(monkeypatch):
+    routes = [
+        {"component": ["Core", "Runtime"], "project": "eclipse/core"},
+        {"product": "FoodReplicator", "project": 42, "component_mappings": {"UI": "ui"}},
+    ]
+    conf = load_test_config(monkeypatch, project_routes=routes)
+
+    def get_gitlab_project(url, project, headers, verify=True):
+        return {"id": 41 if project == "eclipse/core" else 42,
+                "path_with_namespace": "eclipse/core" if project == "eclipse/core" else "eclipse/food"}
+
+    monkeypatch.setattr(bugzilla2gitlab.routing, "get_gitlab_project", get_gitlab_project)
+    monkeypatch.setattr(bugzilla2gitlab.routing, "_load_milestone_id_cache",
+                        lambda project_id, url, headers, verify: {"gitlab_milestones": {}})
+    router = bugzilla2gitlab.routing.ProjectRouter(conf)
+
+    core = router.route({"product": "Platform", "component": "Runtime"})
+    food = router.route({"product": "FoodReplicator", "component": "UI"})
+    assert (core.gitlab_project_id, food.gitlab_project_id) == (41, 42)
+    assert router.route({"product": "Other", "component": "UI"}) is conf
+    assert router.target(42) is food
+
+    # user caches are shared, milestones and component mappings are per project
+    assert core.gitlab_users is conf.gitlab_users
+    food.gitlab_milestones["1.0"] = 3
+    assert "1.0" not in core.gitlab_milestones
+    assert food.component_mappings["UI"] == "ui" and "UI" not in conf.component_mappings
+
+
+def test_bug_scheduler(monkeypatch):
+    conf = load_test_config(monkeypatch, dry_run=False, component_mapping_auto=True,
+                            bug_concurrency=2, heavy_attachment_bytes=10000,
+                            heavy_upload_bandwidth=1e9)
+    conf.bugzilla_users.update({"jdoe@domain.com": "mcline", "attachment@domain.com": "cyeh",
+                                "default_assignee@domain.com": "cyeh"})
+    other_project = conf._replace(gitlab_project_id=42)
+    gitlab = FakeGitLab().install(monkeypatch)
+    upload_limiters = []
+    save = bugzilla2gitlab.models.Attachment.save
+
+    def get_bugzilla_bug(bugzilla_url, bug_id, attachment_data=True):
+        if bug_id == "3":
+            fields = bugzilla2gitlab.utils.load_bugzilla_bug(
+                os.path.join(os.path.dirname(__file__), "test_xmls", "attachments.xml"))
+        else:
+            fields = bugzilla2gitlab.utils.load_bugzilla_bug(os.path.join(TEST_DATA_PATH, "bug-103.xml"))
+        fields["bug_id"] = bug_id
+        return fields
+
+    def sizes(bug_ids):
+        return {bug_id: bugzilla2gitlab.scheduler.bug_size(get_bugzilla_bug(None, bug_id))
+                for bug_id in bug_ids}
+
+    def record_upload(attachment):
+        upload_limiters.append(getattr(bugzilla2gitlab.models.CONF.local, "upload_limiter", None))
+        save(attachment)
+
+    monkeypatch.setattr(bugzilla2gitlab.sources, "get_bugzilla_bug", get_bugzilla_bug)
+    monkeypatch.setattr(bugzilla2gitlab.migrator, "get_config", lambda path: conf)
+    monkeypatch.setattr(bugzilla2gitlab.models.Attachment, "save", record_upload)
+    migrator = Migrator(os.path.join(TEST_DATA_PATH, "config"))
+    migrator.router.route = lambda fields: other_project if fields["bug_id"] == "2" else conf
+
+    migrator.run_bugs(["1", "2", "3", "4"], migrator.migrate_one, sizes=sizes)
+
+    assert len(gitlab.find("post", "/issues")) == 4
+    # every bug is created in the project of its own configuration
+    assert len(gitlab.find("post", "/projects/42/issues")) == 1
+    # the uploads of the heavy bug share the bandwidth limit of the heavy lane
+    assert len(upload_limiters) == 3 and all(upload_limiters)
+    assert len(gitlab.find("post", "/uploads")) == 3
+
+    # and are throttled chunk by chunk while they are sent
+    class Limiter:
+        rate = 1000
+        waits = []
+
+        def wait(self, amount):
+            self.waits.append(amount)
+
+    body = bugzilla2gitlab.utils.ThrottledBody(b"x" * 150000, Limiter())
+    assert len(body) == 150000 and b"".join(body) == b"x" * 150000
+    assert Limiter.waits == [65536, 65536, 18928]
+    body.seek(0)
+    assert body.read(1000) == b"x" * 1000 and body.tell() == 1000
+
+
+def test_progress(monkeypatch, tmp_path):
+    conf = load_test_config(monkeypatch, dry_run=False, component_mapping_auto=True)
+    conf.bugzilla_users.update({"jdoe@domain.com": "mcline"})
+    gitlab = FakeGitLab().install(monkeypatch)
+
+    def get_bugzilla_bug(bugzilla_url, bug_id, attachment_data=True):
+        fields = bugzilla2gitlab.utils.load_bugzilla_bug(os.path.join(TEST_DATA_PATH, "bug-103.xml"))
+        fields["bug_id"] = bug_id
+        return fields
+
+    monkeypatch.setattr(bugzilla2gitlab.sources, "get_bugzilla_bug", get_bugzilla_bug)
+    monkeypatch.setattr(bugzilla2gitlab.migrator, "get_config", lambda path: conf)
+    status_file = str(tmp_path / "status.json")
+    progress = bugzilla2gitlab.progress.Progress(show=False, status_file=status_file, interval=0.01)
+    migrator = Migrator(os.path.join(TEST_DATA_PATH, "config"), progress=progress)
+
+    migrator.migrate(["1", "", "2"])
+
+    with open(status_file) as f:
+        status = json.load(f)
+    assert status["bugs"] == {"total": 2, "done": 2, "failed": 0, "remaining": 0}
+    assert status["issues"] == 2
+    assert status["fetched"] == 2
+    assert status["notes"]["done"] == len(gitlab.find("post", "/notes"))
+    assert status["eta"] in (0, None)
+    assert bugzilla2gitlab.progress.CURRENT is None
+
+    # the ETA follows the rate of finished bugs
+    progress.total = 10
+    progress.rates[bugzilla2gitlab.progress.BUGS] = 2.0
+    assert progress.eta() == 4.0
+    assert "ETA" in progress.status_line()
+
+
+def test_graphql_notes(monkeypatch, tmp_path):
+    # the notes would lose their dates
+    with open(os.path.join(TEST_DATA_PATH, "config", "defaults.yml")) as f:
+        defaults = yaml.safe_load(f)
+    defaults.update(note_backend="graphql", show_datetime_in_comments=False)
+    with open(str(tmp_path / "defaults.yml"), "w") as f:
+        yaml.safe_dump(defaults, f)
+    with pytest.raises(Exception, match="show_datetime_in_comments"):
+        bugzilla2gitlab.config._load_defaults(str(tmp_path))
+
+    conf = load_test_config(monkeypatch, dry_run=False, note_backend="graphql",
+                            graphql_note_batch_size=2, gitlab_base_url="https://gitlab.example.com/api/v4")
+    bugzilla2gitlab.models.set_config(conf)
+    sent = []
+
+    def perform_request(url, method, data={}, headers={}, **kwargs):
+        payload = json.loads(data)
+        sent.append((url, headers["sudo"], [v["body"] for _, v in sorted(payload["variables"].items())]))
+        assert all(v["noteableId"] == "gid://gitlab/Issue/707" for v in payload["variables"].values())
+        result = {"data": {alias: {"note": {"id": 1}, "errors": []} for alias in payload["variables"]}}
+        if len(sent) == 1:
+            # the second note of the first request is refused
+            result["data"]["n1"] = {"note": None, "errors": ["Note is too long"]}
+        else:
+            created.extend(bodies for _, _, bodies in sent[-1:])
+        if len(sent) == 3:
+            # the notes are created, but the response is lost
+            raise requests.exceptions.ReadTimeout("Read timed out")
+        return result
+
+    created = []
+
+    class Comment(bugzilla2gitlab.models.Comment):
+        def __init__(self, sudo, body):
+            self.sudo = sudo
+            self.body = body
+
+    def paginate(url, **kwargs):
+        assert url.endswith("/issues/7/notes")
+        return [{"body": body} for bodies in created for body in bodies]
+
+    monkeypatch.setattr(bugzilla2gitlab.graphql, "_perform_request", perform_request)
+    monkeypatch.setattr(bugzilla2gitlab.models, "paginate", paginate)
+    comments = [Comment(sudo, str(i)) for i, sudo in enumerate([1, 1, 1, 2, 1])]
+    bugzilla2gitlab.models.save_comments(comments, 7, 707)
+
+    assert all(url == "https://gitlab.example.com/api/graphql" for url, _, _ in sent)
+    # batches of consecutive notes of one user, the refused note is retried before the
+    # later notes, the notes created by the lost request are not sent again
+    assert [(sudo, bodies) for _, sudo, bodies in sent] == [
+        (1, ["0", "1"]), (1, ["1", "2"]), (2, ["3"]), (1, ["4"])]
+
+    errors = bugzilla2gitlab.graphql.note_errors(
+        {"data": {"n0": None}, "errors": [{"message": "Forbidden", "path": ["n0"]}]}, 1)
+    assert str(errors[0]) == "Forbidden"
+    errors = bugzilla2gitlab.graphql.note_errors({"errors": [{"message": "Syntax error"}]}, 2)
+    assert [str(e) for e in errors] == ["Syntax error", "Syntax error"]
+
+
+def test_rest_source(monkeypatch):
+    xml_fields = bugzilla2gitlab.utils.load_bugzilla_bug(
+        os.path.join(os.path.dirname(__file__), "test_xmls", "attachments.xml"))
+    # the REST API has no form tokens
+    for attachment in xml_fields["attachment"]:
+        del attachment["token"]
+
+    def utc(timestamp):
+        return bugzilla2gitlab.utils.format_utc(timestamp)
+
+    def rest_bug(bug_id):
+        return {
+            "id": bug_id, "creation_time": utc(xml_fields["creation_ts"]),
+            "last_change_time": utc(xml_fields["delta_ts"]), "summary": xml_fields["short_desc"],
+            "product": xml_fields["product"], "component": xml_fields["component"],
+            "version": xml_fields["version"], "platform": xml_fields["rep_platform"],
+            "op_sys": xml_fields["op_sys"], "status": xml_fields["bug_status"], "resolution": "",
+            "dupe_of": None, "whiteboard": "", "keywords": [], "priority": xml_fields["priority"],
+            "severity": xml_fields["bug_severity"], "target_milestone": xml_fields["target_milestone"],
+            "url": "", "creator": xml_fields["reporter"],
+            "creator_detail": {"real_name": xml_fields["reporter_name"]},
+            "assigned_to": xml_fields["assigned_to"], "assigned_to_detail": {"real_name": "Default Assignee"},
+            "cc": xml_fields["cc"], "depends_on": [], "blocks": [], "see_also": [], "groups": [],
+        }
+
+    comments = [{
+        "id": int(c["commentid"]), "count": int(c["comment_count"]), "creator": c["who"],
+        "creation_time": utc(c["bug_when"]), "text": c["thetext"],
+        "attachment_id": int(c["attachid"]) if c.get("attachid") else None,
+    } for c in xml_fields["long_desc"]]
+    attachments = [{
+        "id": int(a["attachid"]), "is_obsolete": a["isobsolete"] == "1", "creation_time": utc(a["date"]),
+        "last_change_time": utc(a["delta_ts"]), "summary": a["desc"], "file_name": a["filename"],
+        "content_type": a["type"], "size": int(a["size"]), "creator": a["attacher"], "data": a["data"],
+    } for a in reversed(xml_fields["attachment"])]
+    requests = []
+
+    def perform_request(url, method, params={}, **kwargs):
+        requests.append((url, params))
+        if url.endswith("/rest/bug"):
+            return {"bugs": [rest_bug(int(bug_id)) for bug_id in params["id"].split(",")]}
+        if url.endswith("/comment"):
+            return {"bugs": {"1": {"comments": comments}, "2": {"comments": []}, "3": {"comments": []}}}
+        if url.endswith("/attachment"):
+            return {"bugs": {"1": attachments}}
+        if url.endswith("/rest/user"):
+            return {"users": [{"name": "attachment@domain.com", "real_name": "Attachment Creator"}]}
+
+    monkeypatch.setattr(bugzilla2gitlab.sources, "_perform_request", perform_request)
+    conf = load_test_config(monkeypatch, bugzilla_source="rest", bugzilla_batch_size=3,
+                            bugzilla_time_zone="America/New_York")
+    source = bugzilla2gitlab.sources.get_source(conf)
+    source.expect([1, 2, 3, 4])
+    fields = source.get_bug(1)
+    source.get_bug(2)
+
+    # bugs 1 to 3 were read at once: bugs, comments, attachments and unknown commenters
+    assert len(requests) == 4
+    assert requests[0][1]["id"] == "1,2,3"
+    assert requests[1][1] == {"ids": ["2", "3"], "api_key": conf.bugzilla_api_token}
+    assert requests[3][1]["names"] == ["attachment@domain.com"]
+    assert fields["bug_id"] == "1"
+    for key, value in fields.items():
+        if key != "bug_id":
+            assert xml_fields[key] == value, key
+    assert fields["long_desc"] == xml_fields["long_desc"]
+
+    source.get_bug(4)
+    assert requests[4][1]["id"] == "4"
+
+
+def test_database_source(monkeypatch, tmp_path):
+    xml_fields = bugzilla2gitlab.utils.load_bugzilla_bug(
+        os.path.join(os.path.dirname(__file__), "test_xmls", "attachments.xml"))
+
+    def local(timestamp):
+        return timestamp[:19]
+
+    database = str(tmp_path / "bugs.db")
+    conn = sqlite3.connect(database)
+    conn.executescript(
+        "CREATE TABLE bugs (bug_id INTEGER, creation_ts TEXT, short_desc TEXT, delta_ts TEXT, "
+        "product_id INTEGER, component_id INTEGER, version TEXT, rep_platform TEXT, op_sys TEXT, "
+        "bug_status TEXT, resolution TEXT, bug_file_loc TEXT, status_whiteboard TEXT, priority TEXT, "
+        "bug_severity TEXT, target_milestone TEXT, reporter INTEGER, assigned_to INTEGER);"
+        "CREATE TABLE products (id INTEGER, name TEXT);"
+        "CREATE TABLE components (id INTEGER, name TEXT);"
+        "CREATE TABLE profiles (userid INTEGER, login_name TEXT, realname TEXT);"
+        "CREATE TABLE cc (bug_id INTEGER, who INTEGER);"
+        "CREATE TABLE dependencies (blocked INTEGER, dependson INTEGER);"
+        "CREATE TABLE duplicates (dupe_of INTEGER, dupe INTEGER);"
+        "CREATE TABLE keywords (bug_id INTEGER, keywordid INTEGER);"
+        "CREATE TABLE keyworddefs (id INTEGER, name TEXT);"
+        "CREATE TABLE bug_see_also (id INTEGER, bug_id INTEGER, value TEXT);"
+        "CREATE TABLE bug_group_map (bug_id INTEGER, group_id INTEGER);"
+        "CREATE TABLE groups (id INTEGER, name TEXT);"
+        "CREATE TABLE longdescs (comment_id INTEGER, bug_id INTEGER, who INTEGER, bug_when TEXT, "
+        "thetext TEXT, isprivate INTEGER, type INTEGER, extra_data TEXT);"
+        "CREATE TABLE attachments (attach_id INTEGER, bug_id INTEGER, creation_ts TEXT, "
+        "modification_time TEXT, description TEXT, mimetype TEXT, filename TEXT, submitter_id INTEGER, "
+        "isobsolete INTEGER, isprivate INTEGER);"
+        "CREATE TABLE attach_data (id INTEGER, thedata BLOB);"
+    )
+    users = {"jdoe@domain.com": (1, "John Doe"), "default_assignee@domain.com": (2, "Default Assignee"),
+             "attachment@domain.com": (3, "Attachment Creator"), "cc@domain.com": (4, "")}
+    conn.executemany("INSERT INTO profiles VALUES (?, ?, ?)",
+                     [(uid, login, name) for login, (uid, name) in users.items()])
+    conn.execute("INSERT INTO products VALUES (1, ?)", (xml_fields["product"],))
+    conn.execute("INSERT INTO components VALUES (1, ?)", (xml_fields["component"],))
+    for bug_id in (1, 2):
+        conn.execute("INSERT INTO bugs VALUES (?, ?, ?, ?, 1, 1, ?, ?, ?, ?, '', '', '', ?, ?, ?, 1, 2)", (
+            bug_id, local(xml_fields["creation_ts"]), xml_fields["short_desc"], local(xml_fields["delta_ts"]),
+            xml_fields["version"], xml_fields["rep_platform"], xml_fields["op_sys"], xml_fields["bug_status"],
+            xml_fields["priority"], xml_fields["bug_severity"], xml_fields["target_milestone"]))
+    conn.execute("INSERT INTO cc VALUES (1, 4)")
+    conn.execute("INSERT INTO dependencies VALUES (2, 1)")
+    for comment in xml_fields["long_desc"]:
+        attachid = comment.get("attachid")
+        conn.execute("INSERT INTO longdescs VALUES (?, 1, ?, ?, ?, 0, ?, ?)", (
+            int(comment["commentid"]), users[comment["who"]][0], local(comment["bug_when"]),
+            "" if attachid else comment["thetext"], 5 if attachid else 0, attachid))
+    conn.execute("INSERT INTO longdescs VALUES (100006, 1, 1, '2021-12-20 11:24:43', 'Secret', 1, 0, NULL)")
+    for attachment in xml_fields["attachment"]:
+        conn.execute("INSERT INTO attachments VALUES (?, 1, ?, ?, ?, ?, ?, 3, ?, 0)", (
+            int(attachment["attachid"]), local(attachment["date"]), local(attachment["delta_ts"]),
+            attachment["desc"], attachment["type"], attachment["filename"], int(attachment["isobsolete"])))
+        conn.execute("INSERT INTO attach_data VALUES (?, ?)", (
+            int(attachment["attachid"]), base64.b64decode(attachment["data"] or "")))
+    # an empty attachment and a private one with its comment
+    for attach_id, private in [(200010, 0), (200011, 1)]:
+        conn.execute("INSERT INTO attachments VALUES (?, 2, '2021-12-20 11:24:43', "
+                     "'2021-12-20 11:24:43', 'Empty', 'text/plain', 'empty.txt', 3, 0, ?)",
+                     (attach_id, private))
+        conn.execute("INSERT INTO attach_data VALUES (?, ?)", (attach_id, b""))
+        conn.execute("INSERT INTO longdescs VALUES (?, 2, 3, '2021-12-20 11:24:43', '', 0, 5, ?)",
+                     (attach_id - 100000, str(attach_id)))
+    conn.commit()
+
+    conf = load_test_config(monkeypatch, bugzilla_source="database", bugzilla_batch_size=10,
+                            bugzilla_database="sqlite:///" + database, bugzilla_time_zone="America/New_York")
+    source = bugzilla2gitlab.sources.get_source(conf)
+    source.expect(["1", "2"])
+    fields = source.get_bug("1")
+
+    for key in ["creation_ts", "short_desc", "delta_ts", "product", "component", "version", "op_sys",
+                "bug_status", "resolution", "status_whiteboard", "keywords", "priority", "bug_severity",
+                "target_milestone", "reporter", "reporter_name", "assigned_to", "cc", "dependson"]:
+        assert fields[key] == xml_fields[key], key
+    assert fields["blocked"] == ["2"]
+    # the private comment is left out, the text of attachment comments is generated
+    assert len(fields["long_desc"]) == len(xml_fields["long_desc"])
+    for count, (comment, xml_comment) in enumerate(zip(fields["long_desc"], xml_fields["long_desc"])):
+        # the test data skips a comment count
+        assert comment.pop("comment_count") == str(count)
+        del xml_comment["comment_count"]
+        assert " ".join(comment.pop("thetext").split()) == " ".join(xml_comment.pop("thetext").split())
+        assert comment == xml_comment
+    live_size = sum(len(base64.b64decode(a["data"])) for a in xml_fields["attachment"] if a["isobsolete"] == "0")
+    for attachment, xml_attachment in zip(fields["attachment"], xml_fields["attachment"]):
+        data = base64.b64decode(xml_attachment.pop("data") or "")
+        if attachment["isobsolete"] == "0":
+            assert base64.b64decode(attachment["data"]) == data
+        else:
+            assert attachment["data"] is None
+        del attachment["data"]
+        assert attachment.pop("size") == str(len(data))
+        del xml_attachment["token"], xml_attachment["size"]
+        assert attachment == xml_attachment
+
+    # the second bug was read together with the first one
+    assert "2" in source.bugs
+    fields = source.get_bug("2")
+    assert fields["dependson"] == ["1"]
+    assert [a["attachid"] for a in fields["attachment"]] == ["200010"]
+    assert fields["attachment"][0]["data"] == ""
+    assert [c["attachid"] for c in fields["long_desc"]] == ["200010"]
+    bugzilla2gitlab.models.set_config(conf)
+    assert bugzilla2gitlab.models.Attachment(fields["attachment"][0]).file_data == b""
+    sizes = source.get_sizes(["1", "2"])
+    assert sizes["1"] == (5, live_size)
+    assert sizes["2"][1] == 0
+
+
+def test_response_cache(monkeypatch, tmp_path):
+    calls = []
+
+    def response(status_code, content=b"", headers={}):
+        result = requests.Response()
+        result.status_code = status_code
+        result._content = content
+        result.headers.update(headers)
+        return result
+
+    class Session:
+        status_code = 200
+
+        def get(self, url, params={}, headers={}, **kwargs):
+            calls.append(("get", url, dict(headers)))
+            if url.endswith("/projects/1") and headers.get("If-None-Match") == '"v1"':
+                return response(304)
+            if url.endswith("/users"):
+                return response(200, b"[]")
+            return response(200, json.dumps({"url": url, "calls": len(calls)}).encode(), {"ETag": '"v1"'})
+
+        def put(self, url, **kwargs):
+            calls.append(("put", url, {}))
+            return response(self.status_code, b"{}")
+
+    monkeypatch.setattr(bugzilla2gitlab.utils, "_get_session", lambda url: Session())
+    path = str(tmp_path / "cache.db")
+    ttls = {"/users/[0-9]+$": 300, "/users$": 3600, "/projects/[0-9]+$": 0}
+    cache = bugzilla2gitlab.cache.ResponseCache(size=10, path=path, ttls=ttls)
+    monkeypatch.setattr(bugzilla2gitlab.utils, "CACHE", cache)
+    headers = {"private-token": "secret"}
+
+    first = bugzilla2gitlab.utils.get_gitlab_user("https://gitlab/api/v4", 5, headers)
+    assert bugzilla2gitlab.utils.get_gitlab_user("https://gitlab/api/v4", 5, headers) == first
+    assert len(calls) == 1
+    # other users (sudo) get their own responses
+    bugzilla2gitlab.utils.get_gitlab_user("https://gitlab/api/v4", 5, dict(headers, sudo=3))
+    assert len(calls) == 2
+
+    # changing the user invalidates it
+    bugzilla2gitlab.utils.set_admin_permission("https://gitlab/api/v4", 5, True, dict(headers))
+    assert bugzilla2gitlab.utils.get_gitlab_user("https://gitlab/api/v4", 5, headers) != first
+    assert len(calls) == 4
+    # failed changes and changes of other resources do not
+    Session.status_code = 500
+    with pytest.raises(bugzilla2gitlab.utils.RequestError):
+        bugzilla2gitlab.utils.set_admin_permission("https://gitlab/api/v4", 5, True, dict(headers))
+    Session.status_code = 200
+    bugzilla2gitlab.utils._perform_request("https://gitlab/api/v4/projects/1/issues/2", "put",
+                                           headers=headers)
+    bugzilla2gitlab.utils.get_gitlab_user("https://gitlab/api/v4", 5, headers)
+    assert len(calls) == 6
+    assert cache.stats[bugzilla2gitlab.cache.INVALIDATED] == 2
+    # users that are not found are looked up again, they may be created in the meantime
+    url = "https://gitlab/api/v4/users"
+    for _ in range(2):
+        assert bugzilla2gitlab.utils._perform_request(url, "get", params={"username": "new"},
+                                                      headers=headers) == []
+    assert len(calls) == 8
+    del calls[4:]
+
+    # expired responses are revalidated with their ETag
+    url = "https://gitlab/api/v4/projects/1"
+    project = bugzilla2gitlab.utils._perform_request(url, "get", headers=headers)
+    assert bugzilla2gitlab.utils._perform_request(url, "get", headers=headers) == project
+    assert calls[-1][2]["If-None-Match"] == '"v1"'
+    # endpoints without a time to live are not cached
+    bugzilla2gitlab.utils._perform_request("https://gitlab/api/v4/projects/1/issues", "get", headers=headers)
+    bugzilla2gitlab.utils._perform_request("https://gitlab/api/v4/projects/1/issues", "get", headers=headers)
+    assert len(calls) == 8
+
+    # a later run finds the responses on disk
+    cache = bugzilla2gitlab.cache.ResponseCache(size=10, path=path, ttls=ttls)
+    monkeypatch.setattr(bugzilla2gitlab.utils, "CACHE", cache)
+    bugzilla2gitlab.utils.get_gitlab_user("https://gitlab/api/v4", 5, headers)
+    assert len(calls) == 8
+    assert cache.stats[bugzilla2gitlab.cache.DISK_HIT] == 1
+    assert cache.hit_rate() == 1.0
+    assert "100% hit rate" in cache.summary()
+
+
+def test_templates(monkeypatch):
+    bug_file = os.path.join(TEST_DATA_PATH, "bug-103.xml")
+
+    def render(**overrides):
+        conf = load_test_config(monkeypatch, dry_run=False, component_mapping_auto=True,
+                                show_datetime_in_comments=True, **overrides)
+        FakeGitLab().install(monkeypatch)
+        issue_thread = bugzilla2gitlab.models.IssueThread(
+            conf, bugzilla2gitlab.utils.load_bugzilla_bug(bug_file))
+        return issue_thread.issue.description, [comment.body for comment in issue_thread.comments]
+
+    description, comments = render()
+    assert description.startswith("|  |  |\n| --- | --- |\n")
+    assert "| Status | RESOLVED DUPLICATE of [bug 20](" in description
+    assert comments[0].startswith("May 21, 2008 16:21\n\n")
+    assert "\n## Description \n" in description
+
+    custom_description, custom_comments = render(
+        description_template="[{table}] {fields[product]}{description}",
+        comment_template="{header}{body} ({fields[commentid]})")
+    table, _, text = description.partition("\n## Description")
+    assert custom_description == "[{}] FoodReplicator\n## Description{}".format(table, text)
+    assert custom_comments == ["{} (12126)".format(comments[0])]
+
+
+def test_http_session():
+    utils = bugzilla2gitlab.utils
+    utils.configure_http(pool_maxsize=3, connect_timeout=2, read_timeout=5, keepalive_timeout=0.05)
+    try:
+        # one pool per host, sized to the concurrency
+        session = utils._get_session("https://gitlab.example.com/api/v4/issues")
+        assert utils._get_session("https://gitlab.example.com/api/v4/users") is session
+        adapter = utils.ADAPTERS["https://gitlab.example.com"]
+        assert list(utils.ADAPTERS) == ["https://gitlab.example.com"]
+        assert session.get_adapter("https://gitlab.example.com/api/v4") is adapter
+        assert adapter._pool_maxsize == 3
+        pool = adapter.poolmanager.connection_from_url("https://gitlab.example.com/")
+        assert isinstance(pool, utils.KeepAliveHTTPSConnectionPool)
+        assert pool.pool.maxsize == 3
+
+        class Connection:
+            def __init__(self):
+                self.sock, self.peer = socket.socketpair()
+
+            def close(self):
+                self.peer.close()
+                self.sock.close()
+                self.sock = None
+
+        # idle connections are reopened, recently used ones are kept
+        pool._get_conn(), pool._get_conn()
+        idle, fresh = Connection(), Connection()
+        pool._put_conn(idle)
+        time.sleep(0.1)
+        pool._put_conn(fresh)
+        assert pool._get_conn() is fresh and fresh.sock is not None
+        assert pool._get_conn() is idle and idle.sock is None
+        fresh.close()
+
+        # the timeouts reach the adapter
+        timeouts = []
+
+        class Adapter(requests.adapters.HTTPAdapter):
+            def send(self, request, timeout=None, **kwargs):
+                timeouts.append(timeout)
+                response = requests.Response()
+                response.status_code = 200
+                response._content = b"{}"
+                response.request = request
+                return response
+
+        session.mount("https://gitlab.example.com/", Adapter())
+        assert utils._perform_request("https://gitlab.example.com/api/v4/issues", "get") == {}
+        assert timeouts == [(2, 5)]
+    finally:
+        utils.configure_http()
+
+
+def test_deadlines_and_hedging(monkeypatch):
+    timeouts = []
+    slow = threading.Event()
+
+    class Session:
+        def get(self, url, timeout=None, **kwargs):
+            timeouts.append(timeout)
+            if slow.is_set():
+                # the first request hangs, its hedge does not
+                slow.clear()
+                time.sleep(0.5)
+            result = requests.Response()
+            result.status_code = 200
+            result._content = b"{}"
+            result.raw = io.BytesIO()
+            return result
+
+        def post(self, url, timeout=None, **kwargs):
+            timeouts.append(timeout)
+            result = requests.Response()
+            result.status_code = 201
+            result._content = b"{}"
+            return result
+
+    monkeypatch.setattr(bugzilla2gitlab.utils, "_get_session", lambda url: Session())
+    monkeypatch.setitem(bugzilla2gitlab.utils.HTTP_SETTINGS, "timeout", (10, 300))
+    monkeypatch.setitem(bugzilla2gitlab.utils.HTTP_SETTINGS, "endpoint_timeouts",
+                        [(re.compile(r"/show_bug\.cgi$"), (5, 60))])
+    monkeypatch.setitem(bugzilla2gitlab.utils.HTTP_SETTINGS, "hedge_percentile", 95)
+    monkeypatch.setitem(bugzilla2gitlab.utils.HTTP_SETTINGS, "hedge_endpoints",
+                        [re.compile(r"/show_bug\.cgi$")])
+    latency = bugzilla2gitlab.latency.LatencyStats()
+    monkeypatch.setattr(bugzilla2gitlab.utils, "LATENCY", latency)
+    monkeypatch.setattr(bugzilla2gitlab.utils, "HEDGE_EXECUTOR", ThreadPoolExecutor(max_workers=4))
+    url = "https://bugzilla/show_bug.cgi"
+
+    # per-endpoint timeouts, shortened to the time budget of the bug
+    bugzilla2gitlab.utils._perform_request("https://bugzilla/rest/bug", "get")
+    bugzilla2gitlab.utils._perform_request(url, "get")
+    with bugzilla2gitlab.latency.deadline(2):
+        bugzilla2gitlab.utils._perform_request(url, "get")
+    assert timeouts[:2] == [(10, 300), (5, 60)]
+    assert 1.5 < timeouts[2][0] <= 2 and timeouts[2][0] == timeouts[2][1]
+    with bugzilla2gitlab.latency.deadline(0.01):
+        time.sleep(0.02)
+        with pytest.raises(bugzilla2gitlab.latency.DeadlineExceeded) as error:
+            bugzilla2gitlab.utils._perform_request(url, "get")
+    assert bugzilla2gitlab.utils.is_transient(error.value)
+
+    # writes are not sent once the time is up, but are never cut short
+    with bugzilla2gitlab.latency.deadline(2):
+        bugzilla2gitlab.utils._perform_request("https://bugzilla/rest/bug", "post")
+    assert timeouts[3] == (10, 300)
+    with bugzilla2gitlab.latency.deadline(0.01):
+        time.sleep(0.02)
+        with pytest.raises(bugzilla2gitlab.latency.DeadlineExceeded) as error:
+            bugzilla2gitlab.utils._perform_request("https://bugzilla/rest/bug", "post")
+    assert len(timeouts) == 4
+    assert bugzilla2gitlab.utils.is_unsent(error.value)
+    assert not bugzilla2gitlab.utils.is_unsent(requests.exceptions.ReadTimeout())
+
+    # once there are enough samples, a slow read is hedged
+    for _ in range(bugzilla2gitlab.latency.MIN_SAMPLES):
+        bugzilla2gitlab.utils._perform_request(url, "get")
+    slow.set()
+    started = time.monotonic()
+    assert bugzilla2gitlab.utils._perform_request(url, "get") == {}
+    assert time.monotonic() - started < 0.4
+    assert latency.hedges[bugzilla2gitlab.latency.endpoint(url)] == 1
+    assert latency.hedge_wins[bugzilla2gitlab.latency.endpoint(url)] == 1
+    assert "1 hedged (1 won by the hedge)" in latency.summary()
+    assert bugzilla2gitlab.latency.endpoint("https://gitlab/api/v4/users/12") == "https://gitlab/api/v4/users/:id"
+
+
+def test_token_pool(monkeypatch):
+    calls = []
+
+    class Session:
+        def post(self, url, headers={}, **kwargs):
+            calls.append((headers["private-token"], headers.get("sudo")))
+            result = requests.Response()
+            result.status_code = 201
+            result._content = b"{}"
+            if headers["private-token"] == "limited":
+                result.status_code = 429
+                result.headers["Retry-After"] = "100"
+            elif headers["private-token"] == "revoked":
+                result.status_code = 401
+            return result
+
+    monkeypatch.setattr(bugzilla2gitlab.utils, "_get_session", lambda url: Session())
+    pool = bugzilla2gitlab.tokens.TokenPool(["main", "second", "main", None])
+    monkeypatch.setattr(bugzilla2gitlab.utils, "TOKEN_POOL", pool)
+    url = "https://gitlab/api/v4/projects/1/issues/1/notes"
+
+    # requests are spread over the tokens, sudo is kept
+    for _ in range(4):
+        bugzilla2gitlab.utils._perform_request(url, "post", headers={"private-token": "main", "sudo": 3})
+    assert sorted(calls) == [("main", 3), ("main", 3), ("second", 3), ("second", 3)]
+    # other tokens are left alone
+    bugzilla2gitlab.utils._perform_request(url, "post", headers={"private-token": "other"})
+    assert calls[-1] == ("other", None)
+
+    # rate limited and refused tokens are skipped
+    pool = bugzilla2gitlab.tokens.TokenPool(["limited", "revoked", "main"])
+    monkeypatch.setattr(bugzilla2gitlab.utils, "TOKEN_POOL", pool)
+    del calls[:]
+    bugzilla2gitlab.utils._perform_request(url, "post", headers={"private-token": "main", "sudo": 3})
+    bugzilla2gitlab.utils._perform_request(url, "post", headers={"private-token": "main", "sudo": 3})
+    assert calls == [("limited", 3), ("revoked", 3), ("main", 3), ("main", 3)]
+    assert "...ited 1 requests (1 rate limited)" in pool.summary()
+    assert "...oked 1 requests (refused)" in pool.summary()
+
+    config = dict(bugzilla2gitlab.config.OPTIONAL_DEFAULTS, gitlab_private_token="main")
+    bugzilla2gitlab.config._configure_http(dict(config, gitlab_private_tokens=["second"]))
+    assert "second" in bugzilla2gitlab.utils.TOKEN_POOL
+    bugzilla2gitlab.config._configure_http(config)
+    assert bugzilla2gitlab.utils.TOKEN_POOL is None
+
+
+def test_attachments_on_demand(monkeypatch):
+    bug_file = os.path.join(os.path.dirname(__file__), "test_xmls", "attachments.xml")
+    with open(bug_file) as f:
+        # what show_bug.cgi returns with excludefield=attachmentdata
+        bug_xml = re.sub(r"\s*<data encoding=\"base64\">[^<]*</data>", "", f.read())
+    xml_fields = bugzilla2gitlab.utils.load_bugzilla_bug(bug_file)
+    data = {attachment["attachid"]: base64.b64decode(attachment["data"] or "")
+            for attachment in xml_fields["attachment"]}
+    users = {"jdoe@domain.com": "mcline", "attachment@domain.com": "cyeh",
+             "default_assignee@domain.com": "cyeh"}
+    conf = load_test_config(monkeypatch, dry_run=False, component_mapping_auto=True,
+                            attachment_concurrency=4)
+    conf.bugzilla_users.update(users)
+    bugzilla = []
+
+    def perform_request(url, method, params={}, **kwargs):
+        if not url.startswith(conf.bugzilla_base_url):
+            return gitlab(url, method, params=params, **kwargs)
+        bugzilla.append((url, dict(params)))
+        result = requests.Response()
+        result.status_code = 200
+        if "show_bug.cgi" in url:
+            result._content = bug_xml.encode()
+        elif params["id"] == "login":
+            result._content = b"<html>Log in to Bugzilla</html>"
+            result.headers["Content-Type"] = "text/html; charset=UTF-8"
+        elif params["id"] == "forced":
+            result._content = data["200004"]
+            result.headers["Content-Type"] = "application/octet-stream"
+        else:
+            result._content = data[params["id"]]
+            result.headers["Content-Type"] = "{}; name=\"file\"".format(types[params["id"]])
+        return result
+
+    types = {attachment["attachid"]: attachment["type"] for attachment in xml_fields["attachment"]}
+
+    uploads = {}
+
+    class GitLab(FakeGitLab):
+        def __call__(self, url, method, files={}, **kwargs):
+            if files:
+                uploads[files["file"][0]] = files["file"][1]
+            return super().__call__(url, method, files=files, **kwargs)
+
+    gitlab = GitLab().install(monkeypatch)
+    monkeypatch.setattr(bugzilla2gitlab.utils, "_perform_request", perform_request)
+    monkeypatch.setattr(bugzilla2gitlab.sources, "_perform_request", perform_request)
+    source = bugzilla2gitlab.sources.get_source(conf)
+    fields = source.get_bug(1)
+    assert bugzilla[0][0].endswith("show_bug.cgi?ctype=xml&id=1&excludefield=attachmentdata")
+    assert all("data" not in attachment for attachment in fields["attachment"])
+
+    bugzilla2gitlab.models.IssueThread(conf, fields).save()
+    # only the live attachments are downloaded, and uploaded as they were
+    assert sorted(params["id"] for url, params in bugzilla[1:]) == ["200002", "200003", "200004"]
+    assert all(url.endswith("/attachment.cgi") for url, params in bugzilla[1:])
+    live = [a for a in xml_fields["attachment"] if a["isobsolete"] == "0"]
+    assert uploads == {a["filename"]: data[a["attachid"]] for a in live}
+
+    # what Bugzilla returns instead of an attachment is not uploaded
+    with pytest.raises(Exception, match="is image/png, but attachment.cgi returned an HTML page"):
+        bugzilla2gitlab.sources.get_attachment_data(conf, "login", 11397, "image/png")
+    # other content types than the reported one are fine
+    assert bugzilla2gitlab.sources.get_attachment_data(
+        conf, "forced", 11397, "image/png") == data["200004"]
+    with pytest.raises(Exception, match="has 11397 bytes, but 31 bytes were received"):
+        bugzilla2gitlab.sources.get_attachment_data(conf, "login", 11397, "text/html")
+
+
+def test_verify(monkeypatch, tmp_path):
+    users = {"jdoe@domain.com": "mcline", "attachment@domain.com": "cyeh",
+             "default_assignee@domain.com": "cyeh"}
+    conf = load_test_config(monkeypatch, dry_run=False, component_mapping_auto=True)
+    conf.bugzilla_users.update(users)
+    bug_files = [os.path.join(os.path.dirname(__file__), "test_xmls", "attachments.xml"),
+                 os.path.join(TEST_DATA_PATH, "bug-103.xml")]
+
+    # migrate the bugs and keep what GitLab got as issues
+    issues = []
+    verification = bugzilla2gitlab.verification.Verification(conf, concurrency=2)
+    for iid, bug_file in enumerate(bug_files, 1):
+        gitlab = FakeGitLab().install(monkeypatch)
+        bugzilla2gitlab.models.IssueThread(conf, bugzilla2gitlab.utils.load_bugzilla_bug(bug_file)).save()
+        issue = gitlab.find("post", "/issues")[0][2]
+        notes = [r[2]["body"] for r in gitlab.find("post", "/issues/7/notes")]
+        closed = any(r[2].get("state_event") == "close" for r in gitlab.find("put", "/issues/7"))
+        issues.append({"iid": iid, "project_id": conf.gitlab_project_id, "title": issue["title"],
+                       "description": issue["description"], "labels": issue["labels"].split(","),
+                       "state": "closed" if closed else "opened", "user_notes_count": len(notes),
+                       "notes": notes})
+        verification.add_bug(conf, bugzilla2gitlab.utils.load_bugzilla_bug(bug_file))
+    # bug 103 lost a note and a label, bug 104 was not migrated
+    issues[1]["user_notes_count"] -= 1
+    issues[1]["labels"].remove("bugzilla")
+    fields = bugzilla2gitlab.utils.load_bugzilla_bug(bug_files[1])
+    fields["bug_id"] = "104"
+    verification.add_bug(conf, fields)
+
+    requested = []
+
+    def paginate(url, params={}, headers={}, verify=True, keyset=False, prefetch=0):
+        requested.append(url)
+        if url.endswith("/issues"):
+            return iter(issues)
+        iid = int(url.split("/")[-2])
+        return iter([{"body": body, "system": False} for body in issues[iid - 1]["notes"]] +
+                    [{"body": "changed the description", "system": True}])
+
+    monkeypatch.setattr(bugzilla2gitlab.verification, "paginate", paginate)
+    report_file = str(tmp_path / "report.jsonl")
+    summary = verification.run(report_file)
+
+    with open(report_file) as f:
+        report = [json.loads(line) for line in f]
+    assert report == [
+        {"bug_id": 103, "issue_iid": 2,
+         "differences": {"labels": {"missing": ["bugzilla"], "unexpected": []},
+                         "notes": [issues[1]["user_notes_count"] + 1, issues[1]["user_notes_count"]]}},
+        {"bug_id": 104, "issue_iid": None, "differences": {"issue": "missing"}},
+    ]
+    assert summary.startswith("Verified 3 bug(s): 1 match, 2 differ")
+    # the notes are only read for the bug whose attachments are linked from notes
+    assert [url for url in requested if url.endswith("/notes")] == [
+        "{}/projects/{}/issues/1/notes".format(conf.gitlab_base_url, conf.gitlab_project_id)]
+
+
+def test_relink(monkeypatch, tmp_path):
+    journal_store = "sqlite:///{}".format(tmp_path / "journal.db")
+    conf = load_test_config(monkeypatch, dry_run=False, component_mapping_auto=True,
+                            journal_store=journal_store)
+    journal = bugzilla2gitlab.journal.Journal(journal_store)
+    bug_link = conf.bugzilla_base_url + "/show_bug.cgi?id={}"
+
+    # bug 103 depends on 22803 (not migrated), blocks 23 and is a duplicate of bug 20,
+    # which its note mentions too; bug 20 links to no other bug
+    bugs = {}
+    for bug_id, dependson, blocked in [("103", ["22803"], ["23"]), ("23", ["103"], []), ("20", [], [])]:
+        fields = bugzilla2gitlab.utils.load_bugzilla_bug(os.path.join(TEST_DATA_PATH, "bug-103.xml"))
+        fields.update(bug_id=bug_id, dependson=dependson, blocked=blocked)
+        if bug_id == "20":
+            fields["long_desc"][1]["thetext"] = "Fixed."
+            fields["resolution"] = "FIXED"
+        bugs[bug_id] = fields
+    issues = {}
+    for iid, (bug_id, fields) in enumerate(bugs.items(), 1):
+        gitlab = FakeGitLab().install(monkeypatch)
+        issue_thread = bugzilla2gitlab.models.IssueThread(conf, fields)
+        issue_thread.save()
+        journal.record(bug_id, iid, issue_thread.journal_entry())
+        notes = [{"id": 100 * iid + i, "body": r[2]["body"], "author": {"id": int(r[3]["sudo"])}, "system": False}
+                 for i, r in enumerate(gitlab.find("post", "/issues/7/notes"))]
+        issues[iid] = {"iid": iid, "description": gitlab.find("post", "/issues")[0][2]["description"], "notes": notes}
+    assert journal.get(103)["description_refs"] == ["20", "22803", "23"]
+    assert journal.get(103)["note_refs"] == ["20"]
+    assert journal.get(20)["note_refs"] == []
+
+    requests = []
+
+    def perform_request(url, method, data={}, headers={}, **kwargs):
+        requests.append((method, url, dict(data), dict(headers)))
+        return {}
+
+    def paginate(url, params={}, headers={}, verify=True, keyset=False, prefetch=0):
+        requests.append(("get", url, dict(params), dict(headers)))
+        if url.endswith("/issues"):
+            return iter([issues[iid] for iid in params["iids[]"]])
+        return iter(issues[int(url.split("/")[-2])]["notes"])
+
+    def get_gitlab_project(url, project, headers, verify=True):
+        return {"web_url": "https://git.example.com/my-namespace/my-projectname"}
+
+    monkeypatch.setattr(bugzilla2gitlab.relinking, "_perform_request", perform_request)
+    monkeypatch.setattr(bugzilla2gitlab.relinking, "paginate", paginate)
+    monkeypatch.setattr(bugzilla2gitlab.relinking, "get_gitlab_project", get_gitlab_project)
+    relinker = bugzilla2gitlab.relinking.Relinker(conf, journal, concurrency=2)
+    assert relinker.run() == "Relinked 2 description(s) and 2 note(s), created 1 issue link(s)"
+
+    # the issues of bugs 103 and 23 are read in one request, bug 20 is not touched
+    issue_url = "{}/projects/{}/issues".format(conf.gitlab_base_url, conf.gitlab_project_id)
+    assert [r[2]["iids[]"] for r in requests if r[1] == issue_url] == [[1, 2]]
+    assert not [r for r in requests if "/issues/3" in r[1]]
+
+    edits = {r[1][len(issue_url):]: r for r in requests if r[0] == "put"}
+    description = edits["/1"][2]["description"]
+    assert "[23](https://git.example.com/my-namespace/my-projectname/-/issues/2)" in description
+    assert "of [bug 20](https://git.example.com/my-namespace/my-projectname/-/issues/3)" in description
+    assert "[22803]({})".format(bug_link.format(22803)) in description
+    # the link to the bug itself is kept
+    assert "[103]({})".format(bug_link.format(103)) in description
+    note = edits["/1/notes/100"]
+    assert "(https://git.example.com/my-namespace/my-projectname/-/issues/3)" in note[2]["body"]
+    assert note[3]["sudo"] == str(issues[1]["notes"][0]["author"]["id"])
+    assert "[103](https://git.example.com/my-namespace/my-projectname/-/issues/1)" in edits["/2"][2]["description"]
+
+    links = [r for r in requests if r[0] == "post"]
+    assert [(r[1], r[2]) for r in links] == [
+        (issue_url + "/1/links", {"target_project_id": str(conf.gitlab_project_id), "target_issue_iid": 2,
+                                  "link_type": "relates_to"})]